@@ -0,0 +1,190 @@
+"""最小化的 astrbot.api 替身
+
+AstrBot 之外无法直接导入 main.py。基准测试脚本通过 load_plugin() 先把替身
+模块注册进 sys.modules，再导入插件模块。替身只实现插件实际用到的接口。
+"""
+import asyncio
+import json
+import logging
+import random
+import re
+import sys
+import types
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+class AstrMessageEvent:
+    def __init__(self, message_str: str = "", sender_id: str = "10001", sender_name: str = "测试玩家",
+                 group_id: str = "bench"):
+        self.message_str = message_str
+        self._sender_id = sender_id
+        self._sender_name = sender_name
+        self._group_id = group_id
+        self.unified_msg_origin = f"stub:GroupMessage:{group_id}"
+
+    def get_group_id(self):
+        return self._group_id
+
+    def get_sender_id(self):
+        return self._sender_id
+
+    def get_sender_name(self):
+        return self._sender_name
+
+    def plain_result(self, text: str):
+        return text
+
+
+class MessageChain:
+    def __init__(self):
+        self.text = ""
+
+    def message(self, text: str):
+        self.text += text
+        return self
+
+
+class _Filter:
+    """filter.command(...) 在替身中不做注册，原样返回处理函数"""
+
+    def command(self, *args, **kwargs):
+        return lambda func: func
+
+
+class LLMResponse:
+    def __init__(self, completion_text: str, role: str = "assistant"):
+        self.completion_text = completion_text
+        self.role = role
+
+
+BATCH_TASK_RE = re.compile(r"^### 任务 (\d+)\n(.*?)(?=\n\n### 任务 |\Z)", re.S | re.M)
+
+
+def batch_responder(garble_rate: float = 0.0, seed: int = 0):
+    """识别插件合批提示词（build_batch_prompt）的应答函数
+
+    普通提示词返回 "叙事：<提示词>"；合批提示词对每个任务返回一行
+    {"id": 编号, "text": "叙事：<任务内容>"}，并以 garble_rate 的概率漏掉或写坏某一行。
+    """
+    rng = random.Random(seed)
+
+    def respond(prompt: str, system_prompt: str) -> str:
+        tasks = BATCH_TASK_RE.findall(prompt)
+        if not tasks:
+            return f"叙事：{prompt.strip()}"
+        lines = []
+        for index, task in tasks:
+            if rng.random() < garble_rate:
+                lines.append(rng.choice(["", "{broken json", f'{{"id": {index}}}']))
+                continue
+            lines.append(json.dumps({"id": int(index), "text": f"叙事：{task.strip()}"}, ensure_ascii=False))
+        return "```\n" + "\n".join(lines) + "\n```"
+    return respond
+
+
+class StubProvider:
+    """本地 LLM 提供者替身：按给定延迟和失败率返回文本，不访问网络
+
+    latency 为 (最小, 最大) 秒，每次调用在其间均匀取值；failure_rate 为抛出异常的概率。
+    responder(prompt, system_prompt) 决定返回文本，默认为 batch_responder()。
+    calls 记录调用次数，max_concurrency 记录同时进行的调用数峰值。
+    """
+
+    def __init__(self, latency=(0.0, 0.0), failure_rate: float = 0.0, responder=None, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.responder = responder or batch_responder(seed=seed)
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.active = 0
+        self.max_concurrency = 0
+
+    async def text_chat(self, prompt: str = "", func_tool=None, system_prompt: str = "", **kwargs):
+        self.calls += 1
+        self.active += 1
+        self.max_concurrency = max(self.max_concurrency, self.active)
+        try:
+            await asyncio.sleep(self.rng.uniform(*self.latency))
+            if self.rng.random() < self.failure_rate:
+                raise RuntimeError("stub provider failure")
+            return LLMResponse(self.responder(prompt, system_prompt))
+        finally:
+            self.active -= 1
+
+
+class Context:
+    """记录插件主动发送的消息，不连接任何平台"""
+
+    def __init__(self, provider=None):
+        self.sent = []
+        self.provider = provider
+
+    async def send_message(self, origin, message_chain):
+        self.sent.append((origin, message_chain.text))
+        return True
+
+    async def send_private_message(self, user_id, text):
+        self.sent.append((user_id, text))
+
+    def get_using_provider(self):
+        return self.provider
+
+    def get_llm_tool_manager(self):
+        return None
+
+
+class Star:
+    def __init__(self, context):
+        self.context = context
+
+    async def terminate(self):
+        pass
+
+
+def register(*args, **kwargs):
+    return lambda cls: cls
+
+
+def install() -> None:
+    """把替身模块注册为 astrbot.api / astrbot.api.event / astrbot.api.star"""
+    if "astrbot.api" in sys.modules:
+        return
+    astrbot = types.ModuleType("astrbot")
+    api = types.ModuleType("astrbot.api")
+    event = types.ModuleType("astrbot.api.event")
+    star = types.ModuleType("astrbot.api.star")
+
+    api.logger = logging.getLogger("astrbot")
+    event.filter = _Filter()
+    event.AstrMessageEvent = AstrMessageEvent
+    event.MessageChain = MessageChain
+    star.Context = Context
+    star.Star = Star
+    star.register = register
+
+    astrbot.api = api
+    api.event = event
+    api.star = star
+    sys.modules.update({
+        "astrbot": astrbot,
+        "astrbot.api": api,
+        "astrbot.api.event": event,
+        "astrbot.api.star": star,
+    })
+
+
+def load_plugin():
+    """安装替身并导入插件的 main 模块"""
+    install()
+    if str(REPO_ROOT) not in sys.path:
+        sys.path.insert(0, str(REPO_ROOT))
+    import main
+    main.ShardRouter.worker_entry = run_shard_worker
+    return main
+
+
+def run_shard_worker(index, shards, conn):
+    """分片工作进程入口：spawn 出的子进程没有 astrbot，先安装替身再导入插件"""
+    load_plugin()._shard_worker_main(index, shards, conn)
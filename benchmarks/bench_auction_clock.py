@@ -0,0 +1,118 @@
+"""拍卖会快速成交倒计时的任务创建速率与内存基准
+
+模拟每秒 100 次出价的竞拍战，对比：
+  legacy - 旧实现的模型：每次出价取消上一个任务并新建一个睡眠30秒、持有事件对象的任务
+  clock  - 当前实现：真实调用 /拍卖会 bid，只改期任务表中的 quick_win 任务，由插件唯一的任务协程统一触发
+job_table_writes 为 system/jobs.json 的写入次数（含退出时的一次）。
+
+用法：python benchmarks/bench_auction_clock.py [--rate 100] [--seconds 5]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from astrbot_stub import AstrMessageEvent, Context, load_plugin
+
+main = load_plugin()
+
+
+async def _legacy_quick_win(event):
+    await asyncio.sleep(main.AUCTION_QUICK_WIN_SECONDS)
+    return event
+
+
+async def run(mode: str, rate: int, seconds: float) -> dict:
+    loop = asyncio.get_running_loop()
+    created = 0
+    default_factory = loop.get_task_factory()
+
+    def counting_factory(loop, coro, **kwargs):
+        nonlocal created
+        created += 1
+        if default_factory is not None:
+            return default_factory(loop, coro, **kwargs)
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    plugin = main.DouPoCangQiongFinal(Context())
+    world = plugin._get_world("bench")
+    world.game_started = True
+    bidders = []
+    for i in range(20):
+        player = main.Player(f"bidder-{i}", f"竞拍者{i}")
+        player.gold = 10 ** 12
+        world.players[player.user_id] = player
+        bidders.append(player)
+    world.generate_auction_items()
+    world.last_auction_refresh = time.time()
+    world.auction_end_time = world.last_auction_refresh + 7200
+
+    job_writes = 0
+    save_jobs = plugin.persistence.save_jobs
+
+    def counting_save_jobs(jobs):
+        nonlocal job_writes
+        job_writes += 1
+        save_jobs(jobs)
+    plugin.persistence.save_jobs = counting_save_jobs
+
+    legacy_tasks = {}
+    loop.set_task_factory(counting_factory)
+    tracemalloc.start()
+    bids = int(rate * seconds)
+    price = world.auction_items[0]["base_price"]
+    started = time.perf_counter()
+    for i in range(bids):
+        price += 10
+        bidder = bidders[i % len(bidders)]
+        event = AstrMessageEvent(f"/拍卖会 bid 1 {price}", bidder.user_id, bidder.user_name, "bench")
+        if mode == "clock":
+            async for _ in plugin.auction(event):
+                pass
+        else:
+            world.auction_bids["0"] = {
+                "bid": price, "bidder": bidder.user_id,
+                "bidder_name": bidder.user_name, "bid_time": time.time(),
+            }
+            if 0 in legacy_tasks:
+                legacy_tasks[0].cancel()
+            legacy_tasks[0] = asyncio.create_task(_legacy_quick_win(event))
+        await asyncio.sleep(1 / rate)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    loop.set_task_factory(default_factory)
+
+    for task in legacy_tasks.values():
+        task.cancel()
+    pending_jobs = len(plugin.jobs)
+    await plugin.terminate()
+    return {
+        "mode": mode,
+        "bids": bids,
+        "elapsed_s": round(elapsed, 3),
+        "tasks_created": created,
+        "tasks_per_bid": round(created / bids, 3),
+        "peak_traced_kib": round(peak / 1024, 1),
+        "pending_jobs": pending_jobs,
+        "job_table_writes": job_writes,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=int, default=100, help="每秒出价次数")
+    parser.add_argument("--seconds", type=float, default=5, help="竞拍战持续时间")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="dpcq_bench_"))
+    results = [asyncio.run(run(mode, args.rate, args.seconds)) for mode in ("legacy", "clock")]
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,127 @@
+"""/接受挑战 处理延迟基准：同步等待 LLM 叙事 vs 后台叙事工作池
+
+  inline - 旧实现的模型：处理函数内 await 完整的 text_chat 往返后才回复
+  pool   - 当前实现：真实调用 accept_duel，叙事交给 NarrationPool 后台生成再补发
+
+LLM 由 astrbot_stub.StubProvider 模拟（延迟区间与失败率可调），--duels 场对战以
+--rate 场/秒的速度陆续发起。报告处理函数延迟（收到命令到产出回复）的 P50/P99，
+pool 模式另报告叙事送达耗时的 P50/P99、LLM 并发峰值以及模板兜底次数。
+
+用法：python benchmarks/bench_duel_narration.py [--duels 200] [--rate 50] [--latency 0.5,3] [--failure-rate 0.05]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from astrbot_stub import AstrMessageEvent, Context, StubProvider, load_plugin
+
+main = load_plugin()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 4) if ordered else None
+
+
+async def run(mode: str, duels: int, rate: float, latency, failure_rate: float, timeout: float) -> dict:
+    provider = StubProvider(latency, failure_rate)
+    context = Context(provider)
+    plugin = main.DouPoCangQiongFinal(context)
+    plugin.narration.timeout = timeout
+    world = plugin._get_world("bench")
+    players = []
+    for i in range(duels * 2):
+        player = main.Player(f"duelist-{i}", f"斗者{i}")
+        player.realm_index = i % 6
+        world.players[player.user_id] = player
+        players.append(player)
+
+    if mode == "inline":
+        async def legacy_accept(event):
+            """旧处理函数的关键路径：胜负已定后 await 叙事，再拼接回复"""
+            challenger, defender = world.players[event.challenger], world.players[event.get_sender_id()]
+            prompt = plugin._duel_prompt(challenger, defender, challenger, False)
+            desc = await plugin._call_llm(None, prompt, "你是斗破苍穹世界的战斗记录者，擅长用生动语言描述精彩对决")
+            yield event.plain_result(f"=== 惊天对决 ===\n{desc}")
+        handler = legacy_accept
+    else:
+        handler = plugin.accept_duel
+
+    handler_latencies = []
+
+    async def one_duel(i: int):
+        challenger, defender = players[2 * i], players[2 * i + 1]
+        world.duel_requests.add(challenger.user_id, {
+            "challenger_id": challenger.user_id, "target_id": defender.user_id, "create_time": time.time(),
+        })
+        event = AstrMessageEvent("/接受挑战", defender.user_id, defender.user_name, "bench")
+        event.challenger = challenger.user_id
+        started = time.perf_counter()
+        async for _ in handler(event):
+            pass
+        handler_latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(duels):
+        tasks.append(asyncio.create_task(one_duel(i)))
+        await asyncio.sleep(1 / rate)
+    await asyncio.gather(*tasks)
+    if mode == "pool":
+        await plugin.narration.queue.join()
+    elapsed = time.perf_counter() - started
+    plugin.narration.stop()
+    if plugin.job_runner_task:
+        plugin.job_runner_task.cancel()
+
+    result = {
+        "mode": mode,
+        "duels": duels,
+        "elapsed_s": round(elapsed, 3),
+        "handler_p50_s": percentile(handler_latencies, 0.5),
+        "handler_p99_s": percentile(handler_latencies, 0.99),
+        "llm_calls": provider.calls,
+        "llm_max_concurrency": provider.max_concurrency,
+    }
+    if mode == "pool":
+        p50, p99 = plugin.narration.percentiles()
+        result.update({
+            "narration_p50_s": round(p50, 4) if p50 is not None else None,
+            "narration_p99_s": round(p99, 4) if p99 is not None else None,
+            "narration_stats": dict(plugin.narration.stats),
+            "follow_up_messages": len(context.sent),
+        })
+    return result
+
+
+async def run_mode(mode: str, args, latency) -> dict:
+    try:
+        return await run(mode, args.duels, args.rate, latency, args.failure_rate, args.timeout)
+    except Exception as e:
+        # inline 模式下 StubProvider 的失败会直接让处理函数抛错，这正是旧实现的行为
+        return {"mode": mode, "error": repr(e)}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duels", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50, help="每秒发起的对战数")
+    parser.add_argument("--latency", default="0.5,3", help="LLM 延迟区间（秒），如 0.5,3")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="LLM 调用失败概率（inline 模式遇到失败即中止）")
+    parser.add_argument("--timeout", type=float, default=main.NARRATION_TIMEOUT, help="叙事生成超时（秒）")
+    args = parser.parse_args()
+    latency = tuple(float(v) for v in args.latency.split(","))
+
+    main.logger.setLevel("ERROR")
+    os.chdir(tempfile.mkdtemp(prefix="dpcq_bench_"))  # 插件会在工作目录下写 dpcq_data
+    results = [asyncio.run(run_mode(mode, args, latency)) for mode in ("inline", "pool")]
+    print(json.dumps({"latency_s": latency, "failure_rate": args.failure_rate, "results": results},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,120 @@
+"""副本回合制战斗基准与平衡表
+
+  simulate - 直接调用 simulate_dungeon_battle（批量平衡测试的用法），报告每秒战斗数
+  instance - 完整的 DungeonInstance.run_battle：含丹药加成读取、按贡献分奖和批量入背包
+
+另输出战力比曲线：各 队伍战力/BOSS战力 下 1 人与 5 人队伍的胜率和平均回合数，
+5 人队伍中战力最高者的平均伤害占比，以及 5 名等战力队员各自的平均伤害占比
+（奖励按伤害分配，必须与出手位置无关，偏离 0.2 超过 0.02 即报错）。同一 --seed 的结果完全相同。
+
+用法：python benchmarks/bench_dungeon_battle.py [--battles 20000] [--level 高级] [--seed 42]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import json
+import random
+import time
+
+from astrbot_stub import load_plugin
+
+main = load_plugin()
+
+RATIOS = (0.3, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.2, 1.5, 2.0)
+
+
+def curve(battles: int, seed: int) -> list:
+    rng = random.Random(seed)
+    rows = []
+    for ratio in RATIOS:
+        row = {"ratio": ratio}
+        for size in (1, 5):
+            # 5 人队伍战力按 5:4:3:2:1 分布，检验伤害占比是否随战力分配
+            weights = [size - i for i in range(size)]
+            powers = [ratio * w / sum(weights) for w in weights]
+            wins = rounds = top_share = 0
+            for _ in range(battles):
+                victory, used, damage = main.simulate_dungeon_battle(powers, 1.0, rng)
+                wins += victory
+                rounds += used
+                top_share += damage[0] / (sum(damage) or 1)
+            row[f"win_rate_{size}"] = round(wins / battles, 3)
+            row[f"avg_rounds_{size}"] = round(rounds / battles, 2)
+            if size > 1:
+                row["top_damage_share_5"] = round(top_share / battles, 3)
+        rows.append(row)
+    return rows
+
+
+def equal_shares(battles: int, seed: int) -> list:
+    rng = random.Random(seed)
+    rows = []
+    for ratio in (1.0, 3.0):
+        shares = [0.0] * 5
+        for _ in range(battles):
+            damage = main.simulate_dungeon_battle([ratio / 5] * 5, 1.0, rng)[2]
+            total = sum(damage) or 1
+            for i, d in enumerate(damage):
+                shares[i] += d / total
+        shares = [round(x / battles, 3) for x in shares]
+        assert max(abs(x - 0.2) for x in shares) < 0.02, f"等战力队员的伤害占比不均: {shares}"
+        rows.append({"ratio": ratio, "damage_shares_5": shares})
+    return rows
+
+
+def bench_simulate(battles: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    powers = [0.3, 0.25, 0.2, 0.15, 0.1]
+    started = time.perf_counter()
+    for _ in range(battles):
+        main.simulate_dungeon_battle(powers, 1.0, rng)
+    elapsed = time.perf_counter() - started
+    return {"mode": "simulate", "battles": battles, "seconds": round(elapsed, 4),
+            "battles_per_s": int(battles / elapsed)}
+
+
+def bench_instance(battles: int, level: str, seed: int) -> dict:
+    boss_power = main.DUNGEON_LEVELS[level]["boss_power"]
+    players = []
+    for i in range(5):
+        player = main.Player(f"bench-{i}", f"玩家{i}")
+        player.realm_index = 10
+        player.level = 1 + i
+        players.append(player)
+    players[0].apply_temp_boost("battle_all", 0.5, 3600)
+    started = time.perf_counter()
+    wins = 0
+    for n in range(battles):
+        for player in players:
+            player.inventory.clear()
+        dungeon = main.DungeonInstance(f"bench-{n}", level, players, boss_power, players[0].user_id)
+        wins += dungeon.run_battle(seed=seed + n)[0]
+    elapsed = time.perf_counter() - started
+    return {"mode": "instance", "level": level, "battles": battles, "seconds": round(elapsed, 4),
+            "battles_per_s": int(battles / elapsed), "win_rate": round(wins / battles, 3),
+            "power_ratio": round(sum(p.base_power for p in players) / boss_power, 3)}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--battles", type=int, default=20000, help="每种模式的战斗次数")
+    parser.add_argument("--curve-battles", type=int, default=4000, help="胜率曲线上每个点的战斗次数")
+    parser.add_argument("--level", default="高级", help="instance 模式使用的副本等级")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.level not in main.DUNGEON_LEVELS:
+        parser.error(f"无效的副本等级: {args.level}")
+    main.logger.setLevel("WARNING")  # Player 构造与属性计算会打 info 日志
+
+    print(json.dumps({
+        "results": [
+            bench_simulate(args.battles, args.seed),
+            bench_instance(args.battles, args.level, args.seed),
+        ],
+        "curve": curve(args.curve_battles, args.seed),
+        "equal_shares": equal_shares(args.curve_battles, args.seed),
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,93 @@
+"""LLM 请求合批基准：逐条调用 vs LLMBatcher 合批
+
+用 astrbot_stub.StubProvider 作为本地 LLM（不访问网络），其 batch_responder 能识别
+build_batch_prompt 生成的合批提示词，按任务编号逐行返回 JSON。--requests 个请求在
+--spread 秒内陆续到达（模拟数百个群的对战叙事与世界事件），对比：
+
+  single  - 每个请求单独调用一次提供者（旧 _call_llm 的行为）
+  batched - 经 LLMBatcher 合批
+  garbled - 合批，但提供者以 --garble-rate 的概率漏掉或写坏某一行，检验逐条回退
+
+报告提供者调用次数、请求平均/P99 耗时，并校验每个请求拿到的都是自己任务的结果。
+
+用法：python benchmarks/bench_llm_batching.py [--requests 400] [--spread 2] [--latency 0.8,1.5]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from astrbot_stub import StubProvider, batch_responder, load_plugin
+
+main = load_plugin()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 4) if ordered else None
+
+
+async def run(mode: str, requests: int, spread: float, latency, garble_rate: float, seed: int) -> dict:
+    provider = StubProvider(latency, responder=batch_responder(garble_rate if mode == "garbled" else 0.0, seed))
+
+    async def call(prompt, system_prompt):
+        response = await provider.text_chat(prompt=prompt, system_prompt=system_prompt)
+        return response.completion_text
+
+    batcher = main.LLMBatcher(call)
+    system_prompts = ["你是斗破苍穹世界的战斗记录者", "你是斗破苍穹世界的天道意志"]
+    latencies = []
+    mismatched = 0
+
+    async def one(i: int):
+        nonlocal mismatched
+        prompt = f"请求{i}"
+        system_prompt = system_prompts[i % 2]
+        await asyncio.sleep(random.Random(seed + i).uniform(0, spread))
+        started = time.perf_counter()
+        if mode == "single":
+            text = await call(prompt, system_prompt)
+        else:
+            text = await batcher.request(prompt, system_prompt)
+        latencies.append(time.perf_counter() - started)
+        if text != f"叙事：{prompt}":
+            mismatched += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": mode,
+        "requests": requests,
+        "provider_calls": provider.calls,
+        "elapsed_s": round(elapsed, 3),
+        "avg_latency_s": round(sum(latencies) / len(latencies), 4),
+        "p99_latency_s": percentile(latencies, 0.99),
+        "mismatched": mismatched,
+        "batcher": dict(batcher.stats),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--spread", type=float, default=2.0, help="请求到达的时间跨度（秒）")
+    parser.add_argument("--latency", default="0.8,1.5", help="提供者延迟区间（秒）")
+    parser.add_argument("--garble-rate", type=float, default=0.1, help="garbled 模式下每行被写坏的概率")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    latency = tuple(float(v) for v in args.latency.split(","))
+
+    main.logger.setLevel("ERROR")
+    results = [
+        asyncio.run(run(mode, args.requests, args.spread, latency, args.garble_rate, args.seed))
+        for mode in ("single", "batched", "garbled")
+    ]
+    print(json.dumps({"config": {"window_s": main.LLM_BATCH_WINDOW, "max_batch": main.LLM_BATCH_MAX},
+                      "results": results}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,139 @@
+"""斗破彩开奖基准：位掩码彩票 vs 旧的逐注 set 求交
+
+  legacy - 旧实现：每注为 7 个号码的列表，逐注构造两个 set 与中奖号码求交
+  pure   - 当前实现的纯 Python 路径：array('Q') 掩码 + int.bit_count 查表
+  numpy  - 当前实现的 NumPy 路径（已安装 NumPy 时）：整批 popcount + 查表
+  index  - 倒排索引（LOTTERY_WINNER_LOOKUP = "index"）：只判定与中奖号码共有号码对的候选彩票，
+           另报告购买时建立索引的开销（index_build）
+
+旧实现、纯 Python 路径和倒排索引在 --sample-tickets 注上实测，再按线性外推到 --tickets 注；
+NumPy 路径直接在 --tickets 注上实测。三条路径在样本上的中奖统计必须一致。
+另校验 generate_lottery_tickets(aggregate=True) 在两条路径上合并出的注数之和等于购买注数。
+
+用法：python benchmarks/bench_lottery.py [--tickets 10000000] [--users 1000] [--sample-tickets 500000]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import json
+import random
+import time
+from array import array
+
+from astrbot_stub import load_plugin
+
+main = load_plugin()
+
+
+def legacy_match(tickets_by_user, winning_numbers):
+    """旧版 GameWorld.draw_lottery 的判奖循环"""
+    winners = {level: [] for level in main.LOTTERY_PRIZE_LEVELS}
+    for user_id, tickets in tickets_by_user.items():
+        for ticket in tickets:
+            main_match = len(set(ticket[:5]) & set(winning_numbers[:5]))
+            special_match = len(set(ticket[5:]) & set(winning_numbers[5:]))
+            tier = main._lottery_tier(main_match, special_match)
+            if tier >= 0:
+                winners[main.LOTTERY_PRIZE_LEVELS[tier]].append((user_id, ticket))
+    return winners
+
+
+def make_tickets(count: int, users: int, distinct: int = 100000):
+    """生成 count 注随机彩票，平均分给 users 个玩家（由 distinct 注不同号码循环铺满）"""
+    world = main.GameWorld("bench")
+    pool = array("Q", (main.encode_lottery_ticket(world.generate_lottery_numbers())
+                       for _ in range(min(distinct, count))))
+    per_user = count // users
+    tickets_by_user = {}
+    for i in range(users):
+        tickets = array("Q")
+        while len(tickets) < per_user:
+            offset = (i * per_user + len(tickets)) % len(pool)
+            tickets.extend(pool[offset:offset + per_user - len(tickets)])
+        tickets_by_user[f"user-{i}"] = tickets
+    return tickets_by_user
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def summary(winners):
+    return {level: len(v) for level, v in winners.items()}
+
+
+def check_aggregate(count: int) -> None:
+    """合并重复组合后的 {掩码: 注数} 总和必须等于 count（NumPy 与纯 Python 路径各校验一次）"""
+    numpy_module = main.np
+    for module in ([numpy_module, None] if numpy_module is not None else [None]):
+        main.np = module
+        try:
+            counts = main.generate_lottery_tickets(count, aggregate=True)
+        finally:
+            main.np = numpy_module
+        path = "numpy" if module is not None else "pure"
+        assert sum(counts.values()) == count, f"{path} 路径合并后的注数之和 {sum(counts.values())} != {count}"
+        assert all(n > 0 for n in counts.values()), f"{path} 路径出现了注数为 0 的组合"
+
+
+def report(mode, tickets, seconds, target):
+    return {
+        "mode": mode,
+        "tickets": tickets,
+        "seconds": round(seconds, 4),
+        "tickets_per_s": int(tickets / seconds) if seconds else None,
+        "est_seconds_at_target": round(seconds * target / tickets, 3),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=10_000_000, help="目标彩票数")
+    parser.add_argument("--users", type=int, default=1000, help="玩家数")
+    parser.add_argument("--sample-tickets", type=int, default=500_000, help="旧实现和纯 Python 路径实测的彩票数")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    check_aggregate(args.sample_tickets)
+    winning_numbers = main.GameWorld("bench").generate_lottery_numbers()
+    winning_mask = main.encode_lottery_ticket(winning_numbers)
+    numpy_module = main.np
+
+    sample = make_tickets(args.sample_tickets, args.users)
+    legacy_sample = {uid: [main.decode_lottery_ticket(t) for t in tickets] for uid, tickets in sample.items()}
+    results = []
+
+    legacy, seconds = timed(legacy_match, legacy_sample, winning_numbers)
+    results.append(report("legacy", args.sample_tickets, seconds, args.tickets))
+    del legacy_sample
+
+    main.np = None
+    try:
+        pure, seconds = timed(main.match_lottery_tickets, sample, winning_mask)
+    finally:
+        main.np = numpy_module
+    results.append(report("pure", args.sample_tickets, seconds, args.tickets))
+    assert summary(pure) == summary(legacy), "纯 Python 路径与旧实现的中奖统计不一致"
+
+    index, seconds = timed(main.LotteryIndex.from_tickets, sample)
+    results.append(report("index_build", args.sample_tickets, seconds, args.tickets))
+    indexed, seconds = timed(index.match, winning_mask)
+    results.append(report("index", args.sample_tickets, seconds, args.tickets))
+    assert summary(indexed) == summary(legacy), "倒排索引与旧实现的中奖统计不一致"
+    del index
+
+    if numpy_module is not None:
+        vectorised = main.match_lottery_tickets(sample, winning_mask)
+        assert summary(vectorised) == summary(legacy), "NumPy 路径与旧实现的中奖统计不一致"
+        full = make_tickets(args.tickets, args.users)
+        winners, seconds = timed(main.match_lottery_tickets, full, winning_mask)
+        results.append(report("numpy", args.tickets, seconds, args.tickets))
+        results[-1]["winners"] = summary(winners)
+
+    print(json.dumps({"winning_numbers": winning_numbers, "results": results}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,101 @@
+"""玩家挂单簿撮合基准
+
+随机的买卖限价单流（价格围绕 --mid 浮动）持续撮合，报告每秒处理的订单数，并校验：
+  - 不发生自成交：撮合到自己的挂单时撤销该挂单，不产生成交
+  - 资产守恒：全部挂单撤销后，所有玩家的金币总数和物品总数与开始时相同
+
+用法：python benchmarks/bench_order_book.py [--orders 20000] [--players 50] [--seed 42]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import json
+import random
+import time
+
+from astrbot_stub import load_plugin
+
+main = load_plugin()
+
+ITEM = "回气丹"
+
+
+def make_world(players: int, gold: int, items: int):
+    world = main.GameWorld("bench")
+    for i in range(players):
+        player = main.Player(f"trader-{i}", f"商人{i}")
+        player.gold = gold
+        player.inventory = [ITEM] * items
+        world.players[player.user_id] = player
+    return world
+
+
+def totals(world) -> tuple:
+    gold = sum(p.gold for p in world.players.values())
+    items = sum(p.inventory.count(ITEM) for p in world.players.values())
+    return gold, items
+
+
+def cancel_all(world) -> None:
+    for book in list(world.order_books.values()):
+        for order in list(book.orders.values()):
+            world.cancel_order(order["user_id"], order["order_id"])
+
+
+def check_self_trade() -> None:
+    """同一玩家先挂卖单再挂可成交的买单：不成交，旧卖单被撤销并退还物品"""
+    world = make_world(2, 10_000, 5)
+    seller = world.players["trader-0"]
+    ok, _ = world.place_order(seller, "sell", ITEM, 100, 3)
+    assert ok
+    ok, msg = world.place_order(seller, "buy", ITEM, 120, 2)
+    assert ok and "成交" not in msg, f"发生了自成交: {msg}"
+    assert seller.inventory.count(ITEM) == 5, "被撤销的自己的卖单没有退还物品"
+    book = world.order_books[ITEM]
+    assert book.best("sell") is None and book.best("buy")["user_id"] == seller.user_id
+
+    # 他人的买单排在自己的买单之后：撤销自己的挂单后继续与他人成交
+    other = world.players["trader-1"]
+    world.place_order(other, "buy", ITEM, 90, 1)
+    ok, msg = world.place_order(seller, "sell", ITEM, 90, 1)
+    assert ok and "成交" in msg and "撤销" in msg, msg
+
+
+def bench(orders: int, players: int, mid: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    world = make_world(players, 10 ** 9, 200)
+    before = totals(world)
+    traders = list(world.players.values())
+    fills = self_fills = 0
+    started = time.perf_counter()
+    for _ in range(orders):
+        player = rng.choice(traders)
+        side = rng.choice(("buy", "sell"))
+        price = max(1, int(rng.gauss(mid, mid * 0.05)))
+        ok, msg = world.place_order(player, side, ITEM, price, rng.randint(1, 5))
+        if ok:
+            lines = msg.splitlines()
+            fills += sum(line.startswith("与 ") for line in lines)
+            self_fills += sum(line.startswith(f"与 {player.user_name} ") for line in lines)
+    elapsed = time.perf_counter() - started
+    resting = sum(len(book) for book in world.order_books.values())
+    cancel_all(world)
+    assert self_fills == 0, f"{self_fills} 笔自成交"
+    assert totals(world) == before, f"资产不守恒: {before} -> {totals(world)}"
+    return {"orders": orders, "players": players, "seconds": round(elapsed, 4),
+            "orders_per_s": int(orders / elapsed), "fills": fills, "resting_at_end": resting}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=20000, help="下单次数")
+    parser.add_argument("--players", type=int, default=50, help="参与交易的玩家数")
+    parser.add_argument("--mid", type=int, default=1000, help="中间价")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    check_self_trade()
+    print(json.dumps(bench(args.orders, args.players, args.mid, args.seed), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,254 @@
+"""整体性能基准：在 100 / 1万 / 10万 人的合成世界上计时各项热点操作
+
+世界由 fixtures.make_world 生成（同一 --seed 完全相同），每种规模依次运行：
+
+  status      - 真实的 player_status 处理函数（含 world_serialized 与运行统计）
+  leaderboard - get_dominator_ranking（全世界扫描主宰并按战力排序）
+  market      - generate_market_items
+  train       - Player.train(continuous=True)
+  explore     - Player.explore，冷却与生命在计时之外重置
+  dungeon     - 5 人 DungeonInstance.run_battle（初级副本，含掉落入背包）
+  lottery     - draw_lottery（每次开奖前在计时之外恢复本期彩票）
+  save / load - GameWorld.to_dict + DataPersistence.save_world，load_world + GameWorld.from_dict
+
+逐玩家的场景抽取 --ops 名玩家各执行一次，整世界的场景重复 --repeat 次。每个场景报告
+平均 / P50 / P99 单次耗时（微秒）。结果 JSON 带提交号、Python 版本与是否启用 numpy，
+可用 --baseline 传入另一次的结果，逐项给出耗时比值并标出超过 --threshold 的退化。
+
+用法：python benchmarks/bench_suite.py [--sizes 100,10k,100k] [--ops 2000] [--repeat 5] [--baseline old.json]
+结果以 JSON 输出到标准输出（或 --output 指定的文件）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+
+from astrbot_stub import AstrMessageEvent, Context, StubProvider, load_plugin
+from fixtures import make_world, parse_size, size_label
+
+main = load_plugin()
+
+SCENARIOS = ("status", "leaderboard", "market", "train", "explore", "dungeon", "lottery", "save", "load")
+
+
+def summarise(durations: list) -> dict:
+    ordered = sorted(durations)
+    n = len(ordered)
+    return {
+        "ops": n,
+        "total_s": round(sum(ordered), 4),
+        "mean_us": round(sum(ordered) / n * 1e6, 2),
+        "p50_us": round(ordered[n // 2] * 1e6, 2),
+        "p99_us": round(ordered[min(n - 1, int(n * 0.99))] * 1e6, 2),
+    }
+
+
+def timed(op, times: int, prepare=None) -> list:
+    """执行 op 共 times 次，prepare(i) 在计时之外运行，返回 op(i) 的各次耗时"""
+    durations = []
+    for i in range(times):
+        if prepare is not None:
+            prepare(i)
+        started = time.perf_counter()
+        op(i)
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+async def bench_status(plugin, world, sample) -> list:
+    durations = []
+    for player in sample:
+        event = AstrMessageEvent("/dp_status", player.user_id, player.user_name, world.group_id)
+        started = time.perf_counter()
+        async for _ in plugin.player_status(event):
+            pass
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def bench_train(world, sample) -> list:
+    def prepare(i):
+        sample[i].is_dying = False  # 走火入魔可能致死，不让后续样本直接返回
+
+    return timed(lambda i: sample[i].train(continuous=True), len(sample), prepare)
+
+
+def bench_explore(world, sample) -> list:
+    def prepare(i):
+        player = sample[i]
+        player.last_explore_time = 0
+        player.is_dying = False
+        player.health = player.max_health
+
+    return timed(lambda i: sample[i].explore("初级"), len(sample), prepare)
+
+
+def bench_dungeon(world, sample, seed: int) -> list:
+    boss_power = main.DUNGEON_LEVELS["初级"]["boss_power"]
+    teams = [sample[i:i + 5] for i in range(0, len(sample) - 4, 5)]
+
+    def op(i):
+        team = teams[i]
+        main.DungeonInstance(f"bench-{i}", "初级", team, boss_power, team[0].user_id).run_battle(seed=seed + i)
+
+    return timed(op, len(teams))
+
+
+def bench_lottery(world, repeat: int) -> list:
+    tickets = {user_id: main.array("Q", batch) for user_id, batch in world.lottery_tickets.items()}
+    pool = world.lottery_pool
+
+    def prepare(i):
+        world.lottery_tickets = {user_id: main.array("Q", batch) for user_id, batch in tickets.items()}
+        if main.LOTTERY_WINNER_LOOKUP == "index":
+            world.lottery_index = main.LotteryIndex.from_tickets(world.lottery_tickets)
+        world.lottery_pool = pool
+        world.lottery_archive_pending.clear()
+
+    return timed(lambda i: world.draw_lottery(), repeat, prepare)
+
+
+def bench_save_load(world, repeat: int):
+    persistence = main.DataPersistence(storage_dir=tempfile.mkdtemp(prefix="dpcq_bench_store_"))
+    save = timed(lambda i: persistence.save_world(world.group_id, world.to_dict()), repeat)
+    load = timed(lambda i: main.GameWorld.from_dict(persistence.load_world(world.group_id)), repeat)
+    return save, load, (persistence.storage_dir / f"{world.group_id}.json").stat().st_size
+
+
+async def run_size(players: int, args, scenarios) -> dict:
+    started = time.perf_counter()
+    world = make_world(main, players, args.seed)
+    fixture_s = time.perf_counter() - started
+    rng = random.Random(args.seed)
+    sample = rng.sample(list(world.players.values()), min(args.ops, players))
+
+    plugin = main.DouPoCangQiongFinal(Context(StubProvider((0, 0))))
+    plugin.worlds[world.group_id] = world
+    for user_id in world.players:
+        plugin.player_world_map[user_id] = world.group_id
+
+    label = size_label(players)
+    results = []
+
+    def add(scenario, durations, **extra):
+        results.append({"size": label, "scenario": scenario, **summarise(durations), **extra})
+
+    for scenario in scenarios:
+        random.seed(args.seed)  # 插件内部用全局 random，每个场景从同一状态开始
+        if scenario == "status":
+            add("status", await bench_status(plugin, world, sample))
+        elif scenario == "leaderboard":
+            add("leaderboard", timed(lambda i: world.get_dominator_ranking(), args.repeat),
+                dominators=len(world.get_dominator_players()))
+        elif scenario == "market":
+            add("market", timed(lambda i: world.generate_market_items(), args.repeat))
+        elif scenario == "train":
+            add("train", bench_train(world, sample))
+        elif scenario == "explore":
+            add("explore", bench_explore(world, sample))
+        elif scenario == "dungeon":
+            add("dungeon", bench_dungeon(world, sample, args.seed))
+        elif scenario == "lottery":
+            tickets = sum(len(batch) for batch in world.lottery_tickets.values())
+            add("lottery", bench_lottery(world, args.repeat), tickets=tickets)
+        elif scenario in ("save", "load") and not any(r["scenario"] in ("save", "load") for r in results):
+            save, load, file_bytes = bench_save_load(world, args.repeat)
+            if "save" in scenarios:
+                add("save", save, file_bytes=file_bytes)
+            if "load" in scenarios:
+                add("load", load, file_bytes=file_bytes)
+
+    plugin.worlds.clear()  # terminate 会保存所有世界，基准世界不必落盘
+    await plugin.terminate()
+    return {"size": label, "players": players, "fixture_s": round(fixture_s, 3), "results": results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline: dict, threshold: float) -> list:
+    """按 (规模, 场景) 对比平均耗时，ratio > 1 表示变慢"""
+    old = {(r["size"], r["scenario"]): r for run in baseline.get("runs", []) for r in run["results"]}
+    rows = []
+    for r in results:
+        before = old.get((r["size"], r["scenario"]))
+        if not before or not before["mean_us"]:
+            continue
+        ratio = r["mean_us"] / before["mean_us"]
+        rows.append({
+            "size": r["size"],
+            "scenario": r["scenario"],
+            "baseline_mean_us": before["mean_us"],
+            "mean_us": r["mean_us"],
+            "ratio": round(ratio, 3),
+            "regression": ratio > 1 + threshold,
+        })
+    return rows
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,10k,100k", help="世界人数，逗号分隔，可写 100 / 10k / 100k 或具体人数")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="要运行的场景，逗号分隔")
+    parser.add_argument("--ops", type=int, default=2000, help="逐玩家场景抽取的玩家数")
+    parser.add_argument("--repeat", type=int, default=5, help="整世界场景的重复次数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", help="另一次运行的 JSON 结果，用于逐项对比")
+    parser.add_argument("--threshold", type=float, default=0.2, help="平均耗时超过基线多少比例算退化")
+    parser.add_argument("--output", help="结果写入文件而不是标准输出")
+    args = parser.parse_args()
+
+    try:
+        sizes = [parse_size(s.strip()) for s in args.sizes.split(",") if s.strip()]
+    except ValueError:
+        parser.error(f"无法解析的世界规模: {args.sizes}")
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {sorted(unknown)}")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    main.logger.setLevel("WARNING")  # Player 构造与属性计算会打 info 日志
+    os.chdir(tempfile.mkdtemp(prefix="dpcq_bench_"))  # 插件会在工作目录下写 dpcq_data
+    runs = [asyncio.run(run_size(players, args, scenarios)) for players in sizes]
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": main.np is not None,
+            "lottery_lookup": main.LOTTERY_WINNER_LOOKUP,
+            "seed": args.seed,
+            "ops": args.ops,
+            "repeat": args.repeat,
+        },
+        "runs": runs,
+    }
+    if baseline is not None:
+        report["baseline_commit"] = baseline.get("meta", {}).get("commit")
+        report["comparison"] = compare([r for run in runs for r in run["results"]], baseline, args.threshold)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main_cli()
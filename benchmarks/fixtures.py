@@ -0,0 +1,73 @@
+"""基准用的合成世界
+
+make_world 生成指定人数的 GameWorld，分布尽量贴近线上存档：
+
+  - 境界呈长尾分布：多数玩家停留在前几个境界，少数达到主宰（realm_index 12）
+  - 金币按对数正态分布，背包物品取自 PILLS_DATA 与 OTHER_DATA，件数同样长尾，最多 200 件
+  - 约一成玩家带临时丹药加成，约两成玩家持有本期彩票（注数对数正态分布）
+  - 坊市已刷新一次
+
+同一 seed 生成的世界完全相同（会重置 random 与 numpy 的全局随机源，彩票号码由插件生成）。
+"""
+import random
+import time
+
+SIZES = {"100": 100, "10k": 10_000, "100k": 100_000}
+
+BOOST_TYPES = (("train_boost", 0.2), ("battle_all", 0.3), ("explore_cd", 0.3), ("perm_health", 200))
+
+
+def parse_size(label: str) -> int:
+    """'10k' / '10000' -> 10000"""
+    if label in SIZES:
+        return SIZES[label]
+    return int(label)
+
+
+def size_label(players: int) -> str:
+    for label, value in SIZES.items():
+        if value == players:
+            return label
+    return str(players)
+
+
+def make_player(main, rng: random.Random, index: int, item_pool: list, now: float):
+    """按线上分布生成一名玩家"""
+    max_realm = len(main.REALMS) - 1
+    realm_index = min(max_realm, int(rng.expovariate(0.45)))
+    if rng.random() < 0.002:
+        realm_index = 12  # 少量主宰，排行榜不至于为空
+    player = main.Player(f"bench-{index}", f"修士{index}", realm_index=realm_index)
+    player.level = rng.randint(1, 10)
+    player.required_qi = player._calculate_required_qi()
+    player.current_qi = rng.randint(0, player.required_qi - 1)
+    player.gold = int(rng.lognormvariate(7, 1.5))
+    count = min(200, int(rng.lognormvariate(2.3, 0.9)))
+    player.inventory = [rng.choice(item_pool) for _ in range(count)]
+    if rng.random() < 0.1:
+        boost_type, value = rng.choice(BOOST_TYPES)
+        player.temp_boosts[boost_type] = (value, now + rng.randint(60, 3600))
+    player.max_health = player._calculate_max_health()
+    player.health = player.max_health
+    return player
+
+
+def make_world(main, players: int, seed: int = 42, group_id: str = "bench"):
+    """生成 players 名玩家的世界，返回 GameWorld"""
+    random.seed(seed)
+    if main.np is not None:
+        main._np_rng = main.np.random.default_rng(seed)
+    rng = random.Random(seed)
+    item_pool = [pill["name"] for pill in main.PILLS_DATA] + list(main.OTHER_DATA)
+    now = time.time()
+
+    world = main.GameWorld(group_id)
+    world.game_started = True
+    for i in range(players):
+        player = make_player(main, rng, i, item_pool, now)
+        world.players[player.user_id] = player
+        if rng.random() < 0.2:
+            world.buy_lottery_tickets(player.user_id, max(1, min(500, int(rng.lognormvariate(1.5, 1.2)))))
+    world.generate_market_items()
+    world.last_market_refresh = now
+    return world
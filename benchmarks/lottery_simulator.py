@@ -0,0 +1,185 @@
+"""斗破彩派奖离线模拟器
+
+用插件真实的 GameWorld.buy_lottery_tickets / draw_lottery 连续开奖，模拟若干个独立“赛季”，
+每个赛季在一个进程中按顺序开奖（奖池逐期滚动），多个赛季由进程池并行。报告：
+
+  - 每注期望派奖与返奖率（派奖 / 售票金额）
+  - 奖池走势：各检查点上所有赛季奖池的 P5 / P50 / P95，以及最低、最高值
+  - 各奖级的每注中奖率与头奖（一等奖）出现的期数
+
+每期的购票量由 --volume 指定：
+  fixed:N              每期固定 N 注
+  uniform:A,B          每期在 [A, B] 中均匀取整
+  lognormal:MU,SIGMA   每期 round(exp(N(MU, SIGMA))) 注，模拟少数大额购买
+  whale:BASE,P,SIZE    每期 BASE 注，另有概率 P 出现一次 SIZE 注的大额购买
+
+可用 --price 和 --distribution（JSON，奖级 -> 比例）试验不同的票价与分配方案。
+
+用法：python benchmarks/lottery_simulator.py [--seasons 8] [--draws 5000] [--volume lognormal:6,1]
+结果以 JSON 输出到标准输出。
+"""
+import argparse
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from astrbot_stub import load_plugin
+
+main = load_plugin()
+
+
+def parse_volume(spec: str):
+    """把 --volume 解析为 (rng -> 每期注数) 的函数"""
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",")] if params else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: int(values[0])
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.randint(int(values[0]), int(values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: int(round(rng.lognormvariate(values[0], values[1])))
+    if kind == "whale" and len(values) == 3:
+        return lambda rng: int(values[0]) + (int(values[2]) if rng.random() < values[1] else 0)
+    raise ValueError(f"无法解析的购票量分布: {spec}")
+
+
+def run_season(season: int, seed: int, draws: int, volume: str, price: int,
+               distribution: dict, checkpoints: int) -> dict:
+    """在当前进程中连续开奖 draws 期，返回该赛季的统计"""
+    random.seed(seed)
+    if main.np is not None:
+        main._np_rng = main.np.random.default_rng(seed)
+    main.LOTTERY_TICKET_PRICE = price
+    if distribution:
+        main.LOTTERY_PRIZE_DISTRIBUTION = distribution
+    volume_of = parse_volume(volume)
+    rng = random.Random(seed ^ 0x5EED)
+
+    world = main.GameWorld(f"sim-{season}")
+    start_pool = world.lottery_pool
+    every = max(1, draws // checkpoints)
+    trajectory = []
+    tickets_sold = 0
+    total_payout = 0
+    jackpots = 0
+    tier_hits = {level: 0 for level in main.LOTTERY_PRIZE_LEVELS}
+    pool_min = pool_max = start_pool
+
+    for draw in range(1, draws + 1):
+        count = max(0, volume_of(rng))
+        if count:
+            world.buy_lottery_tickets("sim", count)
+            tickets_sold += count
+        result = world.draw_lottery()
+        world.lottery_archive_pending.clear()  # 模拟不写归档
+
+        total_payout += result["total_payout"]
+        for level, winners in result["winners"].items():
+            tier_hits[level] += len(winners)
+        if result["winners"]["一等奖"]:
+            jackpots += 1
+        pool_min = min(pool_min, world.lottery_pool)
+        pool_max = max(pool_max, world.lottery_pool)
+        if draw % every == 0:
+            trajectory.append(world.lottery_pool)
+
+    return {
+        "season": season,
+        "tickets_sold": tickets_sold,
+        "total_payout": total_payout,
+        "tier_hits": tier_hits,
+        "jackpot_draws": jackpots,
+        "start_pool": start_pool,
+        "end_pool": world.lottery_pool,
+        "pool_min": pool_min,
+        "pool_max": pool_max,
+        "trajectory": trajectory,
+        "checkpoint_every": every,
+    }
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    k = (len(ordered) - 1) * q
+    low, high = math.floor(k), math.ceil(k)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def summarise(seasons: list, price: int) -> dict:
+    tickets = sum(s["tickets_sold"] for s in seasons)
+    payout = sum(s["total_payout"] for s in seasons)
+    tier_hits = {level: sum(s["tier_hits"][level] for s in seasons) for level in main.LOTTERY_PRIZE_LEVELS}
+    points = min(len(s["trajectory"]) for s in seasons)
+    every = seasons[0]["checkpoint_every"]
+    trajectory = []
+    for i in range(points):
+        pools = [s["trajectory"][i] for s in seasons]
+        trajectory.append({
+            "draw": (i + 1) * every,
+            "p5": int(percentile(pools, 0.05)),
+            "p50": int(percentile(pools, 0.5)),
+            "p95": int(percentile(pools, 0.95)),
+        })
+    return {
+        "tickets_sold": tickets,
+        "payout_per_ticket": round(payout / tickets, 3) if tickets else None,
+        "return_to_player": round(payout / (tickets * price), 4) if tickets else None,
+        "tier_hit_rate": {level: (hits / tickets if tickets else 0) for level, hits in tier_hits.items()},
+        "jackpot_draws": sum(s["jackpot_draws"] for s in seasons),
+        "pool_min": min(s["pool_min"] for s in seasons),
+        "pool_max": max(s["pool_max"] for s in seasons),
+        "pool_end_p50": int(percentile([s["end_pool"] for s in seasons], 0.5)),
+        "pool_trajectory": trajectory,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seasons", type=int, default=8, help="独立赛季数（并行单位）")
+    parser.add_argument("--draws", type=int, default=5000, help="每个赛季的开奖期数")
+    parser.add_argument("--volume", default="lognormal:6,1", help="每期购票量分布，见模块说明")
+    parser.add_argument("--price", type=int, default=main.LOTTERY_TICKET_PRICE, help="每注价格")
+    parser.add_argument("--distribution", default="", help="奖池分配方案 JSON，如 '{\"一等奖\": 0.5, ...}'")
+    parser.add_argument("--checkpoints", type=int, default=20, help="奖池走势的采样点数")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="进程数")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    parse_volume(args.volume)  # 参数错误时在启动进程池之前报错
+    distribution = json.loads(args.distribution) if args.distribution else {}
+    missing = set(distribution) and set(main.LOTTERY_PRIZE_LEVELS) - set(distribution)
+    if missing:
+        parser.error(f"分配方案缺少奖级: {sorted(missing)}")
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [
+            pool.submit(run_season, season, args.seed + season, args.draws, args.volume,
+                        args.price, distribution, args.checkpoints)
+            for season in range(args.seasons)
+        ]
+        seasons = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps({
+        "config": {
+            "seasons": args.seasons,
+            "draws_per_season": args.draws,
+            "volume": args.volume,
+            "price": args.price,
+            "distribution": distribution or main.LOTTERY_PRIZE_DISTRIBUTION,
+            "numpy": main.np is not None,
+        },
+        "elapsed_s": round(elapsed, 2),
+        "draws_per_s": int(args.seasons * args.draws / elapsed),
+        "summary": summarise(seasons, args.price),
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,15 +1,40 @@
 import asyncio
+import base64
+import bisect
+import cProfile
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import math
+import multiprocessing
 import os
+import pstats
 import random
+import re
+import sys
+import threading
 import time
+import tracemalloc
+import types
+from array import array
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache, partial, wraps
 from pathlib import Path
-from typing import Dict, Optional, List, Any, Tuple
+from types import SimpleNamespace
+from typing import Dict, Optional, List, Any, Tuple, Callable, Awaitable
 from astrbot.api.event import filter, AstrMessageEvent, MessageChain
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 
+try:
+    import numpy as np
+    _np_rng = np.random.default_rng()
+except ImportError:  # NumPy 为可选依赖，缺失时走纯 Python 实现
+    np = None
+    _np_rng = None
+
 
 # ==================== 游戏常量定义 ====================
 # 探索等级定义
@@ -488,6 +513,106 @@ OTHER_DATA = [
     "混沌结晶"
 ]
 
+# 请求有效期（秒）
+DUEL_REQUEST_TTL = 60  # 对战请求1分钟内有效
+TRADE_REQUEST_TTL = 600  # 交易请求10分钟内有效
+REQUEST_SWEEP_INTERVAL = 60  # 后台清理过期请求的间隔
+
+DUNGEON_LOBBY_TTL = 1800  # 副本队伍组建后30分钟内未开始则自动解散
+DUNGEON_MATCH_TARGET_RATIO = 1.0  # 匹配组队的目标战力比（队伍战力/BOSS战力），单人胜率约93%、5人队伍约99%
+DUNGEON_MATCH_TEAM_SIZE = 5
+# 回合制副本战斗参数，按 队伍战力/BOSS战力 = 0.7 时胜率约45%、1.0 时九成以上 标定（人数越多胜率越集中）
+DUNGEON_MAX_ROUNDS = 12  # 副本战斗最多回合数，超时判负
+DUNGEON_BOSS_HP_FACTOR = 2.4  # BOSS生命 = BOSS战力 × 该系数
+DUNGEON_BOSS_ATTACK_FACTOR = 0.65  # BOSS每回合群体伤害 = BOSS战力 × 该系数
+DUNGEON_PLAYER_HP_FACTOR = 2.0  # 玩家战斗生命 = 战力 × 该系数
+DUNGEON_CRIT_RATE = 0.3  # 暴击率，暴击伤害翻倍
+DUNGEON_DAMAGE_SPREAD = 0.8  # 每次出手伤害在 ×(1±该值) 间浮动
+DUNGEON_DESPERATE_HP = 0.3  # 生命低于该比例时触发濒危加成
+DUNGEON_WIN_RATE_SAMPLES = 2000  # 副本预测中每个战力比分桶模拟的战斗次数
+DUNGEON_FORECAST_BUCKET = 0.05  # 副本预测按 队伍战力/BOSS战力 分桶缓存的桶宽
+DUNGEON_FORECAST_SAMPLES = 20000  # 副本预测每个桶的蒙特卡洛模拟次数（无 NumPy 时取 1/4）
+
+# 拍卖会出价后无人加价即快速成交的等待时间（秒）
+AUCTION_QUICK_WIN_SECONDS = 30
+AUCTION_INCREMENT_RATE = 0.05  # 代拍自动加价幅度：起拍价的5%
+
+# 对战叙事（LLM）在后台生成，结果作为后续消息发送
+NARRATION_WORKERS = 8  # 同时生成中的叙事上限（经 LLMBatcher 合批，提供者调用数更少）
+NARRATION_TIMEOUT = 20  # 叙事从提交到生成完毕的时限（秒，含排队），超时或出错时改用模板
+NARRATION_MAX_PENDING = 200  # 排队上限，队列已满时直接使用模板
+
+# LLM 调用保护：超时、熔断与缓存
+LLM_CALL_TIMEOUT = 15  # 单次提供者调用的超时（秒）
+LLM_BREAKER_FAILURES = 3  # 连续失败多少次后熔断
+LLM_BREAKER_COOLDOWN = 30  # 熔断后首次半开探测前的冷却时间（秒），探测失败则翻倍
+LLM_BREAKER_MAX_COOLDOWN = 600
+LLM_CACHE_SIZE = 512  # 缓存的提示词数量（LRU）
+LLM_CACHE_VARIANTS = 3  # 每个提示词攒够多少种不同结果后不再调用提供者
+
+# LLM 请求合批：同一系统提示词的请求在窗口内合并为一次调用
+LLM_BATCH_WINDOW = 0.3  # 合批等待窗口（秒）
+LLM_BATCH_MAX = 8  # 单批最多合并的请求数，攒满立即发送
+
+# 世界事件池：所有群共享，后台并发预生成，/dp_world 只从池中取用
+WORLD_EVENT_POOL_SIZE = 30  # 补充到的目标数量
+WORLD_EVENT_POOL_LOW = 10  # 低于该数量时触发后台补充
+WORLD_EVENT_REFILL_CONCURRENCY = LLM_BATCH_MAX  # 补充时每轮并发的生成请求数（经合批为一次 LLM 调用）
+WORLD_EVENT_RECENT = 500  # 记住最近发出的事件数，避免重复
+WORLD_EVENT_UPDATE_INTERVAL = 3600  # 每个群的世界动态刷新间隔（秒）
+
+# 多进程分片：DPCQ_SHARD_WORKERS=N（N>0）时按 group_id 哈希把世界分给 N 个工作进程，
+# 插件进程只负责转发命令与回复；未设置或为 0 时所有世界都在插件进程中运行
+SHARD_WORKERS = int(os.environ.get("DPCQ_SHARD_WORKERS", "0") or 0)
+SHARD_START_TIMEOUT = 60  # 等待工作进程加载完存档并就绪的时限（秒）
+SHARD_STOP_TIMEOUT = 10  # 关闭时等待工作进程保存并退出的时限（秒）
+# 作用于所有世界的管理命令，分片模式下广播给每个工作进程
+SHARD_BROADCAST_COMMANDS = {"clear_all_worlds", "cleanup_files"}
+
+# 运行统计：命令与存档耗时直方图，/dp_stats 查看，并定期写出 Prometheus 文本文件
+METRICS_SAMPLE_RATE = float(os.environ.get("DPCQ_METRICS_SAMPLE", "1") or 0)  # 采样比例，0 为关闭
+METRICS_DUMP_INTERVAL = 60  # 写出 Prometheus 文本文件的间隔（秒）
+METRICS_TEXTFILE = os.environ.get("DPCQ_METRICS_TEXTFILE", "")  # 留空则写到 dpcq_data/system/metrics.prom
+METRICS_PRECISION_BITS = 4  # 直方图每个 2 的幂区间分为 2^(4-1)=8 个子桶，相对误差不超过 12.5%
+METRICS_PROM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)  # 导出时合并成的 le 边界（秒）
+
+# 按需性能采集（/dp_profile）
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 20  # 回报给管理员的热点函数数
+PROFILE_KEEP = 10  # profiles 目录下保留的最近报告数
+
+# 世界内存占用估算（/dp_mem）
+MEMORY_SAMPLE_PLAYERS = 2000  # 玩家数超过该值时随机抽样估算，再按比例放大
+MEMORY_SCAN_CHUNK = 1000  # 每遍历这么多个对象（或粗排这么多名玩家）让出一次事件循环
+MEMORY_TOP_PLAYERS = 5  # 报告占用最大的玩家数
+
+# 定时任务
+JOB_BATCH_SIZE = 20  # 每轮最多执行的到期任务数，积压任务分批执行避免阻塞事件循环
+JOB_SAVE_DELAY = 5  # 任务表变化后延迟写盘的秒数，期间的多次变化合并为一次写入
+LOTTERY_DRAW_INTERVAL = 7200  # 斗破彩开奖间隔
+LOTTERY_TICKET_PRICE = 100  # 每注价格，全额计入奖池
+LOTTERY_POOL_FLOOR = 100000  # 奖池耗尽时的保底奖池
+LOTTERY_DRAW_BONUS = 1000  # 每期开奖后系统注入奖池的基础奖金
+# 各奖级分得的奖池比例，同一奖级的中奖者平分（提高中低奖项比例）
+LOTTERY_PRIZE_DISTRIBUTION = {
+    "一等奖": 0.4,  # 40% 奖池 - 头奖，占大头
+    "二等奖": 0.25,  # 25% 奖池 - 次大奖
+    "三等奖": 0.15,  # 15% 奖池 - 中等奖
+    "四等奖": 0.08,  # 8% 奖池 - 小奖，递减
+    "五等奖": 0.05,  # 5% 奖池
+    "六等奖": 0.03,  # 3% 奖池
+    "七等奖": 0.02,  # 2% 奖池
+    "八等奖": 0.015,  # 1.5% 奖池
+    "九等奖": 0.005  # 0.5% 奖池 - 安慰奖，比例最小
+}
+# 开奖时查找中奖彩票的方式："index" 用购买时建立的倒排索引只检查候选彩票；
+# "scan" 逐注判定。安装了 NumPy 时整批向量化扫描更快，否则使用倒排索引
+LOTTERY_WINNER_LOOKUP = "scan" if np is not None else "index"
+LOTTERY_MAX_BUY = 100000  # 单条消息最多购买的注数
+LOTTERY_BUY_CHUNK = 10000  # 批量购买时每生成这么多注让出一次事件循环，避免大额购买阻塞其他群
+LOTTERY_HISTORY_SIZE = 20  # 内存中保留的最近开奖期数，更早的记录只在归档文件中
+
 PILLS_DATA = [
     # ===== 修炼辅助类丹药 =====
     {
@@ -1034,12 +1159,615 @@ PILLS_DATA = [
     }
 ]
 
+# 丹药名称索引，避免每次查询都遍历 PILLS_DATA
+PILLS_BY_NAME = {pill["name"]: pill for pill in PILLS_DATA}
+
+# 丹药品阶数字
+PILL_RANK_LEVELS = {
+    "一品": 1, "二品": 2, "三品": 3, "四品": 4, "五品": 5,
+    "六品": 6, "七品": 7, "八品": 8, "九品": 9
+}
+
+# 批量出售时永远不会被卖掉的物品
+PROTECTED_ITEMS = {"混沌结晶", "混沌核心", "空间戒指"}
+
+# 批量出售的类型别名
+SELL_TYPE_ALIASES = {
+    "修炼": ("cultivation",), "突破": ("breakthrough",), "战斗": ("battle",),
+    "恢复": ("healing", "recovery"), "复活": ("revival",), "探索": ("exploration",),
+    "永久": ("permanent",), "升级": ("upgrade",), "功法": ("technique",), "杂物": ("misc",)
+}
+
+
+def get_sell_quote(item_name: str) -> Tuple[float, float, float]:
+    """获取物品出售报价 (基础价值, 最低倍率, 最高倍率)，单价在两个倍率之间均匀随机"""
+    if item_name in CULTIVATION_BOOST:
+        return CULTIVATION_BOOST[item_name].get('value', 0), 0.8, 1.1
+    pill = PILLS_BY_NAME.get(item_name)
+    if pill:
+        return pill.get('value', 0), 0.8, 1.2
+    # 其他杂项物品单价 50-200
+    return 1, 50, 200
+
+
+def roll_stack_price(unit_value: float, count: int, low: float, high: float) -> float:
+    """一次算出 count 个同名物品的随机售价总和（每个单价 = 基础价值 × U(low, high)）"""
+    if count <= 0:
+        return 0
+    if np is not None:
+        return float(unit_value * _np_rng.uniform(low, high, count).sum())
+    if count <= 32:
+        return unit_value * sum(random.uniform(low, high) for _ in range(count))
+    # 数量较大时按 Irwin–Hall 分布的正态近似一次抽样，期望与方差与逐个求和一致
+    mean = count * (low + high) / 2
+    std = (high - low) * math.sqrt(count / 12)
+    total = min(max(random.gauss(mean, std), count * low), count * high)
+    return unit_value * total
+
+
+# ==================== 斗破彩彩票编码 ====================
+# 每注彩票压缩为一个 64 位整数：主号码 n(1-35) 占第 n-1 位，特别号码 n(1-12)
+# 占第 40+n-1 位。特别号码从第 5 个字节开始，按字节切分即可分别统计两个区的命中数。
+LOTTERY_MAIN_MASK = (1 << 35) - 1
+LOTTERY_SPECIAL_SHIFT = 40
+LOTTERY_PRIZE_LEVELS = ["一等奖", "二等奖", "三等奖", "四等奖", "五等奖",
+                        "六等奖", "七等奖", "八等奖", "九等奖"]
+
+
+def _lottery_tier(main_match: int, special_match: int) -> int:
+    """按 (主号码命中数, 特别号码命中数) 判定奖级，返回 LOTTERY_PRIZE_LEVELS 的下标，未中奖返回 -1"""
+    if main_match == 5 and special_match == 2:
+        return 0
+    if main_match == 5 and special_match == 1:
+        return 1
+    if main_match == 5:
+        return 2
+    if main_match == 4 and special_match == 2:
+        return 3
+    if main_match == 4 and special_match == 1:
+        return 4
+    if (main_match == 3 and special_match == 2) or (main_match == 2 and special_match == 2):
+        return 5
+    if main_match == 4:
+        return 6
+    if (main_match == 3 and special_match == 1) or (main_match == 1 and special_match == 2):
+        return 7
+    if main_match == 3 or (main_match == 2 and special_match == 1) or (main_match == 0 and special_match == 2):
+        return 8
+    return -1
+
+
+# 奖级查找表，下标为 主号码命中数 * 3 + 特别号码命中数
+LOTTERY_TIER_TABLE = [_lottery_tier(m, sp) for m in range(6) for sp in range(3)]
+
+
+def encode_lottery_ticket(numbers: List[int]) -> int:
+    """[5个主号码] + [2个特别号码] -> 64 位掩码"""
+    mask = 0
+    for n in numbers[:5]:
+        mask |= 1 << (n - 1)
+    for n in numbers[5:]:
+        mask |= 1 << (LOTTERY_SPECIAL_SHIFT + n - 1)
+    return mask
+
+
+def decode_lottery_ticket(mask: int) -> List[int]:
+    """64 位掩码 -> 排好序的 [5个主号码] + [2个特别号码]"""
+    main_numbers = [n + 1 for n in range(35) if mask >> n & 1]
+    special_numbers = [n + 1 for n in range(12) if mask >> (LOTTERY_SPECIAL_SHIFT + n) & 1]
+    return main_numbers + special_numbers
+
+
+def classify_lottery_tickets(tickets: array, winning_mask: int) -> List[int]:
+    """逐注判定奖级，返回与 tickets 等长的奖级下标列表（-1 表示未中奖）
+
+    命中数由 (ticket & winning_mask) 的 popcount 得到；安装了 NumPy 时整批向量化计算。
+    """
+    if np is not None and len(tickets) > 64:
+        return _classify_lottery_tickets_np(np.frombuffer(tickets, dtype=np.uint64), winning_mask).tolist()
+    table = LOTTERY_TIER_TABLE
+    main_mask = LOTTERY_MAIN_MASK
+    shift = LOTTERY_SPECIAL_SHIFT
+    result = []
+    for ticket in tickets:
+        hit = ticket & winning_mask
+        result.append(table[(hit & main_mask).bit_count() * 3 + (hit >> shift).bit_count()])
+    return result
+
+
+def _classify_lottery_tickets_np(tickets, winning_mask: int):
+    """NumPy 版本：tickets 为 uint64 数组，返回 int8 奖级数组"""
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2.0 直接对 uint64 做 popcount
+        main_match = np.bitwise_count(tickets & np.uint64(winning_mask & LOTTERY_MAIN_MASK))
+        special_match = np.bitwise_count(tickets & np.uint64(winning_mask & ~LOTTERY_MAIN_MASK))
+    else:
+        # 按字节查表：小端序下前 5 个字节为主号码区，第 6、7 个字节为特别号码区
+        hits = (tickets & np.uint64(winning_mask)).astype("<u8", copy=False).view(np.uint8).reshape(-1, 8)
+        bits = _NP_POPCOUNT8[hits]
+        main_match = bits[:, :5].sum(axis=1, dtype=np.uint8)
+        special_match = bits[:, 5:7].sum(axis=1, dtype=np.uint8)
+    return _NP_TIER_TABLE[main_match * 3 + special_match]
+
+
+@lru_cache(maxsize=None)
+def _lottery_combination_masks() -> Tuple[array, array]:
+    """全部 C(35,5) 个主号码组合与 C(12,2) 个特别号码组合的掩码表（首次使用时生成）"""
+    main_masks = array("Q", (sum(1 << (n - 1) for n in combo)
+                             for combo in itertools.combinations(range(1, 36), 5)))
+    special_masks = array("Q", (sum(1 << (LOTTERY_SPECIAL_SHIFT + n - 1) for n in combo)
+                                for combo in itertools.combinations(range(1, 13), 2)))
+    return main_masks, special_masks
+
+
+def generate_lottery_tickets(count: int, aggregate: bool = False):
+    """一次生成 count 注随机彩票
+
+    在 C(35,5)×C(12,2) 个组合中均匀抽样：分别抽取主号码组合和特别号码组合的下标，
+    查表后按位或得到掩码，与逐注 random.sample 的分布相同。
+    aggregate=True 时把重复的组合合并为 {掩码: 注数}，否则返回 array('Q')。
+    """
+    main_masks, special_masks = _lottery_combination_masks()
+    if np is not None and count > 64:
+        main_table = np.frombuffer(main_masks, dtype=np.uint64)
+        special_table = np.frombuffer(special_masks, dtype=np.uint64)
+        masks = (main_table[_np_rng.integers(0, len(main_table), count)]
+                 | special_table[_np_rng.integers(0, len(special_table), count)])
+        if aggregate:
+            unique, counts = np.unique(masks, return_counts=True)
+            return dict(zip(unique.tolist(), counts.tolist()))
+        return array("Q", masks.tobytes())
+    tickets = array("Q", map(int.__or__, random.choices(main_masks, k=count),
+                             random.choices(special_masks, k=count)))
+    return Counter(tickets) if aggregate else tickets
+
+
+def match_lottery_tickets(tickets_by_user: Dict[str, array],
+                          winning_mask: int) -> Dict[str, List[Tuple[str, int]]]:
+    """对所有玩家的彩票开奖，返回 {奖级: [(user_id, 彩票掩码)]}"""
+    winners = {level: [] for level in LOTTERY_PRIZE_LEVELS}
+    buckets = [winners[level] for level in LOTTERY_PRIZE_LEVELS]
+    if np is not None and sum(map(len, tickets_by_user.values())) > 64:
+        # 所有彩票拼成一个数组整体判定，只对中奖的彩票回到 Python 层
+        user_ids = [uid for uid, tickets in tickets_by_user.items() if tickets]
+        arrays = [np.frombuffer(tickets_by_user[uid], dtype=np.uint64) for uid in user_ids]
+        all_tickets = np.concatenate(arrays)
+        tiers = _classify_lottery_tickets_np(all_tickets, winning_mask)
+        won = np.flatnonzero(tiers >= 0)
+        starts = np.cumsum([0] + [len(a) for a in arrays[:-1]])
+        owners = np.array(user_ids, dtype=object)[np.searchsorted(starts, won, side="right") - 1]
+        won_tiers = tiers[won]
+        won_tickets = all_tickets[won]
+        for tier, bucket in enumerate(buckets):
+            selected = won_tiers == tier
+            bucket.extend(zip(owners[selected].tolist(), won_tickets[selected].tolist()))
+        return winners
+
+    for user_id, tickets in tickets_by_user.items():
+        for ticket, tier in zip(tickets, classify_lottery_tickets(tickets, winning_mask)):
+            if tier >= 0:
+                buckets[tier].append((user_id, ticket))
+    return winners
+
+
+def pack_lottery_tickets(tickets: array) -> str:
+    """彩票数组 -> base64 字符串（按小端序存盘）"""
+    if sys.byteorder != "little":
+        tickets = array("Q", tickets)
+        tickets.byteswap()
+    return base64.b64encode(tickets.tobytes()).decode("ascii")
+
+
+def unpack_lottery_tickets(data) -> array:
+    """存档数据 -> 彩票数组；兼容旧存档中的号码列表"""
+    tickets = array("Q")
+    if isinstance(data, str):
+        tickets.frombytes(base64.b64decode(data))
+        if sys.byteorder != "little":
+            tickets.byteswap()
+    else:
+        tickets.extend(encode_lottery_ticket(numbers) for numbers in data)
+    return tickets
+
+
+if np is not None:
+    _NP_TIER_TABLE = np.array(LOTTERY_TIER_TABLE, dtype=np.int8)
+    _NP_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+# ==================== 运行统计 ====================
+# 不计入世界占用的对象：类型、函数、模块等由整个进程共享
+_MEMORY_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                      types.MethodType, asyncio.AbstractEventLoop)
+_MEMORY_LEAF_TYPES = (str, bytes, int, float, bool, type(None), array)
+
+
+def _iter_sizes(obj: Any, seen: set):
+    """逐个产出 obj 及其引用的、不在 seen 中的对象的 sys.getsizeof"""
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, _MEMORY_SKIP_TYPES):
+            continue
+        seen.add(id(item))
+        yield sys.getsizeof(item)
+        if isinstance(item, _MEMORY_LEAF_TYPES):
+            continue
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        else:
+            if hasattr(item, "__dict__"):
+                stack.append(item.__dict__)
+            for cls in type(item).__mro__:
+                for slot in getattr(cls, "__slots__", ()):
+                    if hasattr(item, slot):
+                        stack.append(getattr(item, slot))
+
+
+def deep_sizeof(obj: Any, seen: set) -> int:
+    """对象及其引用的全部对象的 sys.getsizeof 之和；seen 中的对象不重复计算"""
+    return sum(_iter_sizes(obj, seen))
+
+
+class MemoryScan:
+    """一次世界内存扫描的共享状态：已计入的对象，以及每遍历 MEMORY_SCAN_CHUNK 个对象让出事件循环"""
+
+    def __init__(self, *seen: Any):
+        self.seen = {id(obj) for obj in seen}
+        self.walked = 0
+
+    async def sizeof(self, obj: Any) -> int:
+        size = 0
+        for item_size in _iter_sizes(obj, self.seen):
+            size += item_size
+            self.walked += 1
+            if self.walked % MEMORY_SCAN_CHUNK == 0:
+                await asyncio.sleep(0)
+        return size
+
+
+# 世界内存报告的分类：(名称, 属性)，其余属性计入“其他”
+WORLD_MEMORY_FIELDS = (
+    ("彩票", ("lottery_tickets", "lottery_index")),
+    ("开奖记录", ("lottery_history", "lottery_archive_pending")),
+    ("交易请求", ("trade_requests",)),
+    ("对战请求", ("duel_requests",)),
+    ("拍卖", ("auction_items", "auction_bids")),
+    ("挂单簿", ("order_books",)),
+    ("副本", ("dungeons",)),
+)
+
+
+async def measure_world_memory(world: "GameWorld", jobs: List[Dict[str, Any]] = ()) -> Dict[str, Any]:
+    """估算一个世界的内存占用，按类别拆分，并找出占用最大的玩家
+
+    玩家数超过 MEMORY_SAMPLE_PLAYERS 时随机抽样测量后按比例放大。占用最大的玩家先按
+    背包件数、临时加成数和彩票注数粗排（全量，开销很小），再精确测量前几名。扫描分批
+    让出事件循环，期间世界可能被修改，结果是近似值。
+    """
+    scan = MemoryScan(world, world.players)  # 玩家字典只计自身，其中的玩家按抽样测量
+    categories = Counter()
+    players = list(world.players.values())
+    sampled = players if len(players) <= MEMORY_SAMPLE_PLAYERS else random.sample(players, MEMORY_SAMPLE_PLAYERS)
+    scale = len(players) / len(sampled) if sampled else 0.0
+
+    for player in sampled:
+        categories["背包"] += await scan.sizeof(player.inventory) + await scan.sizeof(player.zb)
+        categories["临时加成"] += await scan.sizeof(player.temp_boosts)
+        categories["玩家"] += await scan.sizeof(player)
+    for name in ("背包", "临时加成", "玩家"):
+        categories[name] = int(categories[name] * scale)
+    categories["玩家"] += sys.getsizeof(world.players)
+
+    tickets = world.lottery_tickets
+    for name, fields in WORLD_MEMORY_FIELDS:
+        for field in fields:
+            categories[name] += await scan.sizeof(getattr(world, field))
+    categories["其他"] = await scan.sizeof(world.__dict__)
+    categories["定时任务"] = deep_sizeof(list(jobs), set())
+
+    # 占用最大的玩家：全量粗排后精确测量
+    candidates = []  # 小顶堆 (粗排权重, 序号, 玩家)，保留权重最大的几名
+    for i, player in enumerate(players, 1):
+        held = tickets.get(player.user_id)
+        weight = (len(player.inventory) + len(player.zb) + len(player.temp_boosts) +
+                  (len(held) if held is not None else 0))
+        if len(candidates) < MEMORY_TOP_PLAYERS * 2:
+            heapq.heappush(candidates, (weight, i, player))
+        elif weight > candidates[0][0]:
+            heapq.heapreplace(candidates, (weight, i, player))
+        if i % MEMORY_SCAN_CHUNK == 0:
+            await asyncio.sleep(0)
+    largest = []
+    for _, _, player in candidates:
+        held = tickets.get(player.user_id)
+        largest.append((deep_sizeof(player, set()) + (sys.getsizeof(held) if held is not None else 0), player))
+    largest.sort(key=lambda item: item[0], reverse=True)
+
+    return {
+        "group_id": world.group_id,
+        "players": len(players),
+        "sampled": len(sampled),
+        "categories": categories,
+        "total": sum(categories.values()),
+        "jobs": len(jobs),
+        "largest": largest[:MEMORY_TOP_PLAYERS],
+    }
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.2f}GB"
+
+
+class LatencyStats:
+    """一组调用的次数、错误数与 HDR 风格的对数-线性延迟直方图
+
+    耗时按微秒取整后保留最高 METRICS_PRECISION_BITS 位，以桶的上界（微秒）为键计数，
+    因此桶宽随数值增长，任意量级的相对误差都相同。
+    """
+
+    __slots__ = ("count", "errors", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets: Counter = Counter()
+
+    def record(self, seconds: float, failed: bool = False) -> None:
+        self.count += 1
+        self.errors += failed
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        us = int(seconds * 1_000_000)
+        shift = us.bit_length() - METRICS_PRECISION_BITS
+        self.buckets[us + 1 if shift <= 0 else ((us >> shift) + 1) << shift] += 1
+
+    def quantile(self, q: float) -> float:
+        """近似分位数（秒），取所在桶的上界"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for upper in sorted(self.buckets):
+            seen += self.buckets[upper]
+            if seen >= rank:
+                return min(upper / 1_000_000, self.max)
+        return self.max
+
+    def cumulative(self, bounds) -> List[int]:
+        """各 le 边界（秒）下的累计次数，供 Prometheus 直方图导出"""
+        ordered = sorted(self.buckets.items())
+        counts, seen, i = [], 0, 0
+        for bound in bounds:
+            while i < len(ordered) and ordered[i][0] <= bound * 1_000_000:
+                seen += ordered[i][1]
+                i += 1
+            counts.append(seen)
+        return counts
+
+
+class Metrics:
+    """插件的运行统计：按命令、按世界、按存档操作分别累计 LatencyStats
+
+    sample_rate 为 0 时完全关闭，处理函数只多一次 sampled() 判断；介于 0 和 1 之间时按比例
+    随机采样，显示的次数是采样到的次数。
+    """
+
+    def __init__(self, sample_rate: float = METRICS_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def reset(self) -> None:
+        self.since = time.time()
+        self.commands: Dict[str, LatencyStats] = {}
+        self.worlds: Dict[str, LatencyStats] = {}
+        self.persistence: Dict[str, LatencyStats] = {}
+
+    def sampled(self) -> bool:
+        rate = self.sample_rate
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    @staticmethod
+    def _stats(table: Dict[str, LatencyStats], key: str) -> LatencyStats:
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = LatencyStats()
+        return stats
+
+    def record_command(self, name: str, group_id: str, seconds: float, failed: bool) -> None:
+        self._stats(self.commands, name).record(seconds, failed)
+        self._stats(self.worlds, group_id).record(seconds, failed)
+
+    def record_persistence(self, op: str, seconds: float, failed: bool) -> None:
+        self._stats(self.persistence, op).record(seconds, failed)
+
+    async def timed(self, name: str, group_id: str, results):
+        """逐条转交处理函数的结果，只累计处理函数自身的执行时间（不含调用方处理各条回复的时间）"""
+        elapsed = 0.0
+        failed = True
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    result = await results.__anext__()
+                except StopAsyncIteration:
+                    failed = False
+                    break
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield result
+        finally:
+            self.record_command(name, group_id, elapsed, failed)
+
+    def to_prometheus(self, labels: Dict[str, str] = None) -> str:
+        """Prometheus 文本格式；命令与存档操作导出直方图，世界只导出计数与总耗时以控制序列数"""
+        base = "".join(f'{k}="{_prom_escape(v)}",' for k, v in (labels or {}).items())
+        lines = [
+            "# HELP dpcq_metrics_sample_rate 命令与存档耗时的采样比例",
+            "# TYPE dpcq_metrics_sample_rate gauge",
+            f"dpcq_metrics_sample_rate{{{base.rstrip(',')}}} {self.sample_rate:g}" if base
+            else f"dpcq_metrics_sample_rate {self.sample_rate:g}",
+        ]
+        for metric, label, table in (("dpcq_command", "command", self.commands),
+                                     ("dpcq_persistence", "op", self.persistence)):
+            lines += [f"# HELP {metric}_seconds 耗时（秒）", f"# TYPE {metric}_seconds histogram",
+                      f"# HELP {metric}_errors_total 失败次数", f"# TYPE {metric}_errors_total counter"]
+            for key, stats in sorted(table.items()):
+                prefix = f'{base}{label}="{_prom_escape(key)}"'
+                for bound, count in zip(METRICS_PROM_BUCKETS, stats.cumulative(METRICS_PROM_BUCKETS)):
+                    lines.append(f'{metric}_seconds_bucket{{{prefix},le="{bound:g}"}} {count}')
+                lines += [
+                    f'{metric}_seconds_bucket{{{prefix},le="+Inf"}} {stats.count}',
+                    f"{metric}_seconds_sum{{{prefix}}} {stats.total:.6f}",
+                    f"{metric}_seconds_count{{{prefix}}} {stats.count}",
+                    f"{metric}_errors_total{{{prefix}}} {stats.errors}",
+                ]
+        lines += ["# HELP dpcq_world_commands_total 各世界执行的命令数", "# TYPE dpcq_world_commands_total counter",
+                  "# HELP dpcq_world_command_seconds_total 各世界命令累计耗时（秒）",
+                  "# TYPE dpcq_world_command_seconds_total counter"]
+        for group_id, stats in sorted(self.worlds.items()):
+            prefix = f'{base}group="{_prom_escape(group_id)}"'
+            lines += [f"dpcq_world_commands_total{{{prefix}}} {stats.count}",
+                      f"dpcq_world_command_seconds_total{{{prefix}}} {stats.total:.6f}"]
+        return "\n".join(lines) + "\n"
+
+
+def _prom_escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def persistence_timed(op: str):
+    """DataPersistence 方法装饰器：设置了 metrics 且被采样时记录耗时"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None or not metrics.sampled():
+                return func(self, *args, **kwargs)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = func(self, *args, **kwargs)
+                failed = False
+                return result
+            finally:
+                metrics.record_persistence(op, time.perf_counter() - started, failed)
+        return wrapper
+    return decorator
+
+
+class ProfileSession:
+    """一次按需性能采集：cProfile 记录事件循环线程中运行的全部代码，可选同时开启 tracemalloc
+
+    报告只列出本插件文件中的函数（处理函数、后台任务及其调用的游戏逻辑），完整数据
+    另存为 pstats 文件。
+    """
+
+    def __init__(self, memory: bool = False):
+        self.memory = memory
+        self.profiler = cProfile.Profile()
+        self._own_tracemalloc = False
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    def start(self) -> None:
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracemalloc = True
+        try:
+            self.profiler.enable()  # 同一线程已有其他分析器时会失败
+        except Exception:
+            if self._own_tracemalloc:
+                tracemalloc.stop()
+            raise
+        self.started = time.perf_counter()
+
+    def stop(self) -> None:
+        """结束采集；可重复调用"""
+        if self.started and not self.elapsed:
+            self.profiler.disable()
+            self.elapsed = time.perf_counter() - self.started
+            self.snapshot = tracemalloc.take_snapshot() if self.memory and tracemalloc.is_tracing() else None
+            self.traced = tracemalloc.get_traced_memory() if self.snapshot is not None else (0, 0)
+            if self._own_tracemalloc:
+                tracemalloc.stop()
+
+    def report(self, directory: Path, tag: str) -> str:
+        """写出 pstats 与完整文本报告，返回发给管理员的摘要"""
+        os.makedirs(directory, exist_ok=True)
+        stats_path = directory / f"{tag}.pstats"
+        text_path = directory / f"{tag}.txt"
+        self.profiler.dump_stats(str(stats_path))
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(re.escape(__file__), 100)
+        stats.sort_stats("tottime").print_stats(50)
+
+        entries = stats.stats
+        total = sum(tt for _, _, tt, _, _ in entries.values())
+        # 装饰器包装层（world_serialized、persistence_timed、Metrics.timed）的耗时已计入被包装的函数
+        own = [(func, value) for func, value in entries.items()
+               if func[0] == __file__ and func[2] not in ("wrapper", "timed")]
+        own_total = sum(tt for _, (_, _, tt, _, _) in own)
+        own.sort(key=lambda item: item[1][3], reverse=True)
+
+        lines = [
+            f"=== 性能采集结果（{self.elapsed:.0f} 秒）===",
+            f"共记录 {total * 1000:.1f}ms（含事件循环空闲等待），其中插件代码自身 {own_total * 1000:.1f}ms",
+            f"【热点函数】按累计耗时（前 {PROFILE_TOP}）",
+        ]
+        for i, ((_, line, name), (_, calls, tt, ct, _)) in enumerate(own[:PROFILE_TOP], 1):
+            lines.append(f"{i}. {name}:{line} 调用{calls}次 累计{ct * 1000:.1f}ms 自身{tt * 1000:.1f}ms")
+        if not own:
+            lines.append("采集期间插件代码没有运行")
+
+        if self.snapshot is not None:
+            current, peak = self.traced
+            top = self.snapshot.filter_traces([tracemalloc.Filter(True, __file__)]).statistics("lineno")[:10]
+            lines.append(f"【内存】采集期间新分配仍存活 {current / 1024:.0f}KB，峰值 {peak / 1024:.0f}KB；插件代码前 10 处：")
+            lines.extend(f"main.py:{stat.traceback[0].lineno} {stat.size / 1024:.1f}KB {stat.count}个"
+                         for stat in top)
+            stream.write("\n\n=== tracemalloc ===\n")
+            stream.writelines(f"{stat}\n" for stat in self.snapshot.statistics("lineno")[:50])
+
+        with open(text_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n\n" + stream.getvalue())
+        for old in sorted(directory.glob("*.pstats"))[:-PROFILE_KEEP]:
+            old.unlink(missing_ok=True)
+            old.with_suffix(".txt").unlink(missing_ok=True)
+        lines.append(f"完整报告: {text_path}\npstats: {stats_path}")
+        return "\n".join(lines)
+
+
+
 class DataPersistence:
-    def __init__(self, storage_dir: str = "dpcq_data"):
+    def __init__(self, storage_dir: str = "dpcq_data", shard: Optional[Tuple[int, int]] = None):
         # 获取当前文件所在的目录
         self.storage_dir = Path(storage_dir)
         os.makedirs(self.storage_dir, exist_ok=True)
+        # 分片工作进程 (序号, 分片数)：只加载自己的世界，插件级状态按分片分文件
+        self.shard = shard
+        self.metrics: Optional[Metrics] = None  # 由插件设置，记录各操作耗时
+
+    def owns(self, group_id: str) -> bool:
+        return self.shard is None or shard_of(group_id, self.shard[1]) == self.shard[0]
 
+    def _system_path(self, name: str) -> Path:
+        if self.shard is not None:
+            name = f"{name}-shard{self.shard[0]}"
+        return self.storage_dir / "system" / f"{name}.json"
+
+    @persistence_timed("save_world")
     def save_world(self, group_id: str, data: Dict[str, Any]):
         file_path = self.storage_dir / f"{group_id}.json"
         backup_path = self.storage_dir / f"{group_id}.json.bak"
@@ -1051,6 +1779,7 @@ class DataPersistence:
         with open(file_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
 
+    @persistence_timed("load_world")
     def load_world(self, group_id: str) -> Optional[Dict[str, Any]]:
         file_path = self.storage_dir / f"{group_id}.json"
         logger.info(f"从 {file_path} 加载数据")
@@ -1062,14 +1791,67 @@ class DataPersistence:
         except:
             return None
 
+    @persistence_timed("delete_world")
     def delete_world(self, group_id: str):
         file_path = self.storage_dir / f"{group_id}.json"
         if file_path.exists():
             os.remove(file_path)
+        archive_path = self.lottery_archive_path(group_id)
+        if archive_path.exists():
+            os.remove(archive_path)
+
+    def lottery_archive_path(self, group_id: str) -> Path:
+        """开奖记录归档文件（存放在 archive 子目录，不会被当作世界存档）"""
+        return self.storage_dir / "archive" / f"{group_id}_lottery.jsonl"
+
+    @persistence_timed("append_lottery_archive")
+    def append_lottery_archive(self, group_id: str, records: List[Dict[str, Any]]):
+        """把开奖记录追加到归档文件，每期一行"""
+        file_path = self.lottery_archive_path(group_id)
+        os.makedirs(file_path.parent, exist_ok=True)
+        with open(file_path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+    @persistence_timed("save_system_file")
+    def save_system_file(self, name: str, data: Any):
+        """保存插件级状态（存放在 system 子目录，不会被当作世界存档），先写临时文件再替换"""
+        file_path = self._system_path(name)
+        os.makedirs(file_path.parent, exist_ok=True)
+        tmp_path = file_path.with_suffix(".json.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
+
+    @persistence_timed("load_system_file")
+    def load_system_file(self, name: str, default: Any) -> Any:
+        file_path = self._system_path(name)
+        if not file_path.exists():
+            return default
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"加载 system/{file_path.name} 失败: {e}")
+            return default
 
+    def save_jobs(self, jobs: List[Dict[str, Any]]):
+        """保存定时任务表"""
+        self.save_system_file("jobs", jobs)
 
-    def list_saved_worlds(self) -> List[str]:
-        return [f.stem for f in self.storage_dir.glob("*.json")]
+    def load_jobs(self) -> List[Dict[str, Any]]:
+        return self.load_system_file("jobs", [])
+
+    def save_world_events(self, data: Dict[str, Any]):
+        """保存预生成的世界事件池"""
+        self.save_system_file("world_events", data)
+
+    def load_world_events(self) -> Dict[str, Any]:
+        return self.load_system_file("world_events", {})
+
+    def list_saved_worlds(self, owned_only: bool = False) -> List[str]:
+        """所有世界存档；owned_only 时只返回本分片负责的世界"""
+        return [f.stem for f in self.storage_dir.glob("*.json") if not owned_only or self.owns(f.stem)]
 
     def get_world_info(self, group_id: str) -> Optional[Dict[str, Any]]:
         data = self.load_world(group_id)
@@ -1081,6 +1863,86 @@ class DataPersistence:
             "game_started": data.get("game_started", False)
         }
 
+class LotteryArchive:
+    """开奖记录归档文件的只读视图
+
+    归档为只追加的 JSONL 文件，每行一期。分页从文件末尾按块倒序读取，统计逐行流式累加，
+    都不会把整个文件载入内存。
+    """
+
+    def __init__(self, path: Path, block_size: int = 1 << 16):
+        self.path = Path(path)
+        self.block_size = block_size
+
+    def count(self) -> int:
+        """归档中的期数"""
+        if not self.path.exists():
+            return 0
+        total = 0
+        with open(self.path, 'rb') as f:
+            while chunk := f.read(self.block_size):
+                total += chunk.count(b"\n")
+        return total
+
+    def _iter_lines_reversed(self):
+        """从文件末尾开始逐行倒序产出（最新一期在前）"""
+        if not self.path.exists():
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            tail = b""
+            while position > 0:
+                step = min(self.block_size, position)
+                position -= step
+                f.seek(position)
+                lines = (f.read(step) + tail).split(b"\n")
+                tail = lines.pop(0)  # 可能是被块边界截断的行，留到下一块拼接
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+            if tail.strip():
+                yield tail
+
+    def _iter_records(self):
+        if not self.path.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def page(self, page: int = 1, page_size: int = 5) -> List[Dict[str, Any]]:
+        """第 page 页（从 1 开始，最新的在前）"""
+        start = (page - 1) * page_size
+        lines = itertools.islice(self._iter_lines_reversed(), start, start + page_size)
+        return [json.loads(line) for line in lines]
+
+    def stats(self) -> Dict[str, Any]:
+        """全部归档的统计：期数、派奖总额、各号码开出次数、各奖级中奖注数"""
+        main_hits = [0] * 36  # 下标即号码，0 不使用
+        special_hits = [0] * 13
+        tier_winners = {level: 0 for level in LOTTERY_PRIZE_LEVELS}
+        draws = 0
+        total_payout = 0
+        for record in self._iter_records():
+            draws += 1
+            total_payout += record.get("total_payout", 0)
+            for n in record["numbers"][:5]:
+                main_hits[n] += 1
+            for n in record["numbers"][5:]:
+                special_hits[n] += 1
+            for level, count in record.get("winners", {}).items():
+                tier_winners[level] = tier_winners.get(level, 0) + count
+        return {
+            "draws": draws,
+            "total_payout": total_payout,
+            "main_hits": {n: main_hits[n] for n in range(1, 36)},
+            "special_hits": {n: special_hits[n] for n in range(1, 13)},
+            "tier_winners": tier_winners,
+        }
+
+
 class Player:
     def __init__(self, user_id: str, user_name: str, realm_index=0):
         self.user_id = user_id
@@ -1160,6 +2022,21 @@ class Player:
 
     @property
     def power(self):
+        """战力：基础战力 × 临时战斗加成"""
+        # 临时加成
+        temp_multiplier = 1.0
+        now = time.time()
+        for boost_type, (value, expire) in self.temp_boosts.items():
+            if now < expire:
+                if boost_type in ("battle_all","battle_desperate","battle_invincible"):
+                    temp_multiplier *= (1 + value / 10)
+                if boost_type in ("battle_strength","battle_defense"):
+                    temp_multiplier *= (1 + value / 10 / 4)
+        return self.base_power * temp_multiplier
+
+    @property
+    def base_power(self):
+        """不含临时加成的战力（境界、功法、主宰加成）"""
         base_power = 0
 
         # 境界基础灵气加成
@@ -1174,21 +2051,39 @@ class Player:
                 cultivation_multiplier *= (1+boost_value)
         base_power *= cultivation_multiplier
 
-        # 临时加成
-        temp_multiplier = 1.0
-        now = time.time()
-        for boost_type, (value, expire) in self.temp_boosts.items():
-            if now < expire:
-                if boost_type in ("battle_all","battle_desperate","battle_invincible"):
-                    temp_multiplier *= (1 + value / 10)
-                if boost_type in ("battle_strength","battle_defense"):
-                    temp_multiplier *= (1 + value / 10 / 4)
-
-        base_power *= temp_multiplier
         if self.is_supreme_ruler:
             base_power *= 1.3
         return base_power
 
+    def battle_modifiers(self, now: float = None) -> Tuple[float, float, float]:
+        """副本战斗中生效的丹药加成：(攻击倍率, 防御倍率, 濒危时攻击倍率)"""
+        now = time.time() if now is None else now
+        attack = defense = desperate = 1.0
+        for boost_type, (value, expire) in self.temp_boosts.items():
+            if now >= expire:
+                continue
+            if boost_type == "battle_all":
+                attack *= 1 + value
+                defense *= 1 + value
+            elif boost_type == "battle_strength":
+                attack *= 1 + value
+            elif boost_type == "battle_defense":
+                defense *= 1 + value
+            elif boost_type == "battle_invincible":
+                attack *= 1 + value * 0.8
+            elif boost_type == "battle_desperate":
+                desperate *= 1 + value
+        return attack, defense, desperate
+
+    def battle_power(self, now: float = None) -> float:
+        """副本战斗中的等效战力：base_power × √(攻击倍率 × 防御倍率)
+
+        simulate_dungeon_battle 中每回合伤害与攻击成正比、存活回合数与总生命和防御成正比，
+        胜负取决于 战力² × 攻击 × 防御，因此预测分桶和匹配按这一战力计算。
+        """
+        attack, defense, _ = self.battle_modifiers(now)
+        return self.base_power * math.sqrt(attack * defense)
+
     def can_train(self):
         return time.time() - self.last_train_time > self.cooldowns["train"]
 
@@ -1282,6 +2177,89 @@ class Player:
             return True
         return False
 
+    @property
+    def free_slots(self) -> int:
+        """背包剩余格数（每个空间戒指扩容10格）"""
+        capacity = 200 + sum(10 for item in self.inventory if "空间戒指" in item)
+        return max(0, capacity - len(self.inventory))
+
+    def add_items(self, item_name: str, quantity: int) -> int:
+        """批量放入同名物品，返回实际放入的数量（受背包容量限制）"""
+        count = min(quantity, self.free_slots)
+        if count > 0:
+            self.inventory.extend([item_name] * count)
+        return count
+
+    def add_item_counts(self, counts: Dict[str, int]) -> Dict[str, int]:
+        """一次性放入多种物品 {物品名: 数量}，按顺序受背包容量限制，返回实际放入的数量"""
+        free = self.free_slots
+        added = {}
+        batch = []
+        for item_name, quantity in counts.items():
+            count = min(quantity, free)
+            if count <= 0:
+                continue
+            batch.extend([item_name] * count)
+            added[item_name] = count
+            free -= count
+        self.inventory.extend(batch)
+        return added
+
+    def remove_items(self, item_name: str, quantity: int) -> bool:
+        """批量移除同名物品，一次遍历完成；数量不足时不做任何修改"""
+        if quantity <= 0:
+            return True
+        if self.inventory.count(item_name) < quantity:
+            return False
+        kept = []
+        remaining = quantity
+        for item in self.inventory:
+            if remaining and item == item_name:
+                remaining -= 1
+                continue
+            kept.append(item)
+        self.inventory = kept
+        return True
+
+    def bulk_sell(self, max_rank: int = None, item_types: Tuple[str, ...] = None,
+                  keep: int = 0) -> List[Tuple[str, int, int]]:
+        """按条件批量出售背包物品，返回 [(物品名, 出售数量, 获得金币)]
+
+        先一次遍历把背包合并成 {物品: 数量}，每种物品只查一次报价并按整堆
+        抽取随机售价，最后再一次遍历重建背包。装备栏中的物品不在背包里，
+        PROTECTED_ITEMS 中的物品永远不会被出售。
+        """
+        stacks: Dict[str, int] = {}
+        for item in self.inventory:
+            stacks[item] = stacks.get(item, 0) + 1
+
+        to_sell: Dict[str, int] = {}
+        results = []
+        for name, count in stacks.items():
+            if name in PROTECTED_ITEMS or count <= keep:
+                continue
+            pill = PILLS_BY_NAME.get(name)
+            if max_rank is not None and (not pill or PILL_RANK_LEVELS.get(pill["rank"], 10) > max_rank):
+                continue
+            if item_types is not None:
+                kind = pill["type"] if pill else ("technique" if name in CULTIVATION_BOOST else "misc")
+                if kind not in item_types:
+                    continue
+            to_sell[name] = count - keep
+            unit_value, low, high = get_sell_quote(name)
+            results.append((name, count - keep, int(roll_stack_price(unit_value, count - keep, low, high))))
+
+        if to_sell:
+            kept = []
+            for item in self.inventory:
+                if to_sell.get(item):
+                    to_sell[item] -= 1
+                    continue
+                kept.append(item)
+            self.inventory = kept
+            self.add_gold(sum(gold for _, _, gold in results))
+        return results
+
     def lose_item(self):
         if self.inventory:
             item_priority = {
@@ -1664,6 +2642,833 @@ class Player:
 
 
 
+class TimerWheel:
+    """按键管理截止时间的计时器
+
+    每个键只有一个有效截止时间，重新 schedule 即可推迟；旧的堆条目不删除，
+    在查看堆顶时惰性丢弃。一个协程只需睡到 next_deadline() 再取出 pop_due()
+    即可驱动任意数量的倒计时，不必为每个倒计时创建任务。
+    """
+
+    def __init__(self):
+        self._deadlines: Dict[Any, float] = {}
+        self._heap: List[Tuple[float, int, Any]] = []
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key) -> bool:
+        return key in self._deadlines
+
+    def schedule(self, key, deadline: float) -> None:
+        """设置（或推迟/提前）某个键的截止时间"""
+        self._deadlines[key] = deadline
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            # 频繁推迟会留下大量失效条目，超过一定比例时重建堆
+            self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key) -> None:
+        self._deadlines.pop(key, None)
+
+    def clear(self) -> None:
+        self._deadlines.clear()
+        self._heap.clear()
+
+    def deadline(self, key) -> Optional[float]:
+        return self._deadlines.get(key)
+
+    def next_deadline(self) -> Optional[float]:
+        """最早的有效截止时间，没有则返回 None"""
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: float, limit: int = None) -> List[Any]:
+        """取出已到期的键（最多 limit 个）"""
+        due = []
+        while limit is None or len(due) < limit:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                break
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+        return due
+
+
+class JobScheduler:
+    """持久化的定时任务表
+
+    每个任务由 (类型, 群号, 键) 唯一确定，记录截止时间、通知会话
+    (unified_msg_origin) 和附加数据。截止时间由一个 TimerWheel 管理，
+    重新 schedule 同一任务即可推迟或提前。任务表随插件保存到磁盘，
+    重启后重新载入，是插件所有定时工作的唯一来源。
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.clock = TimerWheel()
+
+    @staticmethod
+    def job_id(kind: str, group_id: str, key: str = "") -> str:
+        return f"{kind}:{group_id}:{key}"
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def schedule(self, kind: str, group_id: str, deadline: float, origin: str = "",
+                 key: str = "", payload: Dict[str, Any] = None) -> Dict[str, Any]:
+        """新建或改期任务；origin/payload 未给出时沿用已有任务的值"""
+        job_id = self.job_id(kind, group_id, key)
+        old = self.jobs.get(job_id, {})
+        job = {
+            "job_id": job_id,
+            "kind": kind,
+            "group_id": group_id,
+            "key": key,
+            "deadline": deadline,
+            "origin": origin or old.get("origin", ""),
+            "payload": payload if payload is not None else old.get("payload", {}),
+        }
+        self.jobs[job_id] = job
+        self.clock.schedule(job_id, deadline)
+        return job
+
+    def get(self, kind: str, group_id: str, key: str = "") -> Optional[Dict[str, Any]]:
+        return self.jobs.get(self.job_id(kind, group_id, key))
+
+    def cancel(self, kind: str, group_id: str, key: str = "") -> Optional[Dict[str, Any]]:
+        job_id = self.job_id(kind, group_id, key)
+        self.clock.cancel(job_id)
+        return self.jobs.pop(job_id, None)
+
+    def cancel_group(self, group_id: str) -> None:
+        """取消某个世界的全部任务"""
+        for job in [j for j in self.jobs.values() if j["group_id"] == group_id]:
+            self.cancel(job["kind"], group_id, job["key"])
+
+    def next_deadline(self) -> Optional[float]:
+        return self.clock.next_deadline()
+
+    def pop_due(self, now: float, limit: int) -> List[Dict[str, Any]]:
+        """取出最多 limit 个已到期任务（按截止时间先后）"""
+        return [self.jobs.pop(job_id) for job_id in self.clock.pop_due(now, limit)]
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        return list(self.jobs.values())
+
+    @classmethod
+    def from_list(cls, data: List[Dict[str, Any]]) -> "JobScheduler":
+        scheduler = cls()
+        for job in data:
+            scheduler.schedule(job["kind"], job["group_id"], job["deadline"],
+                               job.get("origin", ""), job.get("key", ""), job.get("payload", {}))
+        return scheduler
+
+
+class RequestStore:
+    """带过期时间的请求表（对战请求、交易请求）
+
+    requests 保存 {请求ID: 请求数据}，by_target 是 目标玩家 -> 请求ID 的反向索引
+    （按发起顺序排列），_expiry 是 (过期时间, 请求ID) 最小堆。
+    过期请求在每次访问时和后台定时任务中从堆顶惰性清除。
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.requests: Dict[str, Dict[str, Any]] = {}
+        self.by_target: Dict[str, Dict[str, None]] = {}
+        self._expiry: List[Tuple[float, str]] = []
+
+    def add(self, request_id: str, data: Dict[str, Any], now: float = None) -> Dict[str, Any]:
+        """登记请求（data 中需包含 target_id），同ID的旧请求会被替换"""
+        now = time.time() if now is None else now
+        self.pop(request_id)
+        data.setdefault("expire_at", now + self.ttl)
+        self.requests[request_id] = data
+        self.by_target.setdefault(data["target_id"], {})[request_id] = None
+        heapq.heappush(self._expiry, (data["expire_at"], request_id))
+        return data
+
+    def pop(self, request_id: str) -> Optional[Dict[str, Any]]:
+        data = self.requests.pop(request_id, None)
+        if data is not None:
+            targets = self.by_target.get(data["target_id"])
+            if targets is not None:
+                targets.pop(request_id, None)
+                if not targets:
+                    del self.by_target[data["target_id"]]
+        return data
+
+    def sweep(self, now: float = None) -> List[Dict[str, Any]]:
+        """清除所有已过期的请求，返回被清除的请求"""
+        now = time.time() if now is None else now
+        expired = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expire_at, request_id = heapq.heappop(self._expiry)
+            data = self.requests.get(request_id)
+            # 被替换或已处理的请求在堆中只剩残留条目
+            if data is not None and data["expire_at"] == expire_at:
+                expired.append(self.pop(request_id))
+        return expired
+
+    def for_target(self, target_id: str) -> List[Dict[str, Any]]:
+        """目标玩家收到的所有有效请求（最早发起的在前）"""
+        self.sweep()
+        return [self.requests[rid] for rid in self.by_target.get(target_id, ())]
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        self.sweep()
+        return self.requests.get(request_id)
+
+    def __contains__(self, request_id: str) -> bool:
+        return self.get(request_id) is not None
+
+    def __getitem__(self, request_id: str) -> Dict[str, Any]:
+        data = self.get(request_id)
+        if data is None:
+            raise KeyError(request_id)
+        return data
+
+    def __delitem__(self, request_id: str) -> None:
+        self.pop(request_id)
+
+    def __len__(self):
+        return len(self.requests)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        self.sweep()
+        return dict(self.requests)
+
+    @classmethod
+    def from_dict(cls, ttl: float, data: Dict[str, Dict[str, Any]]) -> "RequestStore":
+        store = cls(ttl)
+        for request_id, request in sorted(data.items(), key=lambda kv: kv[1].get("create_time", 0)):
+            if "expire_at" not in request:
+                request["expire_at"] = request.get("create_time", time.time()) + ttl
+            store.add(request_id, request)
+        store.sweep()
+        return store
+
+
+DUEL_SKILLS = ["佛怒火莲", "八极崩", "焰分噬浪尺", "三千雷动", "帝印决", "吸掌", "玄重尺法", "风之极·陨杀", "大天造化掌", "天火三玄变"]
+
+DUEL_NARRATION_TEMPLATES = {
+    # 境界差距悬殊：碾压
+    "crush": [
+        "{winner}立于虚空，{w_realm}威压铺天盖地而下。{loser}虽是{l_realm}，却连斗气都难以运转，"
+        "{winner}只随手一记{skill}，{loser}便如断线风筝般倒飞而出。境界之差，宛若天堑。",
+        "斗气化翼轻振，{winner}身形一闪便至{loser}身前。{l_realm}的护体斗气在{w_realm}面前薄如蝉翼，"
+        "一招{skill}落下，胜负已分，观战众人无不噤若寒蝉。",
+    ],
+    # 境界相近：苦战
+    "close": [
+        "{winner}与{loser}甫一交手便是硬碰硬，{skill}与{skill2}在半空轰然相撞，气浪掀翻四周山石。"
+        "鏖战百回合后，{winner}抓住{loser}斗气衔接的一瞬破绽，险胜一招！",
+        "两道斗气光柱冲天而起，{loser}以{skill2}抢攻占得先机，{winner}却沉稳应对，"
+        "暗中蓄势的{skill}骤然爆发，一举扭转战局。{loser}踉跄后退，嘴角溢血，只得认输。",
+    ],
+    # 以下克上：逆袭
+    "upset": [
+        "谁也没想到，区区{w_realm}的{winner}竟敢硬撼{l_realm}的{loser}！生死关头，{winner}燃烧精血施展{skill}，"
+        "火莲绽放之际天地失色，{loser}满脸不可置信地败下阵来。",
+        "{loser}仗着{l_realm}修为步步紧逼，{winner}却借身法游走，寻得破绽后一记{skill}直取要害。"
+        "越阶而战，{winner}之名今日响彻四方！",
+    ],
+}
+
+
+DUEL_OUTCOME_TEMPLATES = {
+    True: ["{loser}经脉寸断，气若游丝，已是濒死之躯。", "一口鲜血喷出，{loser}斗气溃散，重伤濒死倒地不起。"],
+    False: ["{loser}受了些伤，调息片刻后黯然离场。", "{loser}拱手认输，伤势虽不致命，也需静养数日。"],
+}
+
+
+def render_duel_narration(winner_name: str, loser_name: str, winner_realm: int, loser_realm: int,
+                          loser_dying: bool = False, rng: random.Random = random) -> str:
+    """不依赖 LLM 的对战叙事模板：按胜负双方的境界差选择碾压/苦战/逆袭文案，并交代败者结局"""
+    gap = winner_realm - loser_realm
+    kind = "crush" if gap >= 2 else "upset" if gap < 0 else "close"
+    skill, skill2 = rng.sample(DUEL_SKILLS, 2)
+    values = {
+        "winner": winner_name, "loser": loser_name,
+        "w_realm": REALMS[winner_realm]["name"], "l_realm": REALMS[loser_realm]["name"],
+        "skill": skill, "skill2": skill2,
+    }
+    return (rng.choice(DUEL_NARRATION_TEMPLATES[kind]) + rng.choice(DUEL_OUTCOME_TEMPLATES[loser_dying])).format(**values)
+
+
+WORLD_EVENT_TEMPLATES = [
+    ("{place}异宝出世", "{place}上空霞光冲天，疑似有{treasure}现世，{force}已派出长老封锁方圆百里，各路强者闻风而动。", "前往探索的修炼者机缘与凶险并存"),
+    ("{force}广招门徒", "{force}开山门广纳天下英才，凡{realm}以上修为者皆可参加考核，优胜者可入藏经阁挑选功法。", "修炼者斗气增长略有提升"),
+    ("{place}兽潮", "{place}深处魔兽暴动，成群的高阶魔兽冲出山脉，周边城镇紧急求援，佣兵工会发布高额悬赏。", "探索风险上升，魔兽内丹掉落增加"),
+    ("异火榜异动", "沉寂多年的{treasure}气息在{place}一闪而逝，{force}与数位{realm}强者同时现身，一场争夺在所难免。", "高境界修炼者之间的对决更加频繁"),
+    ("丹会开幕", "{force}于{place}举办炼药师大会，各方炼药师齐聚一堂，大会魁首将获赠{treasure}。", "丹药价格小幅波动"),
+]
+WORLD_EVENT_PLACES = ["魔兽山脉", "塔戈尔大沙漠", "迦南学院", "天焚炼气塔", "中州", "黑角域", "丹域", "古帝洞府"]
+WORLD_EVENT_FORCES = ["云岚宗", "魂殿", "丹塔", "星陨阁", "花宗", "古族", "萧族", "天府联盟"]
+WORLD_EVENT_TREASURES = ["青莲地心火", "陨落心炎", "菩提古树", "帝品雏丹", "地阶斗技残卷", "净莲妖火", "玄黄炎"]
+
+
+def render_world_event(rng: random.Random = random) -> str:
+    """不依赖 LLM 的世界事件模板，格式与 LLM 生成的事件一致"""
+    name, description, effect = rng.choice(WORLD_EVENT_TEMPLATES)
+    values = {
+        "place": rng.choice(WORLD_EVENT_PLACES),
+        "force": rng.choice(WORLD_EVENT_FORCES),
+        "treasure": rng.choice(WORLD_EVENT_TREASURES),
+        "realm": rng.choice(REALMS[5:11])["name"],
+    }
+    return f"【{name.format(**values)}】{description.format(**values)}\n（{effect}）"
+
+
+class WorldEventPool:
+    """所有群共享的预生成世界事件池
+
+    events 是待发出的事件（先进先出），take() 每次 O(1) 取出，同一条事件只会发给
+    一个群。新事件按规范化文本的摘要去重：与池中或最近 WORLD_EVENT_RECENT 条已发出
+    事件相同的不再入池。池不足时 take() 用模板补齐，绝不等待 LLM；补充由插件的
+    后台任务调用 refill() 完成，每轮用 asyncio.gather 并发生成。
+    """
+
+    def __init__(self):
+        self.events: deque = deque()
+        self._digests: Dict[str, None] = {}  # 池中事件的摘要
+        self.recent: deque = deque(maxlen=WORLD_EVENT_RECENT)  # 最近发出事件的摘要
+        self._recent_set: set = set()
+
+    def __len__(self):
+        return len(self.events)
+
+    @staticmethod
+    def digest(text: str) -> str:
+        normalized = "".join(text.split())
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).hexdigest()
+
+    def add(self, text: str) -> bool:
+        """放入一条事件，空文本或重复事件返回 False"""
+        if not text or not text.strip():
+            return False
+        digest = self.digest(text)
+        if digest in self._digests or digest in self._recent_set:
+            return False
+        self.events.append(text.strip())
+        self._digests[digest] = None
+        return True
+
+    def _remember(self, digest: str) -> None:
+        if len(self.recent) == self.recent.maxlen:
+            self._recent_set.discard(self.recent[0])
+        self.recent.append(digest)
+        self._recent_set.add(digest)
+
+    def take(self, count: int, rng: random.Random = random) -> List[str]:
+        """取出 count 条事件，池中不足的部分用模板生成"""
+        taken = []
+        while len(taken) < count and self.events:
+            text = self.events.popleft()
+            digest = self.digest(text)
+            self._digests.pop(digest, None)
+            self._remember(digest)
+            taken.append(text)
+        while len(taken) < count:
+            taken.append(render_world_event(rng))
+        return taken
+
+    @property
+    def low(self) -> bool:
+        return len(self.events) < WORLD_EVENT_POOL_LOW
+
+    async def refill(self, generate: Callable[[], Awaitable[str]]) -> int:
+        """并发生成事件直到池满，返回新入池的数量；一整轮没有新事件（全部失败或重复）即停止"""
+        added = 0
+        while len(self.events) < WORLD_EVENT_POOL_SIZE:
+            batch = min(WORLD_EVENT_REFILL_CONCURRENCY, WORLD_EVENT_POOL_SIZE - len(self.events))
+            results = await asyncio.gather(*(generate() for _ in range(batch)), return_exceptions=True)
+            fresh = 0
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.warning(f"世界事件生成失败: {result}")
+                elif self.add(result):
+                    fresh += 1
+            added += fresh
+            if not fresh:
+                break
+        return added
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"events": list(self.events), "recent": list(self.recent)}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "WorldEventPool":
+        pool = cls()
+        for digest in data.get("recent", []):
+            pool._remember(digest)
+        for text in data.get("events", []):
+            pool.add(text)
+        return pool
+
+
+class LLMUnavailable(Exception):
+    """LLM 提供者不可用（未配置或已熔断），调用方应直接使用模板"""
+
+
+class CircuitBreaker:
+    """LLM 提供者熔断器
+
+    closed：正常放行，连续失败 failures 次后转为 open；
+    open：直接拒绝，冷却 cooldown 秒后转为 half_open；
+    half_open：只放行一个探测请求，成功则恢复 closed，失败则重新 open 且冷却时间翻倍
+    （不超过 max_cooldown）。
+    """
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN,
+                 max_cooldown: float = LLM_BREAKER_MAX_COOLDOWN):
+        self.failure_threshold = failures
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        if self.state == "open" and now - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            self.probing = False
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("LLM 熔断恢复")
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        self.probing = False
+
+    def record_failure(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+        if self.state == "half_open":
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        elif self.failures < self.failure_threshold:
+            return
+        if self.state != "open":
+            logger.warning(f"LLM 熔断，{self.cooldown:g} 秒后探测")
+        self.state = "open"
+        self.opened_at = now
+        self.probing = False
+
+
+class ResilientLLM:
+    """带超时、熔断和结果缓存的 LLM 调用封装
+
+    call() 是实际发往提供者的调用：熔断时立即抛出 LLMUnavailable，超过 timeout 秒
+    按失败计入熔断器。缓存按规范化的 (系统提示词, 提示词) 做 LRU，每个键最多保存
+    variants 种不同结果：攒够之前 cached() 返回 None 让调用方继续请求提供者，攒够后
+    随机返回其中一种；提供者不可用时只要有缓存就返回。
+    """
+
+    def __init__(self, call: Callable[[str, str], Awaitable[str]], timeout: float = LLM_CALL_TIMEOUT,
+                 breaker: CircuitBreaker = None, cache_size: int = LLM_CACHE_SIZE,
+                 variants: int = LLM_CACHE_VARIANTS):
+        self._call = call
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.cache_size = cache_size
+        self.variants = variants
+        self.cache: "OrderedDict[str, List[str]]" = OrderedDict()
+        self.stats = Counter()
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state == "closed"
+
+    async def call(self, prompt: str, system_prompt: str = "") -> str:
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            raise LLMUnavailable("LLM 已熔断")
+        self.stats["calls"] += 1
+        try:
+            text = await asyncio.wait_for(self._call(prompt, system_prompt), self.timeout)
+            if not text or not text.strip():
+                raise ValueError("LLM 返回空文本")
+        except asyncio.CancelledError:
+            # 调用方放弃等待不算提供者的失败，但要释放半开探测名额
+            self.breaker.probing = False
+            raise
+        except Exception as e:
+            self.stats["timeouts" if isinstance(e, asyncio.TimeoutError) else "failures"] += 1
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return text
+
+    @staticmethod
+    def cache_key(prompt: str, system_prompt: str = "") -> str:
+        return WorldEventPool.digest(system_prompt + "\x00" + prompt)
+
+    def cached(self, key: str, rng: random.Random = random) -> Optional[str]:
+        variants = self.cache.get(key)
+        if not variants or (len(variants) < self.variants and self.available):
+            self.stats["cache_misses"] += 1
+            return None
+        self.cache.move_to_end(key)
+        self.stats["cache_hits"] += 1
+        return rng.choice(variants)
+
+    def remember(self, key: str, text: str) -> None:
+        variants = self.cache.setdefault(key, [])
+        if text not in variants and len(variants) < self.variants:
+            variants.append(text)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+def build_batch_prompt(prompts: List[str]) -> str:
+    """把多个独立的生成任务合并为一个要求逐行输出 JSON 的提示词"""
+    sections = [f"### 任务 {i}\n{prompt.strip()}" for i, prompt in enumerate(prompts)]
+    return (
+        f"以下是 {len(prompts)} 个相互独立的生成任务，请逐一完成，各任务的结果不要重复。\n"
+        f"输出要求：每个任务输出一行 JSON，形如 {{\"id\": 任务编号, \"text\": \"生成的内容\"}}，"
+        f"text 中的换行写作 \\n；只输出这 {len(prompts)} 行 JSON，不要输出其他内容。\n\n"
+        + "\n\n".join(sections)
+    )
+
+
+def parse_batch_response(text: str, count: int) -> Dict[int, str]:
+    """解析合批响应，返回 {任务编号: 文本}；无法解析的行、越界或重复的编号被忽略"""
+    results: Dict[int, str] = {}
+    for line in (text or "").splitlines():
+        line = line.strip().strip("`").strip()
+        if not line.startswith("{"):
+            continue
+        try:
+            item = json.loads(line)
+            index = int(item["id"])
+            content = str(item["text"]).strip()
+        except (ValueError, KeyError, TypeError):
+            continue
+        if 0 <= index < count and content and index not in results:
+            results[index] = content
+    return results
+
+
+class LLMBatcher:
+    """LLM 请求合批层
+
+    request() 把提示词挂到同一系统提示词的待发批次上并等待结果。批次在第一条请求
+    到达 window 秒后、或攒满 max_batch 条时发送：多条请求合成一个结构化提示词
+    （build_batch_prompt），响应按任务编号拆分后分别交给各自的等待者。合批响应
+    无法解析或缺少某些编号时，缺失的请求各自退回单独调用；单独调用的异常原样
+    抛给等待者。只有一条请求的批次直接单独调用。
+    """
+
+    def __init__(self, call: Callable[[str, str], Awaitable[str]], window: float = LLM_BATCH_WINDOW,
+                 max_batch: int = LLM_BATCH_MAX):
+        self.call = call  # (prompt, system_prompt) -> 文本
+        self.window = window
+        self.max_batch = max_batch
+        self.pending: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._running: set = set()
+        self.stats = Counter()
+
+    async def request(self, prompt: str, system_prompt: str = "") -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(system_prompt, [])
+        batch.append((prompt, future))
+        self.stats["requests"] += 1
+        if len(batch) >= self.max_batch:
+            self._flush(system_prompt)
+        elif system_prompt not in self._timers:
+            self._timers[system_prompt] = loop.call_later(self.window, self._flush, system_prompt)
+        return await future
+
+    def _flush(self, system_prompt: str) -> None:
+        timer = self._timers.pop(system_prompt, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(system_prompt, [])
+        # 等待者已超时取消的请求不再发送
+        batch = [(prompt, future) for prompt, future in batch if not future.done()]
+        if batch:
+            task = asyncio.ensure_future(self._run(system_prompt, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, system_prompt: str, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        if len(batch) == 1:
+            await self._single(system_prompt, *batch[0])
+            return
+        self.stats["batches"] += 1
+        self.stats["batched_requests"] += len(batch)
+        try:
+            text = await self.call(build_batch_prompt([prompt for prompt, _ in batch]), system_prompt)
+            results = parse_batch_response(text, len(batch))
+        except LLMUnavailable as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            logger.warning(f"合批 LLM 调用失败，逐条重试: {e}")
+            results = {}
+        missing = []
+        for index, (prompt, future) in enumerate(batch):
+            if index in results:
+                if not future.done():
+                    future.set_result(results[index])
+            else:
+                missing.append((prompt, future))
+        if missing:
+            self.stats["fallbacks"] += len(missing)
+            await asyncio.gather(*(self._single(system_prompt, prompt, future) for prompt, future in missing))
+
+    async def _single(self, system_prompt: str, prompt: str, future: asyncio.Future) -> None:
+        self.stats["single_calls"] += 1
+        try:
+            text = await self.call(prompt, system_prompt)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(text)
+
+    def stop(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in list(self._running):
+            task.cancel()
+        for batch in self.pending.values():
+            for _, future in batch:
+                future.cancel()
+        self.pending.clear()
+
+
+class NarrationPool:
+    """后台叙事生成池
+
+    命令处理函数把 (生成协程工厂, 模板兜底, 投递回调) 放入有界队列后立即返回，
+    固定数量的工作协程逐个取出执行，因此同时进行的 LLM 调用不超过 workers 个。
+    从提交起超过 timeout 秒（含排队时间）、出错或返回空文本时改用模板兜底；队列已满或工作协程
+    未启动时 submit 返回 False，由调用方当场使用模板。latencies 记录从提交到投递
+    完成的耗时，用于统计 P50/P99。
+    """
+
+    def __init__(self, workers: int = NARRATION_WORKERS, timeout: float = NARRATION_TIMEOUT,
+                 max_pending: int = NARRATION_MAX_PENDING):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(max_pending)
+        self.tasks: List[asyncio.Task] = []
+        self.stats = Counter()
+        self.latencies = deque(maxlen=1000)
+
+    def start(self, spawn: Callable[[Any], Optional[asyncio.Task]]) -> None:
+        """用 spawn（通常是插件的 _start_background_task）启动工作协程"""
+        self.tasks = [task for task in (spawn(self._worker()) for _ in range(self.workers)) if task]
+
+    def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def submit(self, generate: Callable[[], Awaitable[str]], fallback: Callable[[], str],
+               deliver: Callable[[str], Awaitable[Any]]) -> bool:
+        if not self.tasks:
+            self.stats["rejected"] += 1
+            return False
+        try:
+            self.queue.put_nowait((time.perf_counter(), generate, fallback, deliver))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            return False
+        self.stats["submitted"] += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            submitted, generate, fallback, deliver = await self.queue.get()
+            try:
+                try:
+                    # 超时预算从提交时算起，排队过久的请求不再调用 LLM
+                    budget = self.timeout - (time.perf_counter() - submitted)
+                    if budget <= 0:
+                        raise asyncio.TimeoutError
+                    text = await asyncio.wait_for(generate(), budget)
+                    if not text or not text.strip():
+                        raise ValueError("LLM 返回空文本")
+                    self.stats["llm"] += 1
+                except asyncio.TimeoutError:
+                    self.stats["timeout"] += 1
+                    text = fallback()
+                except Exception as e:
+                    logger.warning(f"叙事生成失败，改用模板: {e}")
+                    self.stats["error"] += 1
+                    text = fallback()
+                await deliver(text)
+                self.latencies.append(time.perf_counter() - submitted)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"叙事投递失败: {e}")
+            finally:
+                self.queue.task_done()
+
+    def percentiles(self) -> Tuple[Optional[float], Optional[float]]:
+        """最近投递的 (P50, P99) 耗时（秒）"""
+        if not self.latencies:
+            return None, None
+        ordered = sorted(self.latencies)
+        return ordered[len(ordered) // 2], ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+class OrderBook:
+    """单个物品的玩家挂单簿
+
+    买卖双方各维护一个堆：买单按 (-价格, 序号)，卖单按 (价格, 序号)，
+    即价格优先、时间优先。撤单和成交完毕的订单只从 orders 中删除，
+    堆中的残留条目在取堆顶时惰性跳过，因此每次撮合只需 O(log n)。
+    """
+
+    def __init__(self, item_name: str):
+        self.item_name = item_name
+        self.orders: Dict[str, Dict[str, Any]] = {}  # {order_id: order}
+        self.bids: List[Tuple[float, int, str]] = []  # 买单堆
+        self.asks: List[Tuple[float, int, str]] = []  # 卖单堆
+
+    def __len__(self):
+        return len(self.orders)
+
+    def add(self, order: Dict[str, Any]) -> None:
+        """挂入一个剩余数量大于0的订单"""
+        self.orders[order["order_id"]] = order
+        if order["side"] == "buy":
+            heapq.heappush(self.bids, (-order["price"], order["seq"], order["order_id"]))
+        else:
+            heapq.heappush(self.asks, (order["price"], order["seq"], order["order_id"]))
+
+    def remove(self, order_id: str) -> Optional[Dict[str, Any]]:
+        """移除订单，堆中条目留待惰性清理"""
+        return self.orders.pop(order_id, None)
+
+    def best(self, side: str) -> Optional[Dict[str, Any]]:
+        """返回某一侧的最优订单（跳过已失效的堆条目）"""
+        heap = self.bids if side == "buy" else self.asks
+        while heap:
+            order = self.orders.get(heap[0][2])
+            if order is not None and order["quantity"] > 0:
+                return order
+            heapq.heappop(heap)
+        return None
+
+    def depth(self, side: str, levels: int = 5) -> List[Tuple[float, int]]:
+        """按价位聚合的盘口深度 [(价格, 数量)]"""
+        heap = self.bids if side == "buy" else self.asks
+        live = [entry for entry in heap if entry[2] in self.orders]
+        aggregated: Dict[float, int] = {}
+        for key, _, order_id in heapq.nsmallest(len(live), live):
+            price = -key if side == "buy" else key
+            if price not in aggregated and len(aggregated) >= levels:
+                break
+            aggregated[price] = aggregated.get(price, 0) + self.orders[order_id]["quantity"]
+        return list(aggregated.items())
+
+
+class LotteryIndex:
+    """斗破彩中奖倒排索引，购买时增量建立
+
+    任何中奖彩票都至少与中奖号码共有 2 个主号码或 2 个特别号码（最低的九等奖为
+    3+0、2+1、0+2），因此索引以“号码对”而不是单个号码为键：每注彩票登记到它的
+    C(5,2)=10 个主号码对和 1 个特别号码对之下。开奖时只取中奖号码的 10 个主号码对
+    与 1 个特别号码对的倒排表求并集，候选彩票约为中奖彩票的两倍，判定开销与中奖
+    注数成正比，而与售出总注数无关。键为号码对的掩码，主号码对与特别号码对不会重叠。
+    """
+
+    def __init__(self):
+        self.user_ids: List[str] = []
+        self._slots: Dict[str, int] = {}
+        self.owners = array("I")  # 彩票编号 -> 玩家槽位
+        self.tickets = array("Q")  # 彩票编号 -> 彩票掩码
+        self.postings: Dict[int, array] = {}  # 号码对掩码 -> 彩票编号
+
+    def __len__(self):
+        return len(self.tickets)
+
+    @staticmethod
+    def pair_keys(ticket: int) -> List[int]:
+        """一注彩票的 10 个主号码对和 1 个特别号码对"""
+        bits = []
+        rest = ticket & LOTTERY_MAIN_MASK
+        while rest:
+            low = rest & -rest
+            bits.append(low)
+            rest ^= low
+        keys = [a | b for a, b in itertools.combinations(bits, 2)]
+        keys.append(ticket & ~LOTTERY_MAIN_MASK)
+        return keys
+
+    def add(self, user_id: str, tickets) -> None:
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+        postings = self.postings
+        for ticket in tickets:
+            ticket_id = len(self.tickets)
+            self.tickets.append(ticket)
+            self.owners.append(slot)
+            for key in self.pair_keys(ticket):
+                posting = postings.get(key)
+                if posting is None:
+                    posting = postings[key] = array("I")
+                posting.append(ticket_id)
+
+    @classmethod
+    def from_tickets(cls, tickets_by_user: Dict[str, array]) -> "LotteryIndex":
+        index = cls()
+        for user_id, tickets in tickets_by_user.items():
+            index.add(user_id, tickets)
+        return index
+
+    def match(self, winning_mask: int) -> Dict[str, List[Tuple[str, int]]]:
+        """与 match_lottery_tickets 返回相同的 {奖级: [(user_id, 彩票掩码)]}"""
+        candidates = set()
+        for key in self.pair_keys(winning_mask):
+            posting = self.postings.get(key)
+            if posting is not None:
+                candidates.update(posting)
+
+        winners = {level: [] for level in LOTTERY_PRIZE_LEVELS}
+        buckets = [winners[level] for level in LOTTERY_PRIZE_LEVELS]
+        table = LOTTERY_TIER_TABLE
+        tickets, owners, user_ids = self.tickets, self.owners, self.user_ids
+        for ticket_id in sorted(candidates):  # 按购买顺序输出
+            ticket = tickets[ticket_id]
+            hit = ticket & winning_mask
+            tier = table[(hit & LOTTERY_MAIN_MASK).bit_count() * 3 + (hit >> LOTTERY_SPECIAL_SHIFT).bit_count()]
+            if tier >= 0:
+                buckets[tier].append((user_ids[owners[ticket_id]], ticket))
+        return winners
 
 
 class GameWorld:
@@ -1675,20 +3480,23 @@ class GameWorld:
         self.last_market_refresh = 0
         self.world_events = []
         self.last_event_update = 0
-        self.duel_requests: Dict[str, str] = {}
+        self.duel_requests = RequestStore(DUEL_REQUEST_TTL)  # {挑战者ID: 请求}
 
         self.auction_items = []
         self.last_auction_refresh = 0
-        self.auction_bids = {}  # {index: {'bid': amount, 'bidder': user_id, 'bidder_name': name, 'bid_time': timestamp}}
+        # {index: {'bid': 当前价, 'bidder': user_id, 'bidder_name': name, 'bid_time': timestamp,
+        #          'max_bid': 领先者的最高价（已托管）, 'seq': 出价序号, 'proxies': 代拍堆}}
+        self.auction_bids = {}
         self.auction_end_time = 0
-        self.auction_quick_win_tasks: Dict[int, asyncio.Task] = {}
+        self.notify_origin = ""  # 最近一次互动的会话（unified_msg_origin），用于后台通知
 
         self.lottery_pool = 5000000 + 213616  # 奖池累计
         self.last_lottery_draw = 0  # 上次开奖时间
-        self.lottery_tickets = {}  # 玩家购买的彩票 {user_id: [ticket_numbers]}
-        self.lottery_history = []  # 历史开奖记录
+        self.lottery_tickets = {}  # 玩家购买的彩票 {user_id: array('Q', [彩票掩码])}
+        self.lottery_index = LotteryIndex()  # 本期彩票的中奖倒排索引（不存盘，加载时重建）
+        self.lottery_history = deque(maxlen=LOTTERY_HISTORY_SIZE)  # 最近的开奖记录
+        self.lottery_archive_pending = []  # 尚未写入归档文件的开奖记录，保存世界时写入
         self.lottery_end_time = self.last_lottery_draw  #
-        self.lottery_task = []
 
         self.supreme_ruler = None  # 当前至高主宰玩家ID
         self.world_boss_alive = True  # 世界boss状态
@@ -1698,9 +3506,15 @@ class GameWorld:
         self.supreme_ruler_bonus = 1.5  # 至高主宰加成系数
 
         # 新增交易系统
-        self.trade_requests: Dict[str, Dict] = {}  # {trade_id: trade_data}
+        self.trade_requests = RequestStore(TRADE_REQUEST_TTL)  # {trade_id: trade_data}
         self.next_trade_id = 1
 
+        # 玩家挂单簿 {物品名: OrderBook}
+        self.order_books: Dict[str, OrderBook] = {}
+        self.next_order_id = 1
+
+        # 副本队伍（大厅）
+        self.dungeons = DungeonManager()
 
     def reset_world_boss(self):
         """重置世界boss"""
@@ -1717,6 +3531,132 @@ class GameWorld:
         sorted_doms = sorted(dominators, key=lambda x: x.power, reverse=True)
         return sorted_doms[:top_n]
 
+    def place_order(self, player: Player, side: str, item_name: str, price: int, quantity: int) -> Tuple[bool, str]:
+        """挂出限价买单/卖单，先与对手盘撮合，剩余部分进入挂单簿
+
+        挂单时即托管资产：买单冻结 价格×数量 的金币，卖单从背包取出物品。
+        成交价取挂单簿中已有订单的价格，买方按更低价成交时退还差价。
+        不允许自成交：撮合到自己的挂单时撤销该挂单并退还托管资产。
+        """
+        if side == "buy":
+            if player.free_slots < quantity:
+                return False, f"背包空间不足，求购{quantity}个需要{quantity}格空位"
+            if not player.deduct_gold(price * quantity):
+                return False, f"金币不足，求购需要冻结{price * quantity}金币"
+        else:
+            if not player.remove_items(item_name, quantity):
+                return False, f"你的【{item_name}】数量不足{quantity}个"
+
+        order_id = f"order-{self.next_order_id}"
+        order = {
+            "order_id": order_id,
+            "seq": self.next_order_id,
+            "side": side,
+            "user_id": player.user_id,
+            "user_name": player.user_name,
+            "item_name": item_name,
+            "price": price,
+            "quantity": quantity,
+            "create_time": time.time(),
+        }
+        self.next_order_id += 1
+
+        book = self.order_books.setdefault(item_name, OrderBook(item_name))
+        fills, self_cancelled = self._match_order(book, order)
+
+        lines = []
+        for resting in self_cancelled:
+            lines.append(f"已撤销你自己的对手挂单 {resting['order_id']}（{resting['quantity']}个 @ {resting['price']}金币）")
+        for counterparty, fill_qty, fill_price in fills:
+            lines.append(f"与 {counterparty} 成交 {fill_qty}个 @ {fill_price}金币")
+        if order["quantity"] > 0:
+            book.add(order)
+            lines.append(f"剩余 {order['quantity']}个 已挂单，订单号：{order_id}")
+        elif not book:
+            del self.order_books[item_name]
+        return True, "\n".join(lines)
+
+    def _match_order(self, book: OrderBook,
+                     order: Dict[str, Any]) -> Tuple[List[Tuple[str, int, int]], List[Dict[str, Any]]]:
+        """将新订单与对手盘按价格-时间优先撮合，返回 ([(对手名, 数量, 成交价)], 被撤销的自己的挂单)"""
+        fills = []
+        self_cancelled = []
+        is_buy = order["side"] == "buy"
+        taker = self.players[order["user_id"]]
+        while order["quantity"] > 0:
+            resting = book.best("sell" if is_buy else "buy")
+            if resting is None:
+                break
+            if (is_buy and resting["price"] > order["price"]) or (not is_buy and resting["price"] < order["price"]):
+                break
+
+            if resting["user_id"] == order["user_id"]:
+                # 自成交防护：撤销自己的旧挂单（退还托管资产），不产生成交
+                self._cancel_resting(book, resting)
+                self_cancelled.append(resting)
+                continue
+
+            maker = self.players.get(resting["user_id"])
+            buyer = taker if is_buy else maker
+            if maker is None or (not is_buy and buyer.free_slots == 0):
+                # 挂单方已离开世界或背包已满，撤销该挂单并退还托管资产
+                self._cancel_resting(book, resting)
+                continue
+
+            fill_qty = min(order["quantity"], resting["quantity"], buyer.free_slots)
+            if fill_qty == 0:
+                break  # 买方背包已满（撤销的卖单物品退回了背包），剩余部分挂单
+            fill_price = resting["price"]
+            seller = maker if is_buy else taker
+
+            buyer.add_items(book.item_name, fill_qty)
+            seller.add_gold(fill_price * fill_qty)
+            if is_buy and order["price"] > fill_price:
+                buyer.add_gold((order["price"] - fill_price) * fill_qty)
+
+            order["quantity"] -= fill_qty
+            resting["quantity"] -= fill_qty
+            if resting["quantity"] == 0:
+                book.remove(resting["order_id"])
+            fills.append((maker.user_name, fill_qty, fill_price))
+        return fills, self_cancelled
+
+    def _cancel_resting(self, book: OrderBook, order: Dict[str, Any]) -> None:
+        """移除挂单并退还托管的金币或物品"""
+        book.remove(order["order_id"])
+        owner = self.players.get(order["user_id"])
+        if owner is None or order["quantity"] <= 0:
+            return
+        if order["side"] == "buy":
+            owner.add_gold(order["price"] * order["quantity"])
+        else:
+            # 托管物品原本就在背包中，直接归还不受容量限制
+            owner.inventory.extend([order["item_name"]] * order["quantity"])
+
+    def cancel_order(self, user_id: str, order_id: str) -> Tuple[bool, str]:
+        """撤销自己的挂单"""
+        for item_name, book in self.order_books.items():
+            order = book.orders.get(order_id)
+            if order is None:
+                continue
+            if order["user_id"] != user_id:
+                return False, "这不是你的挂单！"
+            self._cancel_resting(book, order)
+            if not book:
+                del self.order_books[item_name]
+            action = "退还金币" if order["side"] == "buy" else "退还物品"
+            return True, f"已撤销订单 {order_id}（{item_name} ×{order['quantity']}），{action}"
+        return False, "订单号无效或订单已成交！"
+
+    def get_player_orders(self, user_id: str) -> List[Dict[str, Any]]:
+        """获取玩家当前所有挂单"""
+        return [
+            order
+            for book in self.order_books.values()
+            for order in book.orders.values()
+            if order["user_id"] == user_id
+        ]
+
     def generate_technique(self):
         """按概率生成功法"""
         technique = random.choices(
@@ -1895,33 +3835,133 @@ class GameWorld:
         num_items = min(random.randint(3, 5), len(rare_items))
         self.auction_items = random.sample(rare_items, num_items)
 
+    @staticmethod
+    def auction_increment(item: Dict[str, Any]) -> int:
+        return max(1, int(item['base_price'] * AUCTION_INCREMENT_RATE))
+
+    def place_auction_bid(self, player: Player, index: int, amount: int,
+                          proxy: bool = False) -> Tuple[bool, str, Optional[Dict[str, Any]]]:
+        """出价或设置代拍（最高价）
+
+        每件拍品维护一个代拍堆，元素为 [-最高价, 出价序号, user_id, 名字, 是否已托管]，
+        最高价相同时先出价者优先。每个仍在堆中的出价者都已托管其最高价，
+        因此结算时不会出现金币不足。新出价入堆后按第二高价加一个加价幅度
+        确定成交价（不超过领先者的最高价），被超过的出价立即退还托管金币；
+        堆中只留下领先者，每次出价的开销为 O(log n)。
+        手动出价视为最高价等于出价金额、且成交价至少为该金额的代拍。
+
+        返回 (是否受理, 提示信息, 出价后的记录)
+        """
+        item = self.auction_items[index]
+        key = str(index)
+        bid_info = self.auction_bids.get(key)
+        current = bid_info['bid'] if bid_info else None
+
+        if current is not None and amount <= current:
+            return False, f"你的出价必须高于当前最高价 {current} 金币！", None
+        if amount < item['base_price']:
+            return False, f"出价不能低于起拍价 {item['base_price']} 金币！", None
+
+        if bid_info is None:
+            bid_info = {'bid': item['base_price'], 'seq': 0, 'proxies': []}
+        elif 'proxies' not in bid_info:
+            # 旧存档的出价没有托管金币，以当前价作为其最高价参与比较，不退款
+            bid_info['proxies'] = [[-bid_info['bid'], 0, bid_info['bidder'], bid_info['bidder_name'], False]]
+            bid_info['seq'] = 0
+        heap = bid_info['proxies']
+
+        # 领先者提高自己的最高价：替换原出价并退还原托管金额
+        own = heap[0] if heap and heap[0][2] == player.user_id else None
+        if own and amount <= -own[0]:
+            return False, f"你已设置的最高价为 {-own[0]} 金币，新的最高价必须更高！", None
+        refund = -own[0] if own and own[4] else 0
+        if player.gold + refund < amount:
+            return False, "你的金币不足！", None
+        if own:
+            heapq.heappop(heap)
+            player.gold += refund
+        player.gold -= amount
+
+        bid_info['seq'] += 1
+        heapq.heappush(heap, [-amount, bid_info['seq'], player.user_id, player.user_name, True])
+
+        # 决定领先者与成交价
+        top = heapq.heappop(heap)
+        floor = bid_info['bid'] if current is not None else item['base_price']
+        if heap:
+            floor = max(floor, -heap[0][0] + self.auction_increment(item))
+        if not proxy and top[2] == player.user_id:
+            floor = max(floor, amount)
+        price = min(-top[0], floor)
+
+        # 其余出价均已被超过，退还托管金币
+        for entry in heap:
+            if entry[4] and entry[2] in self.players:
+                self.players[entry[2]].gold += -entry[0]
+        heap[:] = [top]
+
+        bid_info.update({
+            'bid': price,
+            'bidder': top[2],
+            'bidder_name': top[3],
+            'bid_time': time.time(),
+            'max_bid': -top[0],
+        })
+        self.auction_bids[key] = bid_info
+        return True, "", bid_info
+
+    def settle_auction_item(self, index: int) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """按当前价结算一件拍品，领先者从托管金币中付款并退还差额
+
+        返回 (出价记录, 是否成交)；未成交的托管金币会退还
+        """
+        item = self.auction_items[index]
+        bid_info = self.auction_bids.pop(str(index), None)
+        if item is None or not bid_info:
+            return bid_info, False
+        winner = self.players.get(bid_info['bidder'])
+        if winner is None:
+            return bid_info, False
+
+        price = bid_info['bid']
+        escrowed = bid_info.get('proxies') and bid_info['proxies'][0][4]
+        if escrowed:
+            winner.gold += bid_info['max_bid'] - price
+        elif not winner.deduct_gold(price):  # 旧存档中未托管的出价
+            return bid_info, False
+
+        if not winner.add_item(item['name']):
+            winner.gold += price
+            return bid_info, False
+        self.auction_items[index] = None
+        return bid_info, True
+
+    def refund_auction_bids(self):
+        """退还所有未结算出价的托管金币并清空竞拍记录"""
+        for bid_info in self.auction_bids.values():
+            proxies = bid_info.get('proxies')
+            if proxies and proxies[0][4] and bid_info['bidder'] in self.players:
+                self.players[bid_info['bidder']].gold += bid_info['max_bid']
+        self.auction_bids = {}
+
     def process_auction_results(self):
         """处理拍卖结果，在拍卖结束后调用"""
         results = []
         for index, item in enumerate(self.auction_items):
-            bid_info = self.auction_bids.get(str(index))
-            if bid_info:
-                # 找到最高出价者
-                winner_id = bid_info['bidder']
-                bid_amount = bid_info['bid']
-
-                if winner_id in self.players:
-                    winner = self.players[winner_id]
-                    if winner.gold >= bid_amount:
-                        winner.gold -= bid_amount
-                        if winner.add_item(item['name']):
-                            results.append(f"🎉 【{winner.user_name}】以 {bid_amount}金币 拍得 【{item['name']}】")
-                        else:
-                            results.append(f"❌ 【{winner.user_name}】拍得 【{item['name']}】但背包已满，交易取消")
-                            winner.gold += bid_amount  # 返还金币
-                    else:
-                        results.append(f"❌ 【{winner.user_name}】金币不足，【{item['name']}】流拍")
-                else:
-                    results.append(f"❌ 【{item['name']}】流拍（出价者已退出游戏）")
-            else:
+            if item is None:  # 已快速成交
+                continue
+            bid_info, sold = self.settle_auction_item(index)
+            if sold:
+                results.append(f"🎉 【{bid_info['bidder_name']}】以 {bid_info['bid']}金币 拍得 【{item['name']}】")
+            elif not bid_info:
                 results.append(f"❌ 【{item['name']}】无人出价，流拍")
+            elif bid_info['bidder'] not in self.players:
+                results.append(f"❌ 【{item['name']}】流拍（出价者已退出游戏）")
+            else:
+                results.append(f"❌ 【{bid_info['bidder_name']}】未能拍得 【{item['name']}】（金币不足或背包已满），流拍")
         # 清空拍卖物品
         self.auction_items = []
+        self.auction_bids = {}
         return results
 
     def generate_lottery_numbers(self) -> List[int]:
@@ -1934,6 +3974,8 @@ class GameWorld:
         """购买彩票"""
         if numbers and len(numbers) != 7:
             return False, "请输入7个数字(前5个1-35，后2个1-12)"
+        if numbers and (len(set(numbers[:5])) != 5 or len(set(numbers[5:])) != 2):
+            return False, "同一区内的号码不能重复"
 
         if not numbers:
             numbers = self.generate_lottery_numbers()
@@ -1947,152 +3989,132 @@ class GameWorld:
                     return False, "后2个数字必须在1-12范围内"
 
         if user_id not in self.lottery_tickets:
-            self.lottery_tickets[user_id] = []
-
-        self.lottery_tickets[user_id].append(numbers)
-        self.lottery_pool += 100  # 每注100金币加入奖池
+            self.lottery_tickets[user_id] = array("Q")
+
+        ticket = encode_lottery_ticket(numbers)
+        self.lottery_tickets[user_id].append(ticket)
+        if LOTTERY_WINNER_LOOKUP == "index":
+            self.lottery_index.add(user_id, (ticket,))
+        self.lottery_pool += LOTTERY_TICKET_PRICE
+        numbers = sorted(numbers[:5]) + sorted(numbers[5:])
         return True, f"购买成功！你的号码是：{numbers[:5]} + {numbers[5:]}"
 
+    def add_lottery_tickets(self, user_id: str, count: int) -> array:
+        """随机生成 count 注彩票记到玩家名下，不动奖池；返回新生成的彩票"""
+        tickets = generate_lottery_tickets(count)
+        self.lottery_tickets.setdefault(user_id, array("Q")).extend(tickets)
+        if LOTTERY_WINNER_LOOKUP == "index":
+            self.lottery_index.add(user_id, tickets)
+        return tickets
+
+    def credit_lottery_pool(self, count: int) -> None:
+        """count 注彩票的售价全额计入奖池"""
+        self.lottery_pool += LOTTERY_TICKET_PRICE * count
+
+    def buy_lottery_tickets(self, user_id: str, count: int) -> array:
+        """随机购买 count 注彩票，奖池一次性入账；返回新买的彩票"""
+        tickets = self.add_lottery_tickets(user_id, count)
+        self.credit_lottery_pool(count)
+        return tickets
+
     def draw_lottery(self) -> Dict[str, Any]:
         """开奖并计算中奖结果"""
         if self.lottery_pool <= 0:
-            self.lottery_pool = 100000
+            self.lottery_pool = LOTTERY_POOL_FLOOR
+        # 中奖规则见 _lottery_tier：5+2 一等奖 …… 3+0、2+1、0+2 九等奖
         winning_numbers = self.generate_lottery_numbers()
-        winners = {
-            "一等奖": [],  # 5+2
-            "二等奖": [],  # 5+1
-            "三等奖": [],  # 5+0
-            "四等奖": [],  # 4+2
-            "五等奖": [],  # 4+1
-            "六等奖": [],  # 3+2 or 2+2
-            "七等奖": [],  # 4+0
-            "八等奖": [],  # 3+1 or 1+2
-            "九等奖": []  # 3+0 or 2+1 or 0+2
-        }
-
-        # 更合理的奖池分配方案，提高中低奖项比例
-        prize_distribution = {
-            "一等奖": 0.4,  # 40% 奖池 - 头奖，占大头
-            "二等奖": 0.25,  # 25% 奖池 - 次大奖
-            "三等奖": 0.15,  # 15% 奖池 - 中等奖
-            "四等奖": 0.08,  # 8% 奖池 - 小奖，递减
-            "五等奖": 0.05,  # 5% 奖池
-            "六等奖": 0.03,  # 3% 奖池
-            "七等奖": 0.02,  # 2% 奖池
-            "八等奖": 0.015,  # 1.5% 奖池
-            "九等奖": 0.005  # 0.5% 奖池 - 安慰奖，比例最小
-        }
 
         # 计算每个奖项的奖金
         total_prize = self.lottery_pool
         prize_amounts = {
             level: int(total_prize * percentage)
-            for level, percentage in prize_distribution.items()
+            for level, percentage in LOTTERY_PRIZE_DISTRIBUTION.items()
         }
 
-        # 检查所有彩票
-        for user_id, tickets in self.lottery_tickets.items():
-            for ticket in tickets:
-                main_match = len(set(ticket[:5]) & set(winning_numbers[:5]))
-                special_match = len(set(ticket[5:]) & set(winning_numbers[5:]))
-
-                if main_match == 5 and special_match == 2:
-                    winners["一等奖"].append((user_id, ticket))
-                elif main_match == 5 and special_match == 1:
-                    winners["二等奖"].append((user_id, ticket))
-                elif main_match == 5:
-                    winners["三等奖"].append((user_id, ticket))
-                elif main_match == 4 and special_match == 2:
-                    winners["四等奖"].append((user_id, ticket))
-                elif main_match == 4 and special_match == 1:
-                    winners["五等奖"].append((user_id, ticket))
-                elif (main_match == 3 and special_match == 2) or (main_match == 2 and special_match == 2):
-                    winners["六等奖"].append((user_id, ticket))
-                elif main_match == 4:
-                    winners["七等奖"].append((user_id, ticket))
-                elif (main_match == 3 and special_match == 1) or (main_match == 1 and special_match == 2):
-                    winners["八等奖"].append((user_id, ticket))
-                elif main_match == 3 or (main_match == 2 and special_match == 1) or (
-                        main_match == 0 and special_match == 2):
-                    winners["九等奖"].append((user_id, ticket))
-
-        # 计算实际发放的总奖金
+        # 查找中奖彩票：{奖级: [(user_id, 彩票掩码)]}
+        winning_mask = encode_lottery_ticket(winning_numbers)
+        if LOTTERY_WINNER_LOOKUP == "index":
+            winners = self.lottery_index.match(winning_mask)
+        else:
+            winners = match_lottery_tickets(self.lottery_tickets, winning_mask)
+
+        # 计算实际发放的总奖金，并按玩家汇总后一次性发放
         total_payout = 0
+        per_winner = {}
+        payouts = Counter()
         for level in prize_amounts:
             if winners[level]:  # 如果有中奖者
                 # 奖金按中奖人数平分
-                per_winner_prize = prize_amounts[level] // len(winners[level])
-                total_payout += per_winner_prize * len(winners[level])
+                per_winner[level] = prize_amounts[level] // len(winners[level])
+                total_payout += per_winner[level] * len(winners[level])
+                for user_id, _ in winners[level]:
+                    payouts[user_id] += per_winner[level]
+        for user_id, amount in payouts.items():
+            player = self.players.get(user_id)
+            if player:
+                player.add_gold(amount)
 
         # 记录开奖结果
-        self.lottery_history.append({
+        record = {
             "draw_time": time.time(),
             "numbers": winning_numbers,
             "winners": {k: len(v) for k, v in winners.items()},
             "total_payout": total_payout
-        })
+        }
+        self.lottery_history.append(record)
+        self.lottery_archive_pending.append(record)
 
         # 重置奖池和彩票
         # 全额保留奖池，扣除已发放奖金，并添加基础奖金
-        self.lottery_pool = self.lottery_pool - total_payout + 1000
+        self.lottery_pool = self.lottery_pool - total_payout + LOTTERY_DRAW_BONUS
         self.lottery_tickets = {}
+        self.lottery_index = LotteryIndex()
         self.last_lottery_draw = time.time()
 
         return {
             "numbers": winning_numbers,
             "winners": winners,
+            "per_winner": per_winner,
+            "payouts": dict(payouts),
             "prizes": prize_amounts,
             "total_payout": total_payout
         }
 
     def _send_lottery_result(self, event: AstrMessageEvent, result: dict):
-        """发送开奖结果通知"""
-        logger.info("正在发送开奖结果...")
-        logger.info(result)
+        """生成开奖结果通知（奖金已在 draw_lottery 中按玩家汇总发放）"""
+        logger.info(f"正在发送开奖结果: {result['numbers']}，"
+                    f"中奖 {sum(map(len, result['winners'].values()))} 注，派奖 {result['total_payout']} 金币")
 
         # 格式化中奖号码
         main_numbers = " ".join(map(str, result['numbers'][:5]))
         special_numbers = " ".join(map(str, result['numbers'][5:]))
         winning_numbers = f"主区: {main_numbers} | 特码: {special_numbers}"
 
-        # 构建中奖信息
+        # 各奖项的中奖注数与每注奖金
         winner_info = []
-        prize_levels = ["一等奖", "二等奖", "三等奖", "四等奖", "五等奖",
-                        "六等奖", "七等奖", "八等奖", "九等奖"]
-
         # 用于存储五等奖以上的详细票信息
         high_prize_tickets = []
 
-        for level in prize_levels:
-            if result["winners"][level]:
-                winners = []
-                for user_id, ticket in result["winners"][level]:
+        for level in LOTTERY_PRIZE_LEVELS:
+            level_winners = result["winners"][level]
+            if not level_winners:
+                continue
+            prize = result["per_winner"][level]
+            winner_info.append(f"★{level}★ {len(level_winners)}注，每注 {prize}金币")
+
+            # 如果是五等奖及以上，记录详细信息
+            if level in ["一等奖", "二等奖", "三等奖", "四等奖", "五等奖"]:
+                for user_id, ticket in level_winners:
                     player = self.players.get(user_id)
                     if player:
-                        # 计算个人奖金（平分该奖项总奖金）
-                        prize = result["prizes"][level] // len(result["winners"][level])
-                        player.add_gold(prize)
-
-                        # 格式化号码
+                        ticket = decode_lottery_ticket(ticket)
                         ticket_main = " ".join(map(str, ticket[:5]))
                         ticket_special = " ".join(map(str, ticket[5:]))
-                        ticket_str = f"{ticket_main} + {ticket_special}"
-
-                        winners.append(f"{player.user_name} [{ticket_str}] (+{prize}金币)")
-
-                        # 如果是五等奖及以上，记录详细信息
-                        if level in ["一等奖", "二等奖", "三等奖", "四等奖", "五等奖"]:
-                            high_prize_tickets.append(
-                                f"{player.user_name} [{ticket_str}] - {level} (+{prize}金币)"
-                            )
-
-                if winners:
-                    # 添加奖项标题和获奖者
-                    winner_info.append(f"★{level}★")
-                    winner_info.extend(winners)
-                    winner_info.append("")  # 空行分隔
+                        high_prize_tickets.append(
+                            f"{player.user_name} [{ticket_main} + {ticket_special}] - {level} (+{prize}金币)"
+                        )
 
-        if not any(result["winners"].values()):
+        if not winner_info:
             winner_info.append("本期无人中奖，奖池将累积至下期")
 
         # 构建最终消息
@@ -2100,13 +4122,15 @@ class GameWorld:
                 "══════ 斗气彩开奖结果 ══════\n"
                 f"🎯 中奖号码: {winning_numbers}\n"
                 f"💰 奖池总额: {sum(result['prizes'].values()):,}金币\n"
+                "\n" +
+                "\n".join(winner_info) +
                 "\n"
         )
 
         # 如果有五等奖以上的中奖票，添加详细信息
         if high_prize_tickets:
             message += (
-                    "\n\n🎫 五等奖及以上详细票信息:\n" +
+                    "\n🎫 五等奖及以上详细票信息:\n" +
                     "\n".join(high_prize_tickets) +
                     "\n"
             )
@@ -2128,22 +4152,26 @@ class GameWorld:
             "last_market_refresh": self.last_market_refresh,
             "world_events": self.world_events,
             "last_event_update": self.last_event_update,
-            "duel_requests": self.duel_requests,
+            "duel_requests": self.duel_requests.to_dict(),
             "auction_items": self.auction_items,
             "last_auction_refresh": self.last_auction_refresh,
             "auction_bids": self.auction_bids,
             "auction_end_time": self.auction_end_time,
+            "notify_origin": self.notify_origin,
             "lottery_pool": self.lottery_pool,
             "last_lottery_draw": self.last_lottery_draw,
-            "lottery_tickets": self.lottery_tickets,
-            "lottery_history": self.lottery_history,
+            "lottery_tickets": {uid: pack_lottery_tickets(t) for uid, t in self.lottery_tickets.items()},
+            "lottery_recent": list(self.lottery_history),
             "lottery_end_time": self.lottery_end_time,
             "supreme_ruler": self.supreme_ruler,
             "world_boss_alive": self.world_boss_alive,
             "world_boss_hp": self.world_boss_hp,
             "world_boss_max_hp": self.world_boss_max_hp,
-            "trade_requests": self.trade_requests,
+            "trade_requests": self.trade_requests.to_dict(),
             "next_trade_id": self.next_trade_id,
+            "orders": [order for book in self.order_books.values() for order in book.orders.values()],
+            "next_order_id": self.next_order_id,
+            "dungeons": self.dungeons.to_dict(),
         }
 
     @classmethod
@@ -2155,19 +4183,38 @@ class GameWorld:
         world.last_market_refresh = data["last_market_refresh"]
         world.world_events = data["world_events"]
         world.last_event_update = data["last_event_update"]
-        world.duel_requests = data.get("duel_requests", {})
+        duel_requests = {
+            # 旧存档格式为 {挑战者ID: 目标ID}
+            challenger_id: request if isinstance(request, dict) else {
+                "challenger_id": challenger_id,
+                "target_id": request,
+            }
+            for challenger_id, request in data.get("duel_requests", {}).items()
+        }
+        world.duel_requests = RequestStore.from_dict(DUEL_REQUEST_TTL, duel_requests)
 
         # 恢复拍卖系统数据
         world.auction_items = data.get("auction_items", [])
         world.last_auction_refresh = data.get("last_auction_refresh", 0)
         world.auction_bids = data.get("auction_bids", {})
         world.auction_end_time = data.get("auction_end_time", 0)
+        world.notify_origin = data.get("notify_origin", "")
 
         # 恢复彩票系统数据
         world.lottery_pool = data.get("lottery_pool", 5000000 + 213616)
         world.last_lottery_draw = data.get("last_lottery_draw", 0)
-        world.lottery_tickets = data.get("lottery_tickets", {})
-        world.lottery_history = data.get("lottery_history", [])
+        world.lottery_tickets = {
+            uid: unpack_lottery_tickets(t) for uid, t in data.get("lottery_tickets", {}).items()
+        }
+        if LOTTERY_WINNER_LOOKUP == "index":
+            world.lottery_index = LotteryIndex.from_tickets(world.lottery_tickets)
+        if "lottery_recent" in data:
+            world.lottery_history = deque(data["lottery_recent"], maxlen=LOTTERY_HISTORY_SIZE)
+        else:
+            # 旧存档把全部开奖记录存在 lottery_history 中，全部转入归档
+            legacy_history = data.get("lottery_history", [])
+            world.lottery_history = deque(legacy_history, maxlen=LOTTERY_HISTORY_SIZE)
+            world.lottery_archive_pending = list(legacy_history)
         world.lottery_end_time = data.get("lottery_end_time", 0)
 
         # 恢复至高主宰数据
@@ -2179,9 +4226,16 @@ class GameWorld:
         world.world_boss_max_hp = data.get("world_boss_max_hp", 1000000000)
 
         # 恢复交易系统数据
-        world.trade_requests = data.get("trade_requests", {})
+        world.trade_requests = RequestStore.from_dict(TRADE_REQUEST_TTL, data.get("trade_requests", {}))
         world.next_trade_id = data.get("next_trade_id", 1)
 
+        # 恢复挂单簿（按序号重新入堆，保持时间优先）
+        for order in sorted(data.get("orders", []), key=lambda o: o["seq"]):
+            world.order_books.setdefault(order["item_name"], OrderBook(order["item_name"])).add(order)
+        world.next_order_id = data.get("next_order_id", 1)
+
+        world.dungeons = DungeonManager.from_dict(data.get("dungeons", {}))
+
         return world
 
 class PillSystem:
@@ -2190,10 +4244,7 @@ class PillSystem:
     @staticmethod
     def get_pill_by_name(name: str) -> Optional[Dict]:
         """根据名称获取丹药数据"""
-        for pill in PILLS_DATA:
-            if pill["name"] == name:
-                return pill
-        return None
+        return PILLS_BY_NAME.get(name)
 
     @staticmethod
     def get_pill_by_id(pill_id: str) -> Optional[Dict]:
@@ -2393,11 +4444,394 @@ class PillSystem:
         return PillSystem.list_all_pills(page=1)
 
 
+def roll_dungeon_rewards(level: str, rng: random.Random = random) -> Tuple[float, Dict[str, int]]:
+    """按副本等级掷一次胜利奖励：(金币, {物品名: 数量})"""
+    dungeon_info = DUNGEON_LEVELS[level]
+
+    # 基础金币奖励
+    gold_min, gold_max = dungeon_info["gold_range"]
+    gold_reward = rng.randint(gold_min, gold_max) * dungeon_info["reward_factor"]
+
+    # 收集实际掉落的物品
+    dropped_items = {}
+    for item in dungeon_info["drop_items"]:
+        if rng.random() < item["probability"]:
+            quantity = item["quantity"] if isinstance(item["quantity"], int) else rng.randint(*item["quantity"])
+            if item["name"] in dropped_items:
+                dropped_items[item["name"]] += quantity
+            else:
+                dropped_items[item["name"]] = quantity
+    return gold_reward, dropped_items
+
+
+def simulate_dungeon_battle(powers: List[float], boss_power: float, rng: random.Random,
+                            modifiers: List[Tuple[float, float, float]] = None) -> Tuple[bool, int, List[float]]:
+    """回合制副本战斗，返回 (是否胜利, 回合数, 每名玩家造成的伤害)
+
+    每回合存活玩家按随机顺序出手（伤害按 DUNGEON_DAMAGE_SPREAD 浮动，有暴击），随后 BOSS 对全体
+    存活玩家造成群体伤害；BOSS 生命归零即胜利，全员倒下或超过 DUNGEON_MAX_ROUNDS 回合
+    即失败。modifiers 为每名玩家的 (攻击倍率, 防御倍率, 濒危攻击倍率)。
+    只用传入的 rng 取随机数，相同种子必然得到相同战斗过程；参数都是普通数值，
+    批量平衡测试可以不构造 Player 直接调用。
+    """
+    n = len(powers)
+    modifiers = modifiers or [(1.0, 1.0, 1.0)] * n
+    boss_hp = boss_power * DUNGEON_BOSS_HP_FACTOR
+    boss_attack = boss_power * DUNGEON_BOSS_ATTACK_FACTOR
+    max_hp = [power * DUNGEON_PLAYER_HP_FACTOR for power in powers]
+    hp = list(max_hp)
+    damage = [0.0] * n
+    alive = [i for i in range(n) if powers[i] > 0]
+    uniform = rng.uniform
+    chance = rng.random
+
+    for round_no in range(1, DUNGEON_MAX_ROUNDS + 1):
+        # 出手顺序每回合重新洗牌：最后一击被截断到 BOSS 剩余生命，固定顺序会让排在前面的人分得更多奖励
+        order = alive[:]
+        rng.shuffle(order)
+        for i in order:
+            attack, _, desperate = modifiers[i]
+            if hp[i] < max_hp[i] * DUNGEON_DESPERATE_HP:
+                attack *= desperate
+            hit = powers[i] * attack * uniform(1 - DUNGEON_DAMAGE_SPREAD, 1 + DUNGEON_DAMAGE_SPREAD)
+            if chance() < DUNGEON_CRIT_RATE:
+                hit *= 2
+            hit = min(hit, boss_hp)
+            damage[i] += hit
+            boss_hp -= hit
+            if boss_hp <= 0:
+                return True, round_no, damage
+        if not alive:
+            break
+        # 群体攻击按最大生命比例分摊：同等防御下全队同时见底，胜负只取决于总战力
+        ratio = boss_attack * uniform(1 - DUNGEON_DAMAGE_SPREAD, 1 + DUNGEON_DAMAGE_SPREAD) / sum(max_hp[i] for i in alive)
+        for i in alive:
+            hp[i] -= max_hp[i] * ratio / modifiers[i][1]
+        alive = [i for i in alive if hp[i] > 0]
+        if not alive:
+            return False, round_no, damage
+    return False, DUNGEON_MAX_ROUNDS, damage
+
+
+def split_by_contribution(total: int, weights: List[float]) -> List[int]:
+    """按权重把整数 total 分给每个人（最大余数法），总和恰好等于 total"""
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        weights = [1.0] * len(weights)
+        weight_sum = float(len(weights))
+    exact = [total * w / weight_sum for w in weights]
+    shares = [int(x) for x in exact]
+    leftover = total - sum(shares)
+    for i in sorted(range(len(weights)), key=lambda i: shares[i] - exact[i])[:leftover]:
+        shares[i] += 1
+    return shares
+
+
+@lru_cache(maxsize=512)
+def dungeon_battle_win_rate(ratio_bucket: int, team_size: int = 1) -> float:
+    """某个战力比分桶下 team_size 人队伍的 simulate_dungeon_battle 胜率（固定种子，结果可复现）
+
+    伤害浮动、暴击和濒危加成都按人结算，人数越多结果越集中于期望值，同一战力比下
+    多人队伍的胜率高于单人，因此按 (分桶, 人数) 分别模拟，队伍战力在队员间平分。
+    """
+    rng = random.Random(ratio_bucket * 64 + team_size)
+    ratio = (ratio_bucket + 0.5) * DUNGEON_FORECAST_BUCKET
+    powers = [ratio / team_size] * team_size
+    wins = sum(simulate_dungeon_battle(powers, 1.0, rng)[0] for _ in range(DUNGEON_WIN_RATE_SAMPLES))
+    return wins / DUNGEON_WIN_RATE_SAMPLES
+
+
+@lru_cache(maxsize=2048)
+def forecast_dungeon(level: str, ratio_bucket: int, team_size: int = 1) -> Dict[str, Any]:
+    """蒙特卡洛估计某个战力比分桶下的胜率与期望收益，按 (等级, 分桶, 人数) 缓存
+
+    胜率取 dungeon_battle_win_rate，胜利时按 roll_dungeon_rewards 同样的掉落表掷奖励
+    （奖励按贡献分配，全队平均每人恰为一份）。安装了 NumPy 时整批向量化，
+    否则逐次调用 roll_dungeon_rewards。
+    """
+    dungeon_info = DUNGEON_LEVELS[level]
+    win_rate = dungeon_battle_win_rate(ratio_bucket, team_size)
+    expected_drops: Dict[str, float] = {}
+
+    if np is not None:
+        n = DUNGEON_FORECAST_SAMPLES
+        wins = _np_rng.random(n) < win_rate
+        win_count = int(wins.sum())
+        gold_min, gold_max = dungeon_info["gold_range"]
+        gold = _np_rng.integers(gold_min, gold_max + 1, win_count) * dungeon_info["reward_factor"]
+        total_gold = float(gold.sum())
+        for item in dungeon_info["drop_items"]:
+            hits = _np_rng.random(win_count) < item["probability"]
+            if isinstance(item["quantity"], int):
+                total = int(hits.sum()) * item["quantity"]
+            else:
+                low, high = item["quantity"]
+                total = int(_np_rng.integers(low, high + 1, win_count)[hits].sum())
+            expected_drops[item["name"]] = expected_drops.get(item["name"], 0) + total / n
+    else:
+        n = max(1, DUNGEON_FORECAST_SAMPLES // 4)
+        win_count = 0
+        total_gold = 0.0
+        for _ in range(n):
+            if random.random() < win_rate:
+                win_count += 1
+                gold, dropped = roll_dungeon_rewards(level)
+                total_gold += gold
+                for name, quantity in dropped.items():
+                    expected_drops[name] = expected_drops.get(name, 0) + quantity
+        expected_drops = {name: total / n for name, total in expected_drops.items()}
+
+    return {
+        "win_rate": win_count / n,
+        "expected_gold": total_gold / n,
+        "expected_drops": expected_drops,
+        "samples": n,
+    }
+
+
+def dungeon_forecast_bucket(total_power: float, boss_power: float) -> int:
+    """战力比所在的分桶；战力比超过 3 之后胜率已接近 100%，统一归入最后一个桶"""
+    ratio = total_power / boss_power
+    return min(int(ratio / DUNGEON_FORECAST_BUCKET), int(3 / DUNGEON_FORECAST_BUCKET))
+
+
+class MatchQueue:
+    """某个副本等级的匹配队列
+
+    排队玩家按入队时的战力分桶：桶号为战力整数部分的二进制位数，即第 b 个桶
+    容纳 [2^(b-1), 2^b) 的战力。每个桶内按入队顺序排列，非空桶号保存在有序列表中，
+    组队时用二分查找直接定位“单人即可补足剩余战力”的最小桶，找不到时从最强的桶
+    取人继续补足。队伍最多 DUNGEON_MATCH_TEAM_SIZE 人，每步都是 O(log 桶数)。
+    已离开游戏的玩家在组队时被选中才出队（惰性清除），记入 departed 由调用方取走。
+    """
+
+    def __init__(self, level: str):
+        self.level = level
+        self.buckets: Dict[int, Dict[str, float]] = {}  # 桶号 -> {player_id: 战力}（按入队顺序）
+        self._keys: List[int] = []  # 非空桶号，升序
+        self.members: Dict[str, int] = {}  # player_id -> 桶号
+        self.departed: List[str] = []  # 组队时发现已离开游戏、被移出队列的玩家
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, player_id: str) -> bool:
+        return player_id in self.members
+
+    @staticmethod
+    def bucket_of(power: float) -> int:
+        return int(max(power, 0)).bit_length()
+
+    def add(self, player_id: str, power: float) -> None:
+        self.remove(player_id)
+        bucket = self.bucket_of(power)
+        if bucket not in self.buckets:
+            self.buckets[bucket] = {}
+            bisect.insort(self._keys, bucket)
+        self.buckets[bucket][player_id] = power
+        self.members[player_id] = bucket
+
+    def remove(self, player_id: str) -> bool:
+        bucket = self.members.pop(player_id, None)
+        if bucket is None:
+            return False
+        entries = self.buckets[bucket]
+        del entries[player_id]
+        if not entries:
+            del self.buckets[bucket]
+            del self._keys[bisect.bisect_left(self._keys, bucket)]
+        return True
+
+    def _first(self, bucket: int, taken: set, present: Optional[Callable[[str], bool]]) -> Optional[Tuple[str, float]]:
+        pick = None
+        gone = []
+        for player_id, power in self.buckets.get(bucket, {}).items():
+            if player_id in taken:
+                continue
+            if present is not None and not present(player_id):
+                gone.append(player_id)
+                continue
+            pick = (player_id, power)
+            break
+        for player_id in gone:
+            self.remove(player_id)
+            self.departed.append(player_id)
+        return pick
+
+    def match(self, player_id: str, target_power: float,
+              present: Optional[Callable[[str], bool]] = None) -> Optional[List[str]]:
+        """以 player_id 为核心组队，队伍总战力达到 target_power 时取出并返回队员，否则返回 None
+
+        present(player_id) 为假的候选人视为已离开游戏，移出队列并记入 departed。
+        """
+        if player_id not in self.members:
+            return None
+        team = [player_id]
+        taken = {player_id}
+        need = target_power - self.buckets[self.members[player_id]][player_id]
+        while need > 0 and len(team) < DUNGEON_MATCH_TEAM_SIZE:
+            # 桶号大于 need 所在桶的玩家战力必然 ≥ need，单人即可补足
+            pick = None
+            start = bisect.bisect_right(self._keys, self.bucket_of(need))
+            for bucket in self._keys[start:start + DUNGEON_MATCH_TEAM_SIZE]:
+                pick = self._first(bucket, taken, present)
+                if pick:
+                    break
+            if pick is None:
+                # 没有人能单独补足，取最强的人继续凑
+                for bucket in reversed(self._keys[-DUNGEON_MATCH_TEAM_SIZE:]):
+                    pick = self._first(bucket, taken, present)
+                    if pick:
+                        break
+            if pick is None:
+                break
+            team.append(pick[0])
+            taken.add(pick[0])
+            need -= pick[1]
+        if need > 0:
+            return None
+        for member in team:
+            self.remove(member)
+        return team
+
+    def to_list(self) -> List[List[Any]]:
+        return [[pid, power] for bucket in self._keys for pid, power in self.buckets[bucket].items()]
+
+
 class DungeonManager:
+    """单个世界的副本队伍（大厅）
+
+    队伍只记录玩家ID，随世界存档；组建后迟迟不开始的队伍在 DUNGEON_LOBBY_TTL 秒后
+    由 TimerWheel 过期清除。player_lobby 记录每名玩家所在的队伍，O(1) 查询，
+    同一玩家同时只能在一个队伍中。
+
+    另有按副本等级划分的匹配队列（MatchQueue）：入队时即尝试组队，凑够战力的队伍
+    跳过确认流程直接开战；排队超过 DUNGEON_LOBBY_TTL 秒的玩家自动出队。
+    排队与组队互斥。
+    """
+
     def __init__(self):
-        self.active_dungeons = {}  # {dungeon_id: DungeonInstance}
+        # {dungeon_id: {'dungeon_id', 'level', 'player_ids', 'creator_id', 'create_time', 'expire_at', 'pending'}}
+        self.lobbies: Dict[str, Dict[str, Any]] = {}
+        self.player_lobby: Dict[str, str] = {}  # player_id -> dungeon_id
         self.next_dungeon_id = 1
-        self.pending_confirmations = {}  # {dungeon_id: set(player_ids)}
+        self._expiry = TimerWheel()
+        self.queues: Dict[str, MatchQueue] = {}  # level -> 匹配队列
+        self.player_queue: Dict[str, str] = {}  # player_id -> level
+        self._queue_expiry = TimerWheel()
+
+    def __len__(self):
+        return len(self.lobbies)
+
+    def _open(self, lobby: Dict[str, Any]) -> None:
+        self.lobbies[lobby["dungeon_id"]] = lobby
+        for pid in lobby["player_ids"]:
+            self.player_lobby[pid] = lobby["dungeon_id"]
+        self._expiry.schedule(lobby["dungeon_id"], lobby["expire_at"])
+
+    def _close(self, dungeon_id: str) -> Optional[Dict[str, Any]]:
+        lobby = self.lobbies.pop(dungeon_id, None)
+        if lobby is not None:
+            for pid in lobby["player_ids"]:
+                if self.player_lobby.get(pid) == dungeon_id:
+                    del self.player_lobby[pid]
+            self._expiry.cancel(dungeon_id)
+        return lobby
+
+    def sweep(self, now: float = None) -> List[Dict[str, Any]]:
+        """解散所有已过期的队伍，返回被解散的队伍"""
+        now = time.time() if now is None else now
+        return [self._close(dungeon_id) for dungeon_id in self._expiry.pop_due(now)]
+
+    def sweep_queues(self, now: float = None) -> List[str]:
+        """移出所有排队超时的玩家，返回其ID"""
+        now = time.time() if now is None else now
+        expired = self._queue_expiry.pop_due(now)
+        for player_id in expired:
+            self._leave_queue(player_id)
+        return expired
+
+    def _join_queue(self, level: str, player_id: str, power: float, expire_at: float) -> None:
+        self.queues.setdefault(level, MatchQueue(level)).add(player_id, power)
+        self.player_queue[player_id] = level
+        self._queue_expiry.schedule(player_id, expire_at)
+
+    def _leave_queue(self, player_id: str) -> Optional[str]:
+        level = self.player_queue.pop(player_id, None)
+        if level is not None:
+            self.queues[level].remove(player_id)
+            self._queue_expiry.cancel(player_id)
+        return level
+
+    def queue_of(self, player_id: str) -> Optional[str]:
+        """玩家当前排队的副本等级"""
+        self.sweep_queues()
+        return self.player_queue.get(player_id)
+
+    def enqueue(self, world: GameWorld, level: str, player_id: str) -> Tuple[bool, str]:
+        """加入匹配队列并尝试组队；组队成功时直接开战，返回 (是否开战, 消息)"""
+        if level not in DUNGEON_LEVELS:
+            return False, f"无效的副本等级: {level}"
+        player = world.players.get(player_id)
+        if player is None:
+            return False, "你还没有加入游戏，请输入 /dp_join 加入游戏！"
+        lobby = self.lobby_of(player_id)
+        if lobby:
+            return False, f"你已在副本队伍 {lobby['dungeon_id']} 中，无法排队"
+
+        self.sweep_queues()
+        previous = self._leave_queue(player_id)
+        self._join_queue(level, player_id, player.battle_power(), time.time() + DUNGEON_LOBBY_TTL)
+        queue = self.queues[level]
+        boss_power = DUNGEON_LEVELS[level]["boss_power"]
+        # 队友自排队后可能已离开游戏：组队时跳过并移出队列
+        team = queue.match(player_id, boss_power * DUNGEON_MATCH_TARGET_RATIO, world.players.__contains__)
+        for pid in queue.departed:
+            self.player_queue.pop(pid, None)
+            self._queue_expiry.cancel(pid)
+        queue.departed.clear()
+        if team is None:
+            switched = f"（已从【{previous}】队列转入）" if previous and previous != level else ""
+            return False, (
+                f"已加入【{level}】匹配队列{switched}，当前排队 {len(queue)} 人\n"
+                f"凑够战力后将自动组队开战，输入 /取消匹配 退出排队"
+            )
+
+        for pid in team:
+            del self.player_queue[pid]
+            self._queue_expiry.cancel(pid)
+        dungeon_id = f"dungeon-{self.next_dungeon_id}"
+        self.next_dungeon_id += 1
+        dungeon = DungeonInstance(
+            dungeon_id=dungeon_id,
+            level=level,
+            players=[world.players[pid] for pid in team],
+            boss_power=boss_power,
+            creator_id=player_id
+        )
+        header = (
+            f"=== 匹配成功 ===\n"
+            f"副本等级: {level}\n"
+            f"队员: {', '.join(p.user_name for p in dungeon.players)}\n"
+            f"队伍总战力: {int(dungeon.total_power):,} / BOSS战力: {boss_power:,}\n\n"
+        )
+        _, result = dungeon.run_battle()
+        return True, header + result
+
+    def cancel_queue(self, player_id: str) -> Optional[str]:
+        """退出匹配队列，返回原排队的副本等级"""
+        self.sweep_queues()
+        return self._leave_queue(player_id)
+
+    def get(self, dungeon_id: str) -> Optional[Dict[str, Any]]:
+        self.sweep()
+        return self.lobbies.get(dungeon_id)
+
+    def lobby_of(self, player_id: str) -> Optional[Dict[str, Any]]:
+        """玩家当前所在的队伍"""
+        self.sweep()
+        dungeon_id = self.player_lobby.get(player_id)
+        return self.lobbies.get(dungeon_id) if dungeon_id else None
 
     def create_dungeon(self, world: GameWorld, level: str, player_ids: List[str]) -> str:
         """创建新副本"""
@@ -2411,6 +4845,14 @@ class DungeonManager:
         if len(players) > 5:
             return "副本最多支持5名玩家"
 
+        for player in players:
+            lobby = self.lobby_of(player.user_id)
+            if lobby:
+                return f"{player.user_name} 已在副本队伍 {lobby['dungeon_id']} 中，无法加入新的队伍"
+            queued = self.queue_of(player.user_id)
+            if queued:
+                return f"{player.user_name} 正在【{queued}】匹配队列中，请先 /取消匹配"
+
         dungeon_id = f"dungeon-{self.next_dungeon_id}"
         self.next_dungeon_id += 1
 
@@ -2419,11 +4861,20 @@ class DungeonManager:
             level=level,
             players=players,
             boss_power=DUNGEON_LEVELS[level]["boss_power"],
-            creator_id=player_ids[0]  # 第一个玩家是发起者
+            creator_id=players[0].user_id  # 第一个玩家是发起者
         )
-        self.active_dungeons[dungeon_id] = dungeon
-        # 初始化确认集合，包含所有玩家ID
-        self.pending_confirmations[dungeon_id] = set(player_ids)
+        now = time.time()
+        # 确认名单包含所有玩家ID
+        member_ids = [p.user_id for p in players]
+        self._open({
+            "dungeon_id": dungeon_id,
+            "level": level,
+            "player_ids": member_ids,
+            "creator_id": dungeon.creator_id,
+            "create_time": now,
+            "expire_at": now + DUNGEON_LOBBY_TTL,
+            "pending": list(member_ids),
+        })
 
         # 生成奖励预览
         dungeon_info = DUNGEON_LEVELS[level]
@@ -2447,48 +4898,85 @@ class DungeonManager:
             f"奖励倍率: {dungeon_info['reward_factor']}x\n\n"
             f"副本ID: {dungeon_id}\n"
             f"所有队员需输入 /接受副本 {dungeon_id} 确认准备就绪\n"
-            f"当所有队员确认后，发起者可输入 /开始副本 {dungeon_id} 开始挑战"
+            f"当所有队员确认后，发起者可输入 /开始副本 {dungeon_id} 开始挑战\n"
+            f"队伍 {DUNGEON_LOBBY_TTL // 60} 分钟内未开始将自动解散"
         )
 
     def confirm_dungeon(self, dungeon_id: str, player_id: str) -> str:
         """玩家确认准备就绪"""
-        if dungeon_id not in self.active_dungeons:
-            return "无效的副本ID"
+        lobby = self.get(dungeon_id)
+        if lobby is None:
+            return "无效的副本ID（队伍可能已过期解散）"
+
+        if player_id not in lobby["player_ids"]:
+            return "你不是该副本的参与者"
 
-        if dungeon_id not in self.pending_confirmations:
+        if not lobby["pending"]:
             return "该副本已准备好，等待发起者开始"
 
-        if player_id not in self.pending_confirmations[dungeon_id]:
-            return "你不是该副本的参与者"
+        if player_id not in lobby["pending"]:
+            return "你已确认过了，等待其他队员确认"
 
-        self.pending_confirmations[dungeon_id].remove(player_id)
-        remaining = len(self.pending_confirmations[dungeon_id])
+        lobby["pending"].remove(player_id)
+        remaining = len(lobby["pending"])
 
         if remaining == 0:
-            del self.pending_confirmations[dungeon_id]
             return f"所有队员已确认！发起者现在可以输入 /开始副本 {dungeon_id} 开始挑战"
         else:
             return f"已确认准备就绪，还剩下 {remaining} 位队员需要确认"
 
-    def start_dungeon(self, dungeon_id: str, player_id: str) -> Tuple[bool, str]:
+    def start_dungeon(self, world: GameWorld, dungeon_id: str, player_id: str) -> Tuple[bool, str]:
         """开始副本挑战并返回结果"""
-        if dungeon_id not in self.active_dungeons:
-            return False, "无效的副本ID"
-
-        dungeon = self.active_dungeons[dungeon_id]
+        lobby = self.get(dungeon_id)
+        if lobby is None:
+            return False, "无效的副本ID（队伍可能已过期解散）"
 
         # 检查是否是发起者
-        if player_id != dungeon.creator_id:
+        if player_id != lobby["creator_id"]:
             return False, "只有副本发起者可以开始挑战"
 
         # 检查是否所有玩家都已确认
-        if dungeon_id in self.pending_confirmations:
-            remaining = len(self.pending_confirmations[dungeon_id])
+        if lobby["pending"]:
+            remaining = len(lobby["pending"])
             return False, f"还有 {remaining} 位队员未确认，无法开始挑战"
 
-        dungeon = self.active_dungeons.pop(dungeon_id)
+        self._close(dungeon_id)
+        players = [world.players[pid] for pid in lobby["player_ids"] if pid in world.players]
+        if not players:
+            return False, "队伍中已没有有效的玩家"
+        dungeon = DungeonInstance(
+            dungeon_id=dungeon_id,
+            level=lobby["level"],
+            players=players,
+            boss_power=DUNGEON_LEVELS[lobby["level"]]["boss_power"],
+            creator_id=lobby["creator_id"]
+        )
         return dungeon.run_battle()
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "lobbies": list(self.lobbies.values()),
+            "next_dungeon_id": self.next_dungeon_id,
+            "queues": {
+                level: [[pid, power, self._queue_expiry.deadline(pid)] for pid, power in queue.to_list()]
+                for level, queue in self.queues.items() if queue
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DungeonManager":
+        manager = cls()
+        manager.next_dungeon_id = data.get("next_dungeon_id", 1)
+        for lobby in data.get("lobbies", []):
+            manager._open(lobby)
+        for level, entries in data.get("queues", {}).items():
+            if level in DUNGEON_LEVELS:
+                for pid, power, expire_at in entries:
+                    manager._join_queue(level, pid, power, expire_at)
+        manager.sweep()
+        manager.sweep_queues()
+        return manager
+
 
 class DungeonInstance:
     def __init__(self, dungeon_id: str, level: str, players: List[Player], boss_power: int, creator_id: str):
@@ -2501,126 +4989,715 @@ class DungeonInstance:
 
     @property
     def total_power(self) -> int:
-        """计算队伍总战力"""
-        return sum(p.power for p in self.players)
-
-    def run_battle(self) -> Tuple[bool, str]:
-        """执行副本战斗逻辑"""
-        # 计算胜率 (队伍战力/(队伍战力+boss战力))
-        power_ratio = self.total_power / self.boss_power
-        # ✅ 核心改动：平移 Sigmoid，让 ratio=0.7 时胜率=50%
-        # 目标：ratio=1.0 时胜率≈80%
-        center_point = 0.7  # 在这里，胜率是50%
-        steepness = 5.0  # 控制曲线陡峭度
-        base_probability = 1 / (1 + math.exp(-steepness * (power_ratio - center_point)))
-        # 小幅随机扰动 ±5%
-        random_effect = random.uniform(-0.05, 0.05)
-        final_probability = max(0.0, min(1.0, base_probability + random_effect))
-        victory = random.random() < final_probability
+        """计算队伍总战力（副本战斗中的等效战力，见 Player.battle_power）"""
+        return sum(p.battle_power() for p in self.players)
+
+    def run_battle(self, seed: int = None) -> Tuple[bool, str]:
+        """执行回合制副本战斗并结算；给定 seed 时战斗过程与掉落完全可复现"""
+        self.seed = random.getrandbits(32) if seed is None else seed
+        rng = random.Random(self.seed)
+        now = time.time()
+        victory, self.rounds, self.damage = simulate_dungeon_battle(
+            [p.base_power for p in self.players],
+            self.boss_power,
+            rng,
+            [p.battle_modifiers(now) for p in self.players],
+        )
         if victory:
-            gold_reward, dropped_items = self._distribute_rewards()
+            rewards = self._distribute_rewards(rng)
         else:
-            gold_reward, dropped_items = None, None
-        result_msg = self._generate_result_message(victory,gold_reward,dropped_items)
+            rewards = None
+        result_msg = self._generate_result_message(victory, rewards)
 
         return victory, result_msg
 
-    def _generate_result_message(self, victory: bool,gold_reward=None,dropped_items=None) -> str:
+    def _contribution_lines(self) -> List[str]:
+        total = sum(self.damage) or 1
+        return [
+            f"- {player.user_name}: 伤害 {int(damage):,}（{damage / total:.0%}）"
+            for player, damage in zip(self.players, self.damage)
+        ]
+
+    def _generate_result_message(self, victory: bool, rewards=None) -> str:
         """生成战斗结果消息"""
-        dungeon_info = DUNGEON_LEVELS[self.level]
         player_names = ", ".join(p.user_name for p in self.players)
+        header = (
+            f"副本等级: {self.level}\n"
+            f"参与玩家: {player_names}\n"
+            f"BOSS战力: {self.boss_power:,}\n"
+            f"队伍总战力: {int(self.total_power):,}\n"
+        )
 
         if victory:
             # 生成奖励详情
-            reward_details = [f"金币: {int(gold_reward):,}"]
-            if dropped_items:
-                reward_details.append("\n掉落物品:")
-                for item_name, quantity in dropped_items.items():
-                    reward_details.append(f"- {item_name} ×{quantity}")
-            else:
-                reward_details.append("\n(本次未掉落物品)")
-
+            reward_details = []
+            for player, (gold, items) in zip(self.players, rewards):
+                line = f"- {player.user_name}: 金币 {gold:,}"
+                if items:
+                    line += "，" + "、".join(f"{name}×{quantity}" for name, quantity in items.items())
+                reward_details.append(line)
             reward_info = "\n".join(reward_details)
 
             return (
                 f"=== 副本挑战成功 ===\n"
-                f"副本等级: {self.level}\n"
-                f"参与玩家: {player_names}\n"
-                f"BOSS战力: {self.boss_power:,}\n"
-                f"队伍总战力: {self.total_power:,}\n"
-                f"经过激烈战斗，你们成功击败了BOSS！\n\n"
-                f"=== 获得奖励 ===\n"
-                f"{reward_info}"
+                f"{header}"
+                f"经过 {self.rounds} 回合激烈战斗，你们成功击败了BOSS！\n\n"
+                f"=== 战斗贡献 ===\n"
+                + "\n".join(self._contribution_lines()) + "\n\n"
+                f"=== 获得奖励（按贡献分配）===\n"
+                f"{reward_info}\n"
+                f"战斗编号: {self.seed}"
             )
         else:
             # 失败惩罚
             damage_per_player = int(self.boss_power * 0.2 / len(self.players))
             for player in self.players:
                 player.take_damage(damage_per_player)
+            outcome = "全队倒下" if self.rounds < DUNGEON_MAX_ROUNDS else f"{DUNGEON_MAX_ROUNDS} 回合内未能击败BOSS"
             return (
                 f"=== 副本挑战失败 ===\n"
-                f"副本等级: {self.level}\n"
-                f"参与玩家: {player_names}\n"
-                f"BOSS战力: {self.boss_power:,}\n"
-                f"队伍总战力: {self.total_power:,}\n"
-                f"BOSS的实力远超想象，队伍不敌败退！\n"
+                f"{header}"
+                f"BOSS的实力远超想象，{outcome}，队伍不敌败退！\n\n"
+                f"=== 战斗贡献 ===\n"
+                + "\n".join(self._contribution_lines()) + "\n"
                 f"每位玩家损失了{damage_per_player}点生命值"
             )
 
-    def _distribute_rewards(self):
-        """分配副本奖励并返回实际掉落的物品"""
-        dungeon_info = DUNGEON_LEVELS[self.level]
+    def _distribute_rewards(self, rng: random.Random) -> List[Tuple[int, Dict[str, int]]]:
+        """按伤害贡献分配全队奖励，返回每名玩家实际获得的 (金币, {物品名: 数量})
 
-        # 基础金币奖励
-        gold_min, gold_max = dungeon_info["gold_range"]
-        gold_reward = random.randint(gold_min, gold_max) * dungeon_info["reward_factor"]
+        奖励池为每人一份掉落之和（金币与物品数量 × 队伍人数），按伤害占比用最大余数法
+        拆分；每名玩家的物品一次性批量放入背包。
+        """
+        size = len(self.players)
+        gold_reward, dropped_items = roll_dungeon_rewards(self.level, rng)
+        gold_shares = split_by_contribution(int(gold_reward) * size, self.damage)
+        item_shares = {
+            name: split_by_contribution(quantity * size, self.damage)
+            for name, quantity in dropped_items.items()
+        }
+        rewards = []
+        for i, player in enumerate(self.players):
+            player.gold += gold_shares[i]
+            added = player.add_item_counts({name: shares[i] for name, shares in item_shares.items()})
+            rewards.append((gold_shares[i], added))
+        return rewards
 
-        # 收集实际掉落的物品
-        dropped_items = {}
-        for item in dungeon_info["drop_items"]:
-            if random.random() < item["probability"]:
-                quantity = item["quantity"] if isinstance(item["quantity"], int) else random.randint(*item["quantity"])
-                if item["name"] in dropped_items:
-                    dropped_items[item["name"]] += quantity
+class WorldLock:
+    """单个世界的可重入锁
+
+    同一世界的命令和定时任务按到达顺序串行执行，不同世界互不影响。同一任务重复
+    获取（如处理函数内部再调用需要加锁的方法）直接计数通过。记录获取次数、等待
+    耗时与排队深度，供 /dp_locks 查看。
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.owner: Optional[asyncio.Task] = None
+        self.depth = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.acquired = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self) -> None:
+        task = asyncio.current_task()
+        if self.owner is task and task is not None:
+            self.depth += 1
+            return
+        self.acquired += 1
+        if self._lock.locked():
+            self.contended += 1
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            started = time.perf_counter()
+            try:
+                await self._lock.acquire()
+            finally:
+                self.waiting -= 1
+            waited = time.perf_counter() - started
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        else:
+            await self._lock.acquire()
+        self.owner = task
+        self.depth = 1
+
+    def release(self) -> None:
+        self.depth -= 1
+        if self.depth == 0:
+            self.owner = None
+            self._lock.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "avg_wait": self.total_wait / self.contended if self.contended else 0.0,
+            "max_wait": self.max_wait,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+        }
+
+
+class WorldLocks:
+    """group_id -> WorldLock，按需创建"""
+
+    def __init__(self):
+        self.locks: Dict[str, WorldLock] = {}
+
+    def get(self, group_id: str) -> WorldLock:
+        lock = self.locks.get(group_id)
+        if lock is None:
+            lock = self.locks[group_id] = WorldLock()
+        return lock
+
+
+def world_serialized(handler):
+    """命令处理函数装饰器：整个处理过程（含各次 yield 之间）持有所在世界的锁
+
+    群聊命令按群号加锁；私聊命令（_s 系列）按玩家所在的世界加锁。分片模式下插件进程
+    不持有世界，命令整体转发给负责该世界的工作进程，由工作进程加锁执行。
+    被 Metrics 采样到的调用按命令和世界记录耗时（不含等锁时间，见 /dp_locks）。
+    """
+    name = handler.__name__
+
+    @wraps(handler)
+    async def wrapper(self, event: AstrMessageEvent, *args, **kwargs):
+        if self.shards is not None:
+            async for result in self.shards.dispatch(event, name, args, kwargs):
+                yield result
+            return
+        group_id = event.get_group_id() or self.player_world_map.get(event.get_sender_id(), "")
+        async with self.world_locks.get(group_id):
+            results = handler(self, event, *args, **kwargs)
+            if self.metrics.sampled():
+                results = self.metrics.timed(name, group_id, results)
+            async for result in results:
+                yield result
+    return wrapper
+
+
+# ==================== 多进程分片 ====================
+class ShardError(Exception):
+    """分片工作进程不可用，或在工作进程中执行命令失败"""
+
+
+def shard_of(group_id: str, shards: int) -> int:
+    """世界所属的分片；不能用内置 hash()，它在每个进程中的加盐不同"""
+    digest = hashlib.blake2b(group_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+class ShardEvent:
+    """转发给工作进程的消息事件快照，只保留处理函数用到的接口，可被 pickle"""
+
+    def __init__(self, message_str: str, sender_id: str, sender_name: str, group_id: str,
+                 unified_msg_origin: str):
+        self.message_str = message_str
+        self.sender_id = sender_id
+        self.sender_name = sender_name
+        self.group_id = group_id
+        self.unified_msg_origin = unified_msg_origin
+
+    @classmethod
+    def from_event(cls, event: AstrMessageEvent) -> "ShardEvent":
+        return cls(event.message_str, event.get_sender_id(), event.get_sender_name(),
+                   event.get_group_id(), event.unified_msg_origin)
+
+    def get_group_id(self) -> str:
+        return self.group_id
+
+    def get_sender_id(self) -> str:
+        return self.sender_id
+
+    def get_sender_name(self) -> str:
+        return self.sender_name
+
+    def plain_result(self, text: str) -> str:
+        # 回复文本原样送回插件进程，由真实事件的 plain_result 包装
+        return text
+
+
+class BindingMap(dict):
+    """工作进程中的 player_world_map：记录增删，随命令结果回报给插件进程用于路由私聊命令"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changes: List[Tuple[Optional[str], Optional[str]]] = []
+
+    def __setitem__(self, user_id: str, group_id: str):
+        super().__setitem__(user_id, group_id)
+        self.changes.append((user_id, group_id))
+
+    def __delitem__(self, user_id: str):
+        super().__delitem__(user_id)
+        self.changes.append((user_id, None))
+
+    def clear(self):
+        super().clear()
+        self.changes.append((None, None))
+
+    def pop_changes(self) -> List[Tuple[Optional[str], Optional[str]]]:
+        changes, self.changes = self.changes, []
+        return changes
+
+
+class PipeChannel:
+    """multiprocessing 管道的 asyncio 适配
+
+    后台线程阻塞读取，收到的消息经 call_soon_threadsafe 交给事件循环处理；发送只在
+    事件循环线程中进行。管道断开时调用 on_close。
+    """
+
+    def __init__(self, conn, on_message: Callable[[tuple], None], on_close: Callable[[], None]):
+        self.conn = conn
+        self.on_message = on_message
+        self.on_close = on_close
+        self.closed = False
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._read, args=(loop,), daemon=True).start()
+
+    def _read(self, loop: asyncio.AbstractEventLoop) -> None:
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                message = None
+            try:
+                loop.call_soon_threadsafe(self._deliver, message)
+            except RuntimeError:  # 事件循环已关闭
+                return
+            if message is None:
+                return
+
+    def _deliver(self, message: Optional[tuple]) -> None:
+        if message is not None:
+            self.on_message(message)
+        elif not self.closed:
+            self.closed = True
+            self.on_close()
+
+    def send(self, message: tuple) -> None:
+        if self.closed:
+            raise ShardError("管道已关闭")
+        try:
+            self.conn.send(message)
+        except (OSError, ValueError) as e:
+            raise ShardError(f"管道写入失败: {e}") from e
+
+
+class ShardContext:
+    """工作进程中代替 AstrBot Context：LLM 调用与主动消息都经管道交给插件进程"""
+
+    def __init__(self, send: Callable[[tuple], None]):
+        self._send = send
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+
+    def get_using_provider(self):
+        return self
+
+    def get_llm_tool_manager(self):
+        return None
+
+    async def text_chat(self, prompt: str = "", func_tool=None, system_prompt: str = "", **kwargs):
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        try:
+            self._send(("llm", call_id, prompt, system_prompt))
+            return SimpleNamespace(role="assistant", completion_text=await future)
+        finally:
+            self._calls.pop(call_id, None)
+
+    def resolve(self, call_id: int, error: Optional[str], text: str) -> None:
+        future = self._calls.get(call_id)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(text)
+        else:
+            future.set_exception(LLMUnavailable(text) if error == "unavailable" else RuntimeError(text))
+
+    async def send_message(self, origin: str, message_chain) -> bool:
+        self._send(("send", origin, message_chain))
+        return True
+
+    async def send_private_message(self, user_id: str, text: str) -> None:
+        self._send(("private", user_id, text))
+
+
+class ShardWorker:
+    """工作进程：运行一份只持有本分片世界的插件实例，执行插件进程转发来的命令"""
+
+    def __init__(self, index: int, shards: int, conn):
+        self.index = index
+        self.shards = shards
+        self.conn = conn
+        self.tasks = set()
+
+    async def serve(self) -> None:
+        self.stopped = asyncio.Event()
+        self.channel = PipeChannel(self.conn, self._on_message, self.stopped.set)
+        self.channel.start()
+        self.context = ShardContext(self.channel.send)
+        self.plugin = DouPoCangQiongFinal(self.context, shard=(self.index, self.shards))
+        self.channel.send(("ready", self.index, dict(self.plugin.player_world_map)))
+        self.plugin.player_world_map.pop_changes()
+        await self.stopped.wait()
+        for task in list(self.tasks):
+            task.cancel()
+        await self.plugin.terminate()
+
+    def _on_message(self, message: tuple) -> None:
+        kind = message[0]
+        if kind == "command":
+            task = asyncio.get_running_loop().create_task(self._run_command(*message[1:]))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif kind == "llm_result":
+            self.context.resolve(*message[1:])
+        elif kind == "stop":
+            self.stopped.set()
+
+    async def _run_command(self, request_id: int, name: str, event: ShardEvent,
+                           args: tuple, kwargs: dict) -> None:
+        try:
+            async for result in getattr(self.plugin, name)(event, *args, **kwargs):
+                self.channel.send(("result", request_id, result))
+            reply = ("done", request_id, self.plugin.player_world_map.pop_changes())
+        except ShardError:
+            return  # 管道已断开，插件进程不再等待结果
+        except Exception as e:
+            logger.error(f"分片 {self.index} 执行命令 {name} 失败: {e}")
+            reply = ("error", request_id, f"{type(e).__name__}: {e}")
+        try:
+            self.channel.send(reply)
+        except ShardError:
+            pass
+
+
+def _shard_worker_main(index: int, shards: int, conn) -> None:
+    """工作进程入口（spawn 方式启动）"""
+    asyncio.run(ShardWorker(index, shards, conn).serve())
+
+
+class ShardRouter:
+    """插件进程中的分片路由
+
+    按 shard_of(group_id) 把命令转发给对应的工作进程，逐条转交回复；私聊命令按各进程
+    回报的 player_world_map 副本找到玩家所在的世界。每个工作进程只看得到自己分片的
+    玩家，"一名玩家只能加入一个世界"由本进程在转发加入、加载命令前按该副本检查。
+    工作进程的 LLM 调用和主动消息由本进程代为执行。工作进程意外退出时，等待中的命令
+    以 ShardError 结束，下一条命令到来时重新拉起该进程。
+    """
+
+    # 工作进程入口；替身环境下换成先安装 astrbot 替身再导入插件的入口
+    worker_entry: Optional[Callable] = None
+
+    def __init__(self, plugin: "DouPoCangQiongFinal", shards: int):
+        self.plugin = plugin
+        self.shards = shards
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * shards
+        self.channels: List[Optional[PipeChannel]] = [None] * shards
+        self.ready: List[asyncio.Event] = [asyncio.Event() for _ in range(shards)]
+        self.bindings: Dict[str, str] = {}  # user_id -> group_id，用于路由私聊命令
+        self.persistence = DataPersistence()  # 只读存档，检查 /dp_load 要加载的玩家
+        self.pending: Dict[int, Tuple[int, asyncio.Queue]] = {}
+        self.tasks = set()
+        self._ids = itertools.count()
+        self._spawn_lock = asyncio.Lock()
+        self.stopping = False
+        self.stats = Counter()
+
+    def _spawn(self, index: int) -> None:
+        mp = multiprocessing.get_context("spawn")  # 不继承插件进程的事件循环和线程
+        parent_conn, child_conn = mp.Pipe()
+        process = mp.Process(target=ShardRouter.worker_entry or _shard_worker_main,
+                             args=(index, self.shards, child_conn), name=f"dpcq-shard-{index}", daemon=True)
+        process.start()
+        child_conn.close()
+        channel = PipeChannel(parent_conn, partial(self._on_message, index), partial(self._on_close, index))
+        channel.start()
+        self.processes[index] = process
+        self.channels[index] = channel
+        self.ready[index] = asyncio.Event()
+        self.stats["spawned"] += 1
+        logger.info(f"分片工作进程 {index} 已启动 (pid={process.pid})")
+
+    def start(self) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            logger.warning("当前没有运行中的事件循环，分片工作进程将在第一条命令到来时启动")
+            return
+        for index in range(self.shards):
+            self._spawn(index)
+
+    async def _channel(self, index: int) -> PipeChannel:
+        async with self._spawn_lock:
+            if self.stopping:
+                raise ShardError("插件正在关闭")
+            channel = self.channels[index]
+            if channel is None or channel.closed:
+                self._spawn(index)
+        try:
+            await asyncio.wait_for(self.ready[index].wait(), SHARD_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ShardError(f"分片 {index} 未能在 {SHARD_START_TIMEOUT} 秒内就绪")
+        channel = self.channels[index]
+        if channel.closed:
+            raise ShardError(f"分片 {index} 启动失败")
+        return channel
+
+    async def _all_ready(self) -> None:
+        """等所有分片回报玩家映射，此后 bindings 覆盖全部世界"""
+        for index in range(self.shards):
+            await self._channel(index)
+
+    def _load_target(self, event: AstrMessageEvent, name: str) -> Optional[str]:
+        """/dp_load_s 加载到的世界 ID（未指定时为 None）；/dp_load 总是加载到当前群"""
+        args = event.message_str.strip().split()
+        if len(args) < 2:
+            return None
+        return args[1] if name == "load_world_s" else event.get_group_id()
+
+    async def route(self, event: AstrMessageEvent, name: str = "") -> int:
+        if name == "load_world_s" and (target := self._load_target(event, name)):
+            return shard_of(target, self.shards)  # 世界建在存档 ID 上，交给负责该 ID 的分片
+        group_id = event.get_group_id()
+        if not group_id:
+            # 私聊命令：等所有分片回报玩家映射后再查玩家所在的世界
+            await self._all_ready()
+            group_id = self.bindings.get(event.get_sender_id(), "")
+        return shard_of(group_id, self.shards)
+
+    async def _check_bindings(self, event: AstrMessageEvent, name: str) -> Optional[str]:
+        """加入、加载命令会绑定玩家所在的世界；玩家已在其他分片的世界中时返回拒绝理由"""
+        if name == "join_game":
+            await self._all_ready()
+            bound = self.bindings.get(event.get_sender_id())
+            if bound is not None and bound != event.get_group_id():
+                return f"{event.get_sender_name()} 已经加入了其他群聊的游戏，每个玩家只能加入一个世界！"
+            return None
+        if name not in ("load_world", "load_world_s"):
+            return None
+        target = self._load_target(event, name)
+        if target is None:
+            return None
+        save_id = event.message_str.strip().split()[1]
+        data = await asyncio.to_thread(self.persistence.load_world, save_id)
+        if not data:
+            return None  # 由工作进程报告找不到或损坏
+        await self._all_ready()
+        index = shard_of(target, self.shards)
+        conflicts = [uid for uid in data.get("players", {})
+                     if uid in self.bindings and shard_of(self.bindings[uid], self.shards) != index]
+        if conflicts:
+            return (f"存档中有 {len(conflicts)} 名玩家已在其他群聊的游戏中（如 {conflicts[0]}），"
+                    f"每个玩家只能加入一个世界，无法加载！")
+        return None
+
+    async def dispatch(self, event: AstrMessageEvent, name: str, args: tuple, kwargs: dict):
+        """把命令转发给工作进程，逐条产出 event.plain_result(回复)"""
+        if name not in SHARD_BROADCAST_COMMANDS:
+            if reason := await self._check_bindings(event, name):
+                self.stats["rejected"] += 1
+                yield event.plain_result(reason)
+                return
+            async for text in self._request(await self.route(event, name), name, event, args, kwargs):
+                yield event.plain_result(text)
+            return
+        # 广播命令：依次在每个分片上执行，相同的回复只发一次
+        seen = set()
+        for index in range(self.shards):
+            async for text in self._request(index, name, event, args, kwargs):
+                if text not in seen:
+                    seen.add(text)
+                    yield event.plain_result(text)
+
+    async def _request(self, index: int, name: str, event: AstrMessageEvent, args: tuple, kwargs: dict):
+        channel = await self._channel(index)
+        request_id = next(self._ids)
+        queue: asyncio.Queue = asyncio.Queue()
+        self.pending[request_id] = (index, queue)
+        self.stats["commands"] += 1
+        try:
+            channel.send(("command", request_id, name, ShardEvent.from_event(event), args, kwargs))
+            while True:
+                kind, payload = await queue.get()
+                if kind == "result":
+                    yield payload
+                elif kind == "done":
+                    return
                 else:
-                    dropped_items[item["name"]] = quantity
-        # 分配奖励给玩家
-        for player in self.players:
-            # 金币奖励
-            player.gold += int(gold_reward)
-
-            # 物品奖励
-            for item_name, quantity in dropped_items.items():
-                for _ in range(quantity):
-                    player.add_item(item_name)
-        return gold_reward, dropped_items
+                    self.stats["errors"] += 1
+                    raise ShardError(f"分片 {index} 执行 {name} 失败: {payload}")
+        finally:
+            self.pending.pop(request_id, None)
+
+    def _on_message(self, index: int, message: tuple) -> None:
+        kind = message[0]
+        if kind in ("result", "done", "error"):
+            request_id, payload = message[1], message[2]
+            if kind == "done":
+                self._apply_bindings(index, payload)
+            if request_id in self.pending:
+                self.pending[request_id][1].put_nowait((kind, payload))
+        elif kind == "ready":
+            self._apply_bindings(index, list(message[2].items()))
+            self.ready[index].set()
+            logger.info(f"分片工作进程 {index} 已就绪，负责 {len(message[2])} 名玩家")
+        elif kind == "llm":
+            self._spawn_task(self._relay_llm(index, *message[1:]))
+        elif kind == "send":
+            self._spawn_task(self.plugin.context.send_message(message[1], message[2]))
+        elif kind == "private":
+            self._spawn_task(self.plugin.context.send_private_message(message[1], message[2]))
+
+    def _apply_bindings(self, index: int, changes: List[Tuple[Optional[str], Optional[str]]]) -> None:
+        for user_id, group_id in changes:
+            if user_id is None:  # 工作进程清空了映射：移除该分片的全部玩家
+                for uid in [u for u, g in self.bindings.items() if shard_of(g, self.shards) == index]:
+                    del self.bindings[uid]
+                continue
+            bound = self.bindings.get(user_id)
+            if bound is not None and shard_of(bound, self.shards) != index:
+                # 玩家已绑定到其他分片的世界：不允许本分片改写或移除该绑定
+                self.stats["binding_conflicts"] += 1
+                logger.error(f"分片 {index} 回报玩家 {user_id} 绑定到 {group_id}，"
+                             f"但其已在分片 {shard_of(bound, self.shards)} 的世界 {bound} 中，已拒绝")
+            elif group_id is None:
+                self.bindings.pop(user_id, None)
+            else:
+                self.bindings[user_id] = group_id
+
+    def _on_close(self, index: int) -> None:
+        self.ready[index].set()  # 唤醒等待就绪的命令，由 _channel 报告启动失败
+        for request_id, (shard, queue) in list(self.pending.items()):
+            if shard == index:
+                queue.put_nowait(("error", "工作进程已退出"))
+        if not self.stopping:
+            self.stats["crashed"] += 1
+            logger.error(f"分片工作进程 {index} 意外退出，将在下一条命令到来时重启")
+
+    def _spawn_task(self, coro) -> None:
+        task = self.plugin._start_background_task(coro)
+        if task is not None:
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _relay_llm(self, index: int, call_id: int, prompt: str, system_prompt: str) -> None:
+        """代工作进程调用 LLM；各进程自己做合批、缓存与熔断，这里只是转发"""
+        error, text = None, ""
+        try:
+            text = await self.plugin._call_llm(None, prompt, system_prompt)
+        except LLMUnavailable as e:
+            error, text = "unavailable", str(e)
+        except Exception as e:
+            error, text = "failed", f"{type(e).__name__}: {e}"
+        channel = self.channels[index]
+        if channel is not None and not channel.closed:
+            try:
+                channel.send(("llm_result", call_id, error, text))
+            except ShardError:
+                pass
+
+    async def stop(self) -> None:
+        """通知各工作进程保存并退出，超时未退出的强制终止"""
+        self.stopping = True
+        for channel in self.channels:
+            if channel is not None and not channel.closed:
+                try:
+                    channel.send(("stop",))
+                except ShardError:
+                    pass
+        for process in self.processes:
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, SHARD_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"分片工作进程 {process.name} 未能按时退出，强制终止")
+                process.terminate()
+        for task in list(self.tasks):
+            task.cancel()
+
 
 # ==================== 主插件类 ====================
 @register("dpcq_final", "author", "斗破苍穹最终版", "1.0.0", "repo url")
 class DouPoCangQiongFinal(Star):
-    def __init__(self, context: Context):
+    def __init__(self, context: Context, shard: Optional[Tuple[int, int]] = None):
         super().__init__(context)
+        self.shards: Optional[ShardRouter] = None
+        if shard is None and SHARD_WORKERS > 0:
+            # 分片模式：本进程只做路由，世界、定时任务与存档都在工作进程中
+            self.shards = ShardRouter(self, SHARD_WORKERS)
+            self.shards.start()
+            return
         self.worlds: Dict[str, GameWorld] = {}
-        self.player_world_map: Dict[str, str] = {}
-        self.persistence = DataPersistence()
-        self.dungeon_manager = DungeonManager()
-        self.auto_train_tasks = {}
+        self.player_world_map: Dict[str, str] = BindingMap() if shard is not None else {}
+        self.metrics = Metrics()
+        self.persistence = DataPersistence(shard=shard)
+        self.persistence.metrics = self.metrics
         self._load_all_worlds()
+        self.jobs = JobScheduler.from_list(self.persistence.load_jobs())
+        self._jobs_wakeup = asyncio.Event()
+        self.world_locks = WorldLocks()
+        self._jobs_sleep_until = 0.0
+        self._jobs_dirty = False
+        self._jobs_flush_task: Optional[asyncio.Task] = None
+        self._job_handlers = {
+            "auction_end": self._job_auction_end,
+            "quick_win": self._job_quick_win,
+            "lottery_draw": self._job_lottery_draw,
+            "auto_train": self._job_auto_train,
+            "request_sweep": self._job_request_sweep,
+            "metrics_dump": self._job_metrics_dump,
+        }
+        self._rehydrate_jobs()
+        self.job_runner_task = self._start_background_task(self._run_jobs())
+        self.llm = ResilientLLM(lambda prompt, system_prompt: self._call_llm(None, prompt, system_prompt))
+        self.llm_batcher = LLMBatcher(self.llm.call)
+        self.narration = NarrationPool()
+        self.narration.start(self._start_background_task)
+        self.world_event_pool = WorldEventPool.from_dict(self.persistence.load_world_events())
+        self._event_refill_task: Optional[asyncio.Task] = None
+        self._ensure_world_events()
+        self._profile_task: Optional[asyncio.Task] = None
+        self._memory_scan_running = False
 
     def _load_all_worlds(self):
-        for group_id in self.persistence.list_saved_worlds():
+        for group_id in self.persistence.list_saved_worlds(owned_only=True):
             if data := self.persistence.load_world(group_id):
                 try:
                     self.worlds[group_id] = GameWorld.from_dict(data)
                     for player_id in data.get("players", {}):
                         self.player_world_map[player_id] = group_id
+                    if self.worlds[group_id].lottery_archive_pending:
+                        self._save_world(group_id)  # 旧存档的开奖记录迁入归档
                 except Exception as e:
                     logger.error(f"加载世界数据失败: {group_id}, 错误: {e}")
 
     def _save_world(self, group_id: str):
         if group_id in self.worlds:
+            world = self.worlds[group_id]
             try:
-                self.persistence.save_world(group_id, self.worlds[group_id].to_dict())
+                if world.lottery_archive_pending:
+                    self.persistence.append_lottery_archive(group_id, world.lottery_archive_pending)
+                    world.lottery_archive_pending = []
+                self.persistence.save_world(group_id, world.to_dict())
             except Exception as e:
                 logger.error(f"保存世界数据失败: {group_id}, 错误: {e}")
 
@@ -2630,6 +5707,15 @@ class DouPoCangQiongFinal(Star):
             self._save_world(group_id)
         return self.worlds[group_id]
 
+    def _start_background_task(self, coro) -> Optional[asyncio.Task]:
+        """在插件所在事件循环中启动后台任务；没有运行中的循环时放弃"""
+        try:
+            return asyncio.get_running_loop().create_task(coro)
+        except RuntimeError:
+            coro.close()
+            logger.warning("当前没有运行中的事件循环，后台任务未启动")
+            return None
+
     def send_scheduled_messages(self, event: AstrMessageEvent, group_id: str, message: str, seconds):
         """发送定时消息"""
         world = self._get_world(group_id)
@@ -2640,96 +5726,270 @@ class DouPoCangQiongFinal(Star):
 
 
     async def terminate(self):
-        for task in self.auto_train_tasks.values():
-            task.cancel()
+        if self.shards is not None:
+            await self.shards.stop()
+            await super().terminate()
+            return
+        if self.job_runner_task:
+            self.job_runner_task.cancel()
+        self.narration.stop()
+        self.llm_batcher.stop()
+        if self._event_refill_task:
+            self._event_refill_task.cancel()
+        if self._profile_task:
+            self._profile_task.cancel()  # 采集协程的 finally 会关闭 cProfile / tracemalloc
+        if self._jobs_flush_task:
+            self._jobs_flush_task.cancel()  # 下面立即写出任务表
+        self._save_world_events()
+        self._save_jobs()
         for group_id in self.worlds:
             self._save_world(group_id)
         await super().terminate()
 
-    async def _process_quick_win(self, event: AstrMessageEvent, group_id: str, item_index: int):
+    # ==================== 定时任务 ====================
+    def _save_jobs(self):
+        """立即写出任务表"""
+        self._jobs_dirty = False
         try:
-            await asyncio.sleep(30)
-            world = self._get_world(group_id)
-
-            # Check if the item is still up for auction and has a bid
-            if item_index >= len(world.auction_items) or world.auction_items[item_index] is None:
-                if item_index in world.auction_quick_win_tasks:
-                    del world.auction_quick_win_tasks[item_index]
-                return  # Item already sold or auction ended
-
-            bid_info = world.auction_bids.get(str(item_index))
-            if not bid_info:
-                if item_index in world.auction_quick_win_tasks:
-                    del world.auction_quick_win_tasks[item_index]
-                return # No bid, should not happen if task was created
-
-            item = world.auction_items[item_index]
-            winner_id = bid_info['bidder']
-            winner_name = bid_info['bidder_name']
-            bid_amount = bid_info['bid']
-            winner = world.players.get(winner_id)
-
-            if winner and winner.deduct_gold(bid_amount):
-                winner.add_item(item['name'])
-                
-                win_message = f"⚡️快速成交！⚡️\n30秒内无人出价，【{item['name']}】以 {bid_amount} 金币的价格成交给【{winner_name}】！"
-                message_chain = MessageChain().message(win_message)
-                await self.context.send_message(event.unified_msg_origin, message_chain)
-
-                # Clean up
-                world.auction_items[item_index] = None
-                if str(item_index) in world.auction_bids:
-                    del world.auction_bids[str(item_index)]
-                if item_index in world.auction_quick_win_tasks:
-                    del world.auction_quick_win_tasks[item_index]
-                
-                self._save_world(group_id)
-            else:
-                if winner:
-                    # Not enough gold, refund. But this is checked on bid.
-                    pass
-                # Announce failure to quick-win if needed, or just let it go to normal auction.
-                if item_index in world.auction_quick_win_tasks:
-                    del world.auction_quick_win_tasks[item_index]
+            self.persistence.save_jobs(self.jobs.to_list())
+        except Exception as e:
+            logger.error(f"保存定时任务失败: {e}")
 
+    def _jobs_changed(self):
+        """标记任务表已变化，JOB_SAVE_DELAY 秒后合并写出；没有事件循环时立即写出"""
+        self._jobs_dirty = True
+        if self._jobs_flush_task is not None and not self._jobs_flush_task.done():
+            return
+        try:
+            self._jobs_flush_task = asyncio.get_running_loop().create_task(self._flush_jobs())
+        except RuntimeError:
+            self._save_jobs()
 
-        except asyncio.CancelledError:
-            # Task was cancelled, which is normal.
+    async def _flush_jobs(self):
+        await asyncio.sleep(JOB_SAVE_DELAY)
+        if self._jobs_dirty:
+            self._save_jobs()
+
+    def _schedule_job(self, kind: str, group_id: str, deadline: float, origin: str = "",
+                      key: str = "", payload: Dict[str, Any] = None) -> None:
+        """登记（或改期）定时任务，标记待写盘并唤醒任务协程
+
+        只推迟已有任务的截止时间（如每次出价顺延快速成交）时不写盘：磁盘上较早的截止时间
+        在重启补登时按实际状态顺延（见 _rehydrate_jobs）。
+        """
+        old = self.jobs.get(kind, group_id, key)
+        self.jobs.schedule(kind, group_id, deadline, origin, key, payload)
+        postponed_only = (old is not None and deadline >= old["deadline"] and payload is None
+                          and origin in ("", old["origin"]))
+        if not postponed_only:
+            self._jobs_changed()
+        # 推迟截止时间（如竞拍中的快速成交）无需唤醒，任务协程醒来后会重新计算
+        if deadline < self._jobs_sleep_until:
+            self._jobs_wakeup.set()
+
+    def _cancel_job(self, kind: str, group_id: str, key: str = "") -> None:
+        if self.jobs.cancel(kind, group_id, key):
+            self._jobs_changed()
+
+    def _rehydrate_jobs(self):
+        """为旧存档中仍在进行、但任务表里没有记录的定时工作补登任务"""
+        now = time.time()
+        if self.jobs.get("request_sweep", "*") is None:
+            self.jobs.schedule("request_sweep", "*", now + REQUEST_SWEEP_INTERVAL)
+        if self.jobs.get("metrics_dump", "*") is None:
+            self.jobs.schedule("metrics_dump", "*", now + METRICS_DUMP_INTERVAL)
+        for group_id, world in self.worlds.items():
+            origin = world.notify_origin
+            if world.auction_items and world.auction_end_time and not self.jobs.get("auction_end", group_id):
+                self.jobs.schedule("auction_end", group_id, world.auction_end_time, origin)
+            if world.lottery_end_time and not self.jobs.get("lottery_draw", group_id):
+                self.jobs.schedule("lottery_draw", group_id, world.lottery_end_time, origin)
+            for key, bid_info in world.auction_bids.items():
+                # 出价顺延快速成交时不写盘，按最后一次出价时间恢复倒计时
+                job = self.jobs.get("quick_win", group_id, key)
+                resume_at = bid_info.get("bid_time", 0) + AUCTION_QUICK_WIN_SECONDS
+                if job and job["deadline"] < resume_at:
+                    self.jobs.schedule("quick_win", group_id, resume_at, key=key)
+            for user_id, player in world.players.items():
+                if player.is_auto_training and not self.jobs.get("auto_train", group_id, user_id):
+                    self.jobs.schedule("auto_train", group_id, now, key=user_id)
+        self._save_jobs()
+
+    async def _run_jobs(self):
+        """唯一的定时任务协程：睡到最早的截止时间，分批执行到期任务"""
+        while True:
+            try:
+                deadline = self.jobs.next_deadline()
+                timeout = None if deadline is None else max(0.0, deadline - time.time())
+                if timeout is None or timeout > 0:
+                    self._jobs_sleep_until = math.inf if deadline is None else deadline
+                    self._jobs_wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._jobs_wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                self._jobs_sleep_until = 0.0
+
+                due = self.jobs.pop_due(time.time(), JOB_BATCH_SIZE)
+                for job in due:
+                    handler = self._job_handlers.get(job["kind"])
+                    if handler is None:
+                        logger.warning(f"未知的定时任务类型: {job['kind']}")
+                        continue
+                    try:
+                        # 定时任务与同一世界的命令互斥执行
+                        async with self.world_locks.get(job["group_id"]):
+                            await handler(job)
+                    except Exception as e:
+                        logger.error(f"定时任务执行失败: {job['job_id']}, 错误: {e}")
+                if due:
+                    self._jobs_changed()
+                # 积压的任务分批执行，批次之间让出事件循环
+                await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"定时任务协程异常: {e}")
+                await asyncio.sleep(1)
+
+    async def _notify(self, origin: str, message: str) -> None:
+        if not origin:
+            logger.info(f"没有可用的通知会话，消息未发送: {message[:50]}")
             return
+        await self.context.send_message(origin, MessageChain().message(message))
+
+    async def _job_request_sweep(self, job: Dict[str, Any]):
+        """定时清理所有世界中过期的对战请求、交易请求、副本队伍和匹配排队"""
+        now = time.time()
+        for group_id, world in list(self.worlds.items()):
+            world.duel_requests.sweep(now)
+            world.trade_requests.sweep(now)
+            lobbies = world.dungeons.sweep(now)
+            if world.dungeons.sweep_queues(now) or lobbies:
+                self._save_world(group_id)
+        self.jobs.schedule("request_sweep", "*", now + REQUEST_SWEEP_INTERVAL)
+
+    async def _job_metrics_dump(self, job: Dict[str, Any]):
+        """定期把运行统计写成 Prometheus 文本文件（供 node_exporter textfile collector 采集）"""
+        self.jobs.schedule("metrics_dump", "*", time.time() + METRICS_DUMP_INTERVAL)
+        if not self.metrics.sample_rate:
+            return
+        shard = self.persistence.shard
+        if METRICS_TEXTFILE:
+            path = Path(METRICS_TEXTFILE)
+            if shard is not None:
+                path = path.with_name(f"{path.stem}-shard{shard[0]}{path.suffix}")
+        else:
+            path = self.persistence._system_path("metrics").with_suffix(".prom")
+        labels = {"shard": str(shard[0])} if shard is not None else None
+        try:
+            os.makedirs(path.parent, exist_ok=True)
+            tmp_path = path.with_name(path.name + ".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.metrics.to_prometheus(labels))
+            os.replace(tmp_path, path)  # 采集方不会读到写了一半的文件
         except Exception as e:
-            logger.error(f"Error in _process_quick_win for item {item_index}: {e}")
+            logger.error(f"写出运行统计失败: {e}")
+
+    async def _job_quick_win(self, job: Dict[str, Any]):
+        """拍卖物品快速成交倒计时到期"""
+        group_id = job["group_id"]
+        if group_id not in self.worlds:
+            return
+        world = self.worlds[group_id]
+        win_message = self._settle_quick_win(world, int(job["key"]))
+        if win_message:
+            self._save_world(group_id)
+            await self._notify(job["origin"] or world.notify_origin, win_message)
+
+    def _settle_quick_win(self, world: GameWorld, item_index: int) -> Optional[str]:
+        """快速成交：倒计时结束仍无人加价，按当前最高价成交；返回通知内容"""
+        # Check if the item is still up for auction and has a bid
+        if item_index >= len(world.auction_items) or world.auction_items[item_index] is None:
+            return None  # Item already sold or auction ended
+
+        item = world.auction_items[item_index]
+        bid_info, sold = world.settle_auction_item(item_index)
+        if not sold:
+            # 出价者已退出或背包已满：出价作废，拍品继续参与本轮拍卖
+            return None
+
+        return (
+            f"⚡️快速成交！⚡️\n{AUCTION_QUICK_WIN_SECONDS}秒内无人出价，【{item['name']}】以 {bid_info['bid']} 金币"
+            f"的价格成交给【{bid_info['bidder_name']}】！"
+        )
 
     async def _call_llm(self, event: AstrMessageEvent, prompt: str, system_prompt: str = "") -> str:
+        provider = self.context.get_using_provider()
+        if provider is None:
+            raise LLMUnavailable("没有可用的 LLM 提供者")
         func_tools_mgr = self.context.get_llm_tool_manager()
-        llm_response = await self.context.get_using_provider().text_chat(
+        llm_response = await provider.text_chat(
             prompt=prompt,
             func_tool=func_tools_mgr,
             system_prompt=system_prompt
         )
         return llm_response.completion_text if llm_response.role == "assistant" else ""
 
-    async def _generate_duel_description(self, player1: Player, player2: Player, winner: Player) -> str:
-        prompt = f"""
+    DUEL_ROLES = ("【挑战者】", "【应战者】")
+
+    @staticmethod
+    def _duel_prompt(player1: Player, player2: Player, winner: Player, loser_dying: bool) -> str:
+        """对战叙事提示词；只包含境界与胜负，双方用占位符指代，因此同一境界组合可复用缓存"""
+        challenger, defender = DouPoCangQiongFinal.DUEL_ROLES
+        return f"""
         描述一场斗破苍穹风格的修炼者对战：
         对战双方：
-        ▪ {player1.user_name}（{player1.realm} {player1.level}星）
-        ▪ {player2.user_name}（{player2.realm} {player2.level}星）
-        胜利者：{winner.user_name}
+        ▪ {challenger}（{player1.realm}）
+        ▪ {defender}（{player2.realm}）
+        胜利者：{challenger if winner is player1 else defender}
+        战败者结局：{'重伤濒死' if loser_dying else '负伤'}
 
         要求：
         1. 若双方境界相差较小：详细描写双方使用的斗技和战术（各1-2种）、战斗转折点、胜利关键因素。
         2. 若境界差距悬殊（如高出两境或以上）：简要描述碾压过程，突出实力鸿沟，无需复杂战术与转折。
-        3. 说明战败者的结局（轻伤/重伤/濒死等）。
+        3. 文中始终用“{challenger}”“{defender}”指代双方，不要另起名字。
         4. 全文约200字，语言热血激昂，体现玄幻战斗的壮观与气势。
         5. 注意你很熟悉斗破苍穹的境界划分
 
         注意：根据实力对比灵活调整描写详略，真实体现强者威压与战斗张力。
         """
-        return await self._call_llm(
-            None,
-            prompt,
-            system_prompt="你是斗破苍穹世界的战斗记录者，擅长用生动语言描述精彩对决"
-        )
+
+    async def _generate_duel_description(self, prompt: str, names: Tuple[str, str]) -> str:
+        """生成对战叙事并代入双方名字；同一提示词攒够缓存后不再调用提供者"""
+        system_prompt = "你是斗破苍穹世界的战斗记录者，擅长用生动语言描述精彩对决"
+        key = self.llm.cache_key(prompt, system_prompt)
+        text = self.llm.cached(key)
+        if text is None:
+            text = await self.llm_batcher.request(prompt, system_prompt=system_prompt)
+            self.llm.remember(key, text)
+        for role, name in zip(self.DUEL_ROLES, names):
+            text = text.replace(role, name)
+        return text
+
+    def _save_world_events(self):
+        try:
+            self.persistence.save_world_events(self.world_event_pool.to_dict())
+        except Exception as e:
+            logger.error(f"保存世界事件池失败: {e}")
+
+    def _ensure_world_events(self) -> None:
+        """事件池低于水位且没有补充任务在运行时，启动后台补充"""
+        if self.world_event_pool.low and (self._event_refill_task is None or self._event_refill_task.done()):
+            self._event_refill_task = self._start_background_task(self._refill_world_events())
+
+    async def _refill_world_events(self):
+        added = await self.world_event_pool.refill(self._generate_world_event)
+        if added:
+            logger.info(f"世界事件池补充 {added} 条，当前 {len(self.world_event_pool)} 条")
+        self._save_world_events()
+
+    def _take_world_events(self, count: int = 3) -> List[str]:
+        events = self.world_event_pool.take(count)
+        self._ensure_world_events()
+        return events
 
     async def _generate_world_event(self) -> str:
         prompt = """
@@ -2741,14 +6001,14 @@ class DouPoCangQiongFinal(Star):
         【事件名称】事件描述
         （影响说明）
         """
-        return await self._call_llm(
-            None,
+        return await self.llm_batcher.request(
             prompt,
             system_prompt="你是斗破苍穹世界的天道意志，掌控世界运行规律"
         )
 
     # ==================== 游戏命令 ====================
     @filter.command("dp_start")
+    @world_serialized
     async def start_game(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         if world.game_started:
@@ -2757,11 +6017,7 @@ class DouPoCangQiongFinal(Star):
 
         world.game_started = True
         world.generate_market_items()
-        world.world_events = [
-            await self._generate_world_event(),
-            await self._generate_world_event(),
-            await self._generate_world_event()
-        ]
+        world.world_events = self._take_world_events()
         world.last_event_update = time.time()
 
         yield event.plain_result(
@@ -2775,6 +6031,7 @@ class DouPoCangQiongFinal(Star):
         self._save_world(event.get_group_id())
 
     @filter.command("dp_join")
+    @world_serialized
     async def join_game(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -2812,6 +6069,7 @@ class DouPoCangQiongFinal(Star):
         self._save_world(event.get_group_id())
 
     @filter.command("状态")
+    @world_serialized
     async def player_status(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -2854,6 +6112,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(status_msg)
 
     @filter.command("状态_s", private=True)
+    @world_serialized
     async def private_status(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
 
@@ -2898,6 +6157,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(status_msg)
 
     @filter.command("修炼")
+    @world_serialized
     async def train(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -2925,6 +6185,7 @@ class DouPoCangQiongFinal(Star):
 
 
     @filter.command("修炼_s", private=True)
+    @world_serialized
     async def private_train(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
 
@@ -2953,6 +6214,7 @@ class DouPoCangQiongFinal(Star):
 
 
     @filter.command("突破_s")
+    @world_serialized
     async def breakthrough_s(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
         if user_id not in self.player_world_map:
@@ -2973,6 +6235,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result(msg)
 
     @filter.command("突破")
+    @world_serialized
     async def breakthrough(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -2994,6 +6257,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result(msg)
 
     @filter.command("探索")
+    @world_serialized
     async def explore(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3021,6 +6285,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(msg)
 
     @filter.command("探索_s", private=True)
+    @world_serialized
     async def private_explore(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
         args = event.message_str.strip().split()
@@ -3050,6 +6315,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(msg)
 
     @filter.command("使用")
+    @world_serialized
     async def use_item(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3070,6 +6336,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(msg)
 
     @filter.command("炼丹_s", private=True)
+    @world_serialized
     async def private_have_dy(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
         if user_id not in self.player_world_map:
@@ -3119,6 +6386,7 @@ class DouPoCangQiongFinal(Star):
         return ''.join(result)
 
     @filter.command("使用_s",private=True)
+    @world_serialized
     async def private_use_item(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
 
@@ -3137,6 +6405,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(msg)
 
     @filter.command("复活")
+    @world_serialized
     async def revive(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3216,6 +6485,7 @@ class DouPoCangQiongFinal(Star):
 
     # 修改后的救助玩家逻辑
     @filter.command("救助")
+    @world_serialized
     async def save_player(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3327,6 +6597,7 @@ class DouPoCangQiongFinal(Star):
         self._save_world(event.get_group_id())
 
     @filter.command("商店")
+    @world_serialized
     async def market(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3405,6 +6676,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result("无效的市场命令！")
 
     @filter.command("拍卖会")
+    @world_serialized
     async def auction(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3417,22 +6689,18 @@ class DouPoCangQiongFinal(Star):
         # 检查是否需要刷新拍卖会物品
         current_time = time.time()
 
+        world.notify_origin = event.unified_msg_origin
         if current_time - world.last_auction_refresh > 7200:  # 2小时刷新一次
-            # Cancel all running quick-win tasks before refreshing
-            for task in world.auction_quick_win_tasks.values():
-                task.cancel()
-            world.auction_quick_win_tasks.clear()
+            # Drop all pending quick-win countdowns before refreshing
+            self._clear_quick_wins(event.get_group_id())
 
+            world.refund_auction_bids()  # 退还上一轮未结算的托管金币并清空竞拍记录
             world.generate_auction_items()
             world.last_auction_refresh = current_time
-            world.auction_bids = {}  # 清空竞拍记录
             world.auction_end_time = current_time + 7200  # 拍卖持续2小时
-            if hasattr(world, 'auction_task'):
-                world.auction_task.cancel()
-            # 设置新的定时任务，在拍卖结束时发送通知
-            world.auction_task = asyncio.create_task(
-                self._send_auction_end_message(event, event.get_group_id(), world.auction_end_time)
-            )
+            # 设置（或改期）拍卖结束任务，在拍卖结束时发送通知
+            self._schedule_job("auction_end", event.get_group_id(), world.auction_end_time,
+                               event.unified_msg_origin)
         player = world.players[user_id]
 
         if len(args) == 1:
@@ -3449,81 +6717,82 @@ class DouPoCangQiongFinal(Star):
             # 显示拍卖会商品列表
             auction_list = f"=== 拍卖会 === (剩余时间: {hours:02d}:{minutes:02d}:{seconds:02d})\n"
             for i, item in enumerate(world.auction_items):
+                if item is None:
+                    auction_list += f"{i + 1}. （已快速成交）\n"
+                    continue
                 current_bid_info = world.auction_bids.get(str(i), {})
                 current_bid = current_bid_info.get('bid', item['base_price'])
                 bidder_name = current_bid_info.get('bidder_name', '无人出价')
 
                 auction_list += f"{i + 1}. 【{item['name']}】{item['description']}\n"
                 auction_list += f"   当前最高价：{current_bid}金币，出价者：{bidder_name}\n"
+                if current_bid_info.get('bidder') == user_id and 'max_bid' in current_bid_info:
+                    auction_list += f"   你的最高价：{current_bid_info['max_bid']}金币（已托管）\n"
                 auction_list += f"   起拍价：{item['base_price']}金币\n"
 
             auction_list += "\n使用 /拍卖会 bid 序号 价格 参与竞拍"
+            auction_list += "\n使用 /拍卖会 代拍 序号 最高价 自动跟价到最高价"
             auction_list += "\n使用 /拍卖会 info 序号 查看物品详细信息"
             auction_list += "\n拍卖会每2小时刷新一次，结束后价高者得"
 
             yield event.plain_result(auction_list)
             return
 
-        if args[1] == "bid" and len(args) > 3:
+        if args[1] in ("bid", "代拍") and len(args) > 3:
+            proxy = args[1] == "代拍"
             try:
                 index = int(args[2]) - 1
                 bid_amount = int(args[3])
+            except ValueError:
+                yield event.plain_result("请输入正确的商品序号和价格！")
+                return
 
-                if current_time >= world.auction_end_time:
-                    yield event.plain_result("拍卖会已结束，无法出价！")
-                    return
-
-                if 0 <= index < len(world.auction_items):
-                    item = world.auction_items[index]
-                    current_bid = world.auction_bids.get(str(index), {}).get('bid', item['base_price'])
+            if current_time >= world.auction_end_time:
+                yield event.plain_result("拍卖会已结束，无法出价！")
+                return
 
-                    if bid_amount <= current_bid:
-                        yield event.plain_result(f"你的出价必须高于当前最高价 {current_bid} 金币！")
-                        return
+            if not (0 <= index < len(world.auction_items)) or world.auction_items[index] is None:
+                yield event.plain_result("无效的商品序号！")
+                return
 
-                    if bid_amount < item['base_price']:
-                        yield event.plain_result(f"出价不能低于起拍价 {item['base_price']} 金币！")
-                        return
+            item = world.auction_items[index]
+            previous = dict(world.auction_bids.get(str(index), {}))
+            success, message, bid_info = world.place_auction_bid(player, index, bid_amount, proxy)
+            if not success:
+                yield event.plain_result(message)
+                return
+            self._save_world(event.get_group_id())
 
-                    if player.gold < bid_amount:
-                        yield event.plain_result("你的金币不足！")
-                        return
+            if bid_info['bidder'] != user_id:
+                # 出价未超过领先者的代拍最高价，已自动退还托管金币
+                yield event.plain_result(
+                    f"⚔️ 【{bid_info['bidder_name']}】的代拍自动跟价，你的出价已被超过！\n"
+                    f"📈 【{item['name']}】当前最高价：{bid_info['bid']}金币"
+                )
+            elif previous.get('bidder') == user_id and previous.get('bid') == bid_info['bid']:
+                # 领先者仅提高代拍最高价，当前价不变，无需推迟快速成交
+                yield event.plain_result(
+                    f"🔒 你对 【{item['name']}】 的最高价已提高到 {bid_amount} 金币，当前价不变：{bid_info['bid']}金币"
+                )
+                return
+            else:
+                yield event.plain_result(
+                    f"🎉 【{player.user_name}】对 【{item['name']}】 出价 {bid_info['bid']} 金币！\n"
+                    + (f"🔒 代拍最高价 {bid_amount} 金币已托管，被加价时自动跟价\n" if proxy else "")
+                    + f"📈 当前最高价：{bid_info['bid']}金币\n"
+                    f"⏰ 拍卖剩余时间：{int((world.auction_end_time - current_time) // 60)}分钟\n"
+                    f"⚡️ 若{AUCTION_QUICK_WIN_SECONDS}秒内无人出更高价，此物品将快速成交！"
+                )
 
-                    # 记录竞拍
-                    # Cancel previous quick-win task for this item
-                    if index in world.auction_quick_win_tasks:
-                        old_task = world.auction_quick_win_tasks.get(index)
-                        if old_task:
-                            old_task.cancel()
-
-                    world.auction_bids[str(index)] = {
-                        'bid': bid_amount,
-                        'bidder': user_id,
-                        'bidder_name': player.user_name,
-                        'bid_time': current_time
-                    }
-
-                    # Start a new quick-win task
-                    new_task = asyncio.create_task(self._process_quick_win(event, event.get_group_id(), index))
-                    world.auction_quick_win_tasks[index] = new_task
-
-                    # 通知所有玩家有新出价
-                    yield event.plain_result(
-                        f"🎉 【{player.user_name}】对 【{item['name']}】 出价 {bid_amount} 金币！\n"
-                        f"📈 当前最高价：{bid_amount}金币\n"
-                        f"⏰ 拍卖剩余时间：{int((world.auction_end_time - current_time) // 60)}分钟\n"
-                        f"⚡️ 若30秒内无人出更高价，此物品将快速成交！"
-                    )
-                else:
-                    yield event.plain_result("无效的商品序号！")
-            except ValueError:
-                yield event.plain_result("请输入正确的商品序号和价格！")
+            # 价格或领先者变化时推迟该物品的快速成交倒计时
+            self._schedule_job("quick_win", event.get_group_id(), current_time + AUCTION_QUICK_WIN_SECONDS,
+                               event.unified_msg_origin, key=str(index))
             return
 
         if args[1] == "info" and len(args) > 2:
             try:
                 index = int(args[2]) - 1
-                if 0 <= index < len(world.auction_items):
+                if 0 <= index < len(world.auction_items) and world.auction_items[index] is not None:
                     item = world.auction_items[index]
                     info_text = f"=== {item['name']} 详细信息 ===\n"
                     info_text += f"描述：{item['description']}\n"
@@ -3544,9 +6813,10 @@ class DouPoCangQiongFinal(Star):
             except ValueError:
                 yield event.plain_result("请输入正确的商品序号！")
             return
-        yield event.plain_result("无效的拍卖会命令！可用命令：/拍卖会, /拍卖会 bid 序号 价格, /拍卖会 info 序号")
+        yield event.plain_result("无效的拍卖会命令！可用命令：/拍卖会, /拍卖会 bid 序号 价格, /拍卖会 代拍 序号 最高价, /拍卖会 info 序号")
 
     @filter.command("出售")
+    @world_serialized
     async def sell(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3580,24 +6850,10 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result(f"物品【{item_name}】数量不足，你只有 {current_quantity} 个。")
             return
 
-        # 计算总售价并出售
-        total_price = 0
-        for _ in range(quantity):
-            # 计算单个物品价格
-            price = 0
-            if item_name in CULTIVATION_BOOST:
-                price = CULTIVATION_BOOST[item_name].get('value', 0) * random.uniform(0.8, 1.1)
-            else:
-                pill = PillSystem.get_pill_by_name(item_name)
-                if pill:
-                    price = pill.get('value', 0) * random.uniform(0.8, 1.2)
-                else:
-                    # 为其他杂项物品设置一个默认价值
-                    price = random.randint(50, 200)
-            
-            total_price += price
-            player.inventory.remove(item_name)
-
+        # 整堆计算总售价并一次性移除
+        unit_value, low, high = get_sell_quote(item_name)
+        total_price = roll_stack_price(unit_value, quantity, low, high)
+        player.remove_items(item_name, quantity)
         player.add_gold(total_price)
 
         yield event.plain_result(
@@ -3608,6 +6864,7 @@ class DouPoCangQiongFinal(Star):
 
 
     @filter.command("出售_s")
+    @world_serialized
     async def private_sell(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
         if user_id not in self.player_world_map:
@@ -3642,24 +6899,10 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result(f"物品【{item_name}】数量不足，你只有 {current_quantity} 个。")
             return
 
-        # 计算总售价并出售
-        total_price = 0
-        for _ in range(quantity):
-            # 计算单个物品价格
-            price = 0
-            if item_name in CULTIVATION_BOOST:
-                price = CULTIVATION_BOOST[item_name].get('value', 0) * random.uniform(0.8, 1.1)
-            else:
-                pill = PillSystem.get_pill_by_name(item_name)
-                if pill:
-                    price = pill.get('value', 0) * random.uniform(0.8, 1.2)
-                else:
-                    # 为其他杂项物品设置一个默认价值
-                    price = random.randint(50, 200)
-            
-            total_price += price
-            player.inventory.remove(item_name)
-
+        # 整堆计算总售价并一次性移除
+        unit_value, low, high = get_sell_quote(item_name)
+        total_price = roll_stack_price(unit_value, quantity, low, high)
+        player.remove_items(item_name, quantity)
         player.add_gold(total_price)
 
         yield event.plain_result(
@@ -3701,7 +6944,89 @@ class DouPoCangQiongFinal(Star):
 
 
 
+    def _handle_bulk_sell(self, player: Player, args: List[str], command: str) -> str:
+        """解析批量出售条件并执行"""
+        usage = (
+            f"格式：/{command} 条件...\n"
+            "条件可组合：\n"
+            "• 全部 - 出售背包内所有可出售物品\n"
+            "• 品阶N - 只出售N品及以下丹药（如 品阶3）\n"
+            f"• 类型X - 按类型出售（{'/'.join(SELL_TYPE_ALIASES)}）\n"
+            "• 保留K - 每种物品保留K个\n"
+            f"示例：/{command} 品阶3 保留2\n"
+            f"（{'、'.join(PROTECTED_ITEMS)}及已装备的功法不会被出售）"
+        )
+        if len(args) < 2:
+            return usage
+
+        max_rank = None
+        item_types = None
+        keep = 0
+        for token in args[1:]:
+            if token == "全部":
+                continue
+            if token.startswith("品阶"):
+                value = token[2:].lstrip("<=≤")
+                rank = PILL_RANK_LEVELS.get(value) or PILL_RANK_LEVELS.get(value + "品")
+                if rank is None and value.isdigit():
+                    rank = int(value)
+                if rank is None:
+                    return f"无效的品阶条件：{token}\n\n{usage}"
+                max_rank = rank
+            elif token.startswith("类型"):
+                if token[2:] not in SELL_TYPE_ALIASES:
+                    return f"无效的类型条件：{token}\n\n{usage}"
+                item_types = SELL_TYPE_ALIASES[token[2:]]
+            elif token.startswith("保留") and token[2:].isdigit():
+                keep = int(token[2:])
+            else:
+                return f"无法识别的条件：{token}\n\n{usage}"
+
+        results = player.bulk_sell(max_rank=max_rank, item_types=item_types, keep=keep)
+        if not results:
+            return "没有符合条件的可出售物品。"
+
+        results.sort(key=lambda r: r[2], reverse=True)
+        lines = [f"【{name}】×{count} → {gold}金币" for name, count, gold in results[:30]]
+        if len(results) > 30:
+            lines.append(f"……等共{len(results)}种物品")
+        return (
+            "=== 批量出售完成 ===\n" +
+            "\n".join(lines) +
+            f"\n\n共出售 {sum(r[1] for r in results)} 件物品，获得 {sum(r[2] for r in results)} 金币"
+        )
+
+    @filter.command("批量出售")
+    @world_serialized
+    async def bulk_sell(self, event: AstrMessageEvent):
+        """按条件批量出售物品"""
+        world = self._get_world(event.get_group_id())
+        user_id = event.get_sender_id()
+        if user_id not in world.players:
+            yield event.plain_result("你还没有加入游戏，请输入 /dp_join 加入游戏！")
+            return
+
+        args = event.message_str.strip().split()
+        yield event.plain_result(self._handle_bulk_sell(world.players[user_id], args, "批量出售"))
+        self._save_world(event.get_group_id())
+
+    @filter.command("批量出售_s", private=True)
+    @world_serialized
+    async def private_bulk_sell(self, event: AstrMessageEvent):
+        """私聊按条件批量出售物品"""
+        user_id = event.get_sender_id()
+        if user_id not in self.player_world_map:
+            yield event.plain_result("你还没有加入任何游戏，请先在群聊中使用 /dp_join 加入游戏！")
+            return
+
+        group_id = self.player_world_map[user_id]
+        world = self._get_world(group_id)
+        args = event.message_str.strip().split()
+        yield event.plain_result(self._handle_bulk_sell(world.players[user_id], args, "批量出售_s"))
+        self._save_world(group_id)
+
     @filter.command("dp_world")
+    @world_serialized
     async def world_news(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
 
@@ -3709,13 +7034,10 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result("游戏尚未开始！")
             return
 
-        if time.time() - world.last_event_update > 3600:
-            world.world_events = [
-                await self._generate_world_event(),
-                await self._generate_world_event(),
-                await self._generate_world_event()
-            ]
+        if time.time() - world.last_event_update > WORLD_EVENT_UPDATE_INTERVAL:
+            world.world_events = self._take_world_events()
             world.last_event_update = time.time()
+            self._save_world(event.get_group_id())
 
         yield event.plain_result(
             "=== 斗破苍穹世界动态 ===\n" +
@@ -3724,6 +7046,7 @@ class DouPoCangQiongFinal(Star):
         )
 
     @filter.command("对战")
+    @world_serialized
     async def duel(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3784,14 +7107,19 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result(f"{target.user_name} 处于濒死状态，无法接受挑战！")
             return
 
-        world.duel_requests[user_id] = target.user_id
+        world.duel_requests.add(user_id, {
+            "challenger_id": user_id,
+            "target_id": target.user_id,
+            "create_time": time.time(),
+        })
         yield event.plain_result(
             f"你向 {target.user_name} 发起了对战请求！\n"
             f"等待对方接受...\n"
-            f"（对方有1分钟时间使用 /接受挑战 接受挑战）"
+            f"（对方有{DUEL_REQUEST_TTL // 60}分钟时间使用 /接受挑战 接受挑战）"
         )
 
     @filter.command("接受挑战")
+    @world_serialized
     async def accept_duel(self, event: AstrMessageEvent):
         world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
@@ -3800,18 +7128,25 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result("你还没有加入游戏，请输入 /dp_join 加入游戏！")
             return
 
-        challenger_id = next((k for k, v in world.duel_requests.items() if v == user_id), None)
+        pending = world.duel_requests.for_target(user_id)
 
-        if not challenger_id:
+        if not pending:
             yield event.plain_result("当前没有人挑战你！")
             return
 
-        challenger = world.players[challenger_id]
+        challenger_id = pending[0]["challenger_id"]
+        challenger = world.players.get(challenger_id)
+        if challenger is None:
+            world.duel_requests.pop(challenger_id)
+            yield event.plain_result("挑战者已离开这个世界！")
+            return
         defender = world.players[user_id]
         status_ok, msg = defender.check_status()
         if not status_ok:
             yield event.plain_result(msg)
             return
+        # 先移除请求，避免同一请求在等待期间被重复接受
+        world.duel_requests.pop(challenger_id)
 
         # 计算境界差和星级差
         # 计算战力比
@@ -3862,14 +7197,21 @@ class DouPoCangQiongFinal(Star):
         winner.last_duel_time = time.time()
         loser.last_duel_time = time.time()
 
-        duel_desc = await self._generate_duel_description(challenger, defender, winner)
-
-        if challenger_id in world.duel_requests:
-            del world.duel_requests[challenger_id]
+        # 叙事由后台工作池生成后作为后续消息发送；排不上队时当场使用模板
+        prompt = self._duel_prompt(challenger, defender, winner, loser_died)
+        names = (challenger.user_name, defender.user_name)
+        fallback = partial(render_duel_narration, winner.user_name, loser.user_name,
+                           winner.realm_index, loser.realm_index, loser_died)
+        origin = event.unified_msg_origin
+        queued = self.narration.submit(
+            lambda: self._generate_duel_description(prompt, names),
+            fallback,
+            lambda text: self._notify(origin, f"=== 对决回放 ===\n{text}"),
+        )
 
         result_msg = (
             f"=== 惊天对决 ===\n"
-            f"{duel_desc}\n"
+            f"{'（战斗详情稍后送达）' if queued else fallback()}\n"
             f"\n★ 胜利者：{winner.user_name} ★\n"
             f"获得：{exp_gain}斗气点，{gold_gain}金币\n"
         )
@@ -3884,6 +7226,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(result_msg)
 
     @filter.command("dp_save")
+    @world_serialized
     async def save_world(self, event: AstrMessageEvent):
         group_id = event.get_group_id()
         world = self._get_world(group_id)
@@ -3896,6 +7239,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result("⚠ 数据保存失败，请检查日志")
 
     @filter.command("dp_save_s")
+    @world_serialized
     async def save_world_s(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
         group_id = self.player_world_map[user_id]
@@ -3909,6 +7253,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result("⚠ 数据保存失败，请检查日志")
 
     @filter.command("dp_load")
+    @world_serialized
     async def load_world(self, event: AstrMessageEvent):
         group_id = event.get_group_id()
         args = event.message_str.strip().split()
@@ -3962,6 +7307,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result("⚠ 数据加载失败，请检查日志")
 
     @filter.command("dp_load_s")
+    @world_serialized
     async def load_world_s(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
         # if user_id not in self.player_world_map:
@@ -4017,6 +7363,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result("⚠ 数据加载失败，请检查日志")
 
     @filter.command("dp_help", private=True)
+    @world_serialized
     async def show_help(self, event: AstrMessageEvent):
         help_text = (
             "╔════════════════════════════════════════╗\n"
@@ -4041,7 +7388,11 @@ class DouPoCangQiongFinal(Star):
             "🔹 /探索 初级/中级/高级 - 探索世界\n"
             "🔹 /探索_s - 私聊探索\n"
             "🔹 /挑战副本 - 组队挑战副本\n"
-            "🔹 /开始副本 [ID] - 开始副本战斗\n\n"
+            "🔹 /接受副本 [ID] - 确认准备就绪(省略ID为所在队伍)\n"
+            "🔹 /开始副本 [ID] - 开始副本战斗\n"
+            "🔹 /副本匹配 等级 - 排队自动组队，凑够战力直接开战\n"
+            "🔹 /取消匹配 - 退出匹配队列\n"
+            "🔹 /副本预测 [等级] - 预测队伍胜率与期望收益\n\n"
 
             "⚔━━━━━━━━━━ 战斗系统 ━━━━━━━━━━━⚔\n"
             "🔹 /对战 @玩家 - 发起对战\n"
@@ -4053,13 +7404,18 @@ class DouPoCangQiongFinal(Star):
             "🔹 /商店 - 交易市场\n"
             "🔹 /出售 - 出售物品\n"
             "🔹 /出售_s - 私聊出售\n"
-            "🔹 /拍卖会 - 参与珍品拍卖\n"
+            "🔹 /批量出售 条件 - 按品阶/类型批量出售\n"
+            "🔹 /拍卖会 - 参与珍品拍卖（代拍 序号 最高价：自动跟价）\n"
             "🔹 /斗破彩 - 斗气彩票系统\n\n"
             
             "💱━━━━━━━━━━ 交易系统 ━━━━━━━━━━━━💱\n"
             "🔹🔹 /交易 @玩家 物品 金额 - 发起交易\n"
             "🔹🔹 /接受交易 交易号 - 接受交易请求\n"
             "🔹🔹 /拒绝交易 交易号 - 拒绝交易请求\n"
+            "🔹🔹 /挂单 物品 单价 [数量] - 挂出卖单\n"
+            "🔹🔹 /求购 物品 单价 [数量] - 挂出买单\n"
+            "🔹🔹 /撤单 [订单号] - 查看/撤销挂单\n"
+            "🔹🔹 /盘口 [物品] - 查看挂单簿\n"
 
             "🔮━━━━━━━━━━ 特殊系统 ━━━━━━━━━━━🔮\n"
             "🔹 /炼丹_s [品阶] - 炼制丹药(需内丹)\n"
@@ -4087,6 +7443,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(help_text)
 
     @filter.command("更新公告", private=True)
+    @world_serialized
     async def show_changelog(self, event: AstrMessageEvent):
         changelog_text = (
             "╔════════════════════════════════════════╗\n"
@@ -4120,6 +7477,7 @@ class DouPoCangQiongFinal(Star):
         yield event.plain_result(changelog_text)
 
     @filter.command("dp_clear", admin=True)
+    @world_serialized
     async def clear_world(self, event: AstrMessageEvent):
         """管理员命令：清除当前群聊的游戏世界数据"""
         group_id = event.get_group_id()
@@ -4130,31 +7488,38 @@ class DouPoCangQiongFinal(Star):
         for player_id in list(self.player_world_map.keys()):
             if self.player_world_map[player_id] == group_id:
                 del self.player_world_map[player_id]
-        # 删除世界数据
+        # 删除世界数据及其定时任务
         del self.worlds[group_id]
+        self.jobs.cancel_group(group_id)
+        self._jobs_changed()
         # 删除持久化文件
         self.persistence.delete_world(group_id)
         yield event.plain_result("★ 已成功清除当前群聊的游戏数据！ ★")
 
     @filter.command("dp_clear_all", admin=True)
+    @world_serialized
     async def clear_all_worlds(self, event: AstrMessageEvent):
         """管理员命令：清除所有游戏世界数据"""
         confirm = event.message_str.strip().split()
         if len(confirm) < 2 or confirm[1] != "confirm":
             yield event.plain_result("⚠ 危险操作！这将删除所有游戏数据！\n如需继续，请使用 /dp_clear_all confirm")
             return
-        # 清除内存中的数据
+        # 清除内存中的数据及定时任务
+        for group_id in self.worlds:
+            self.jobs.cancel_group(group_id)
+        self._jobs_changed()
         self.worlds.clear()
         self.player_world_map.clear()
-        # 删除所有持久化文件
-        for world_id in self.persistence.list_saved_worlds():
+        # 删除所有持久化文件（分片模式下每个工作进程删除自己负责的世界）
+        for world_id in self.persistence.list_saved_worlds(owned_only=True):
             self.persistence.delete_world(world_id)
         yield event.plain_result("★ 已成功清除所有游戏世界数据！ ★")
 
     @filter.command("dp_cleanup", admin=True)
+    @world_serialized
     async def cleanup_files(self, event: AstrMessageEvent):
         """管理员命令：清理无效数据文件"""
-        saved_files = set(self.persistence.list_saved_worlds())
+        saved_files = set(self.persistence.list_saved_worlds(owned_only=True))
         active_worlds = set(self.worlds.keys())
         # 找出没有对应活跃世界的文件
         orphaned_files = saved_files - active_worlds
@@ -4169,6 +7534,7 @@ class DouPoCangQiongFinal(Star):
         )
 
     @filter.command("斗破彩")
+    @world_serialized
     async def lottery(self, event: AstrMessageEvent):
         """斗气彩彩票系统"""
         world = self._get_world(event.get_group_id())
@@ -4181,13 +7547,13 @@ class DouPoCangQiongFinal(Star):
         player = world.players[user_id]
 
         current_time = time.time()
-        logger.info(f"剩余时间：{current_time}")
-        if not hasattr(world, 'lottery_task'):
-            world.last_lottery_draw = current_time
-            world.lottery_end_time = current_time + 7200  # 2小时后开奖
-            world.lottery_task = asyncio.create_task(
-                self._send_lottery_end_message(event, event.get_group_id(), world.lottery_end_time)
-            )
+        world.notify_origin = event.unified_msg_origin
+        if self.jobs.get("lottery_draw", event.get_group_id()) is None:
+            if world.lottery_end_time <= current_time:
+                world.last_lottery_draw = current_time
+                world.lottery_end_time = current_time + LOTTERY_DRAW_INTERVAL  # 2小时后开奖
+            self._schedule_job("lottery_draw", event.get_group_id(), world.lottery_end_time,
+                               event.unified_msg_origin)
 
         if len(args) == 1:
             # 显示彩票信息（修改剩余时间计算方式）
@@ -4201,7 +7567,7 @@ class DouPoCangQiongFinal(Star):
                 f"下次开奖：{hours}小时{minutes}分钟后\n"
                 "玩法说明：\n"
                 "1. 从1-35选5个主号码，1-12选2个特别号码\n"
-                "2. 每注100金币，奖金来自奖池\n"
+                f"2. 每注{LOTTERY_TICKET_PRICE}金币，奖金来自奖池\n"
                 "3. 每2小时开奖一次\n"
                 "4. 中奖规则：\n"
                 "   一等奖：5+2（40%奖池）\n"
@@ -4218,7 +7584,8 @@ class DouPoCangQiongFinal(Star):
                 "/斗破彩 buy [数量] - 随机购买多注\n"
                 "/斗破彩 buy 1 2 3 4 5 6 7 - 自选号码\n"
                 "/斗破彩 my - 查看我的彩票\n"
-                "/斗破彩 history - 查看历史开奖\n"
+                "/斗破彩 history [页码] - 查看历史开奖\n"
+                "/斗破彩 stats - 查看号码冷热与派奖统计\n"
             )
             yield event.plain_result(info)
             return
@@ -4245,20 +7612,24 @@ class DouPoCangQiongFinal(Star):
                         yield event.plain_result("购买数量必须大于0！")
                         return
 
-                    total_cost = count * 100
+                    if count > LOTTERY_MAX_BUY:
+                        yield event.plain_result(f"单次最多购买{LOTTERY_MAX_BUY}注！")
+                        return
+
+                    total_cost = count * LOTTERY_TICKET_PRICE
                     if not player.deduct_gold(total_cost):
                         yield event.plain_result(f"金币不足，购买{count}注需要{total_cost}金币！")
                         return
 
-                    success_count = 0
-                    for _ in range(count):
-                        success, msg = world.buy_lottery_ticket(user_id)
-                        if success:
-                            success_count += 1
+                    # 分块生成，块之间让出事件循环；整批买完后奖池一次性入账
+                    for start in range(0, count, LOTTERY_BUY_CHUNK):
+                        if start:
+                            await asyncio.sleep(0)
+                        world.add_lottery_tickets(user_id, min(LOTTERY_BUY_CHUNK, count - start))
+                    world.credit_lottery_pool(count)
 
-                    if success_count > 0:
-                        self._save_world(event.get_group_id())
-                    yield event.plain_result(f"成功购买{success_count}注彩票，花费{success_count * 100}金币")
+                    self._save_world(event.get_group_id())
+                    yield event.plain_result(f"成功购买{count}注彩票，花费{total_cost}金币")
                     return
 
                 # 如果不是数量，检查是否为自选号码（至少7个数字）
@@ -4269,12 +7640,14 @@ class DouPoCangQiongFinal(Star):
                         if len(numbers) != 7 or any(n < 1 or n > 35 for n in numbers):  # 示例范围1-35
                             yield event.plain_result("请提供7个有效的号码（例如1-35）！")
                             return
-                        if not player.deduct_gold(100):
-                            yield event.plain_result("金币不足，每注需要100金币！")
+                        if not player.deduct_gold(LOTTERY_TICKET_PRICE):
+                            yield event.plain_result(f"金币不足，每注需要{LOTTERY_TICKET_PRICE}金币！")
                             return
                         success, msg = world.buy_lottery_ticket(user_id, numbers)
                         if success:
                             self._save_world(event.get_group_id())
+                        else:
+                            player.add_gold(LOTTERY_TICKET_PRICE)  # 号码无效，退还金币
                         yield event.plain_result(msg)
                         return
                     except ValueError:
@@ -4285,8 +7658,8 @@ class DouPoCangQiongFinal(Star):
                     return
             # 情况2：购买单注（/buy）
             elif len(args) == 2:
-                if not player.deduct_gold(100):
-                    yield event.plain_result("金币不足，每注需要100金币！")
+                if not player.deduct_gold(LOTTERY_TICKET_PRICE):
+                    yield event.plain_result(f"金币不足，每注需要{LOTTERY_TICKET_PRICE}金币！")
                     return
                 success, msg = world.buy_lottery_ticket(user_id)
                 if success:
@@ -4302,36 +7675,75 @@ class DouPoCangQiongFinal(Star):
                 yield event.plain_result("你还没有购买任何彩票！")
                 return
 
+            my_tickets = world.lottery_tickets[user_id]
             tickets = [
                 f"{i + 1}. 主:{ticket[:5]} 特:{ticket[5:]}"
-                for i, ticket in enumerate(world.lottery_tickets[user_id])
+                for i, ticket in enumerate(map(decode_lottery_ticket, my_tickets[:50]))
             ]
+            if len(my_tickets) > 50:
+                tickets.append("……（仅显示前50注）")
             yield event.plain_result(
                 f"=== 你的彩票 ===\n" +
                 "\n".join(tickets) +
-                f"\n\n共{len(tickets)}注，总价值{len(tickets) * 100}金币"
+                f"\n\n共{len(my_tickets)}注，总价值{len(my_tickets) * LOTTERY_TICKET_PRICE}金币"
             )
             return
         if args[1] == "history":
-            if not world.lottery_history:
+            page_size = 5
+            page = int(args[2]) if len(args) > 2 and args[2].isdigit() and int(args[2]) > 0 else 1
+            archive = LotteryArchive(self.persistence.lottery_archive_path(event.get_group_id()))
+            total = max(archive.count(), len(world.lottery_history))
+            if total == 0:
                 yield event.plain_result("暂无开奖历史！")
                 return
+            total_pages = (total + page_size - 1) // page_size
+            if page > total_pages:
+                yield event.plain_result(f"页码超出范围！共 {total_pages} 页")
+                return
+
+            # 最近的几页直接读内存，更早的从归档文件倒序读取
+            start = (page - 1) * page_size
+            if start + page_size <= len(world.lottery_history):
+                records = list(reversed(world.lottery_history))[start:start + page_size]
+            else:
+                records = archive.page(page, page_size)
+
             history = []
-            for i, record in enumerate(world.lottery_history[-5:]):  # 显示最近5期
+            for i, record in enumerate(records, start + 1):
                 draw_time = time.strftime("%m-%d %H:%M", time.localtime(record["draw_time"]))
                 numbers = f"主:{record['numbers'][:5]} 特:{record['numbers'][5:]}"
                 winners = " ".join([f"{k}:{v}" for k, v in record["winners"].items() if v > 0])
-                history.append(f"{i + 1}. {draw_time} {numbers} 中奖: {winners}")
+                history.append(f"{i}. {draw_time} {numbers} 中奖: {winners}")
+
+            yield event.plain_result(
+                f"=== 开奖历史（第{page}/{total_pages}页，最新在前）===\n" +
+                "\n".join(history) +
+                (f"\n\n使用 /斗破彩 history {page + 1} 查看更早的记录" if page < total_pages else "")
+            )
+            return
 
+        if args[1] == "stats":
+            stats = LotteryArchive(self.persistence.lottery_archive_path(event.get_group_id())).stats()
+            if stats["draws"] == 0:
+                yield event.plain_result("暂无开奖历史！")
+                return
+            hot_main = sorted(stats["main_hits"].items(), key=lambda kv: (-kv[1], kv[0]))
+            hot_special = sorted(stats["special_hits"].items(), key=lambda kv: (-kv[1], kv[0]))
+            tiers = " ".join(f"{level}:{count}" for level, count in stats["tier_winners"].items() if count > 0)
             yield event.plain_result(
-                "=== 最近5期开奖 ===\n" +
-                "\n".join(history)
+                f"=== 斗破彩统计（共{stats['draws']}期）===\n"
+                f"累计派奖：{stats['total_payout']}金币（平均每期{stats['total_payout'] // stats['draws']}金币）\n"
+                f"主号热号：{' '.join(f'{n}({c})' for n, c in hot_main[:5])}\n"
+                f"主号冷号：{' '.join(f'{n}({c})' for n, c in hot_main[-5:])}\n"
+                f"特别号热号：{' '.join(f'{n}({c})' for n, c in hot_special[:3])}\n"
+                f"各奖级中奖注数：{tiers or '无'}"
             )
             return
 
         yield event.plain_result("无效的命令，请输入 /斗气彩 查看帮助")
 
     @filter.command("丹药")
+    @world_serialized
     async def query_pill(self, event: AstrMessageEvent):
         """
         丹药查询系统（群聊版）
@@ -4395,6 +7807,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result(result)
 
     @filter.command("丹药_s", private=True)
+    @world_serialized
     async def private_query_pill(self, event: AstrMessageEvent):
         """
         丹药查询系统（私聊版）
@@ -4457,6 +7870,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result(result)
 
     @filter.command("挑战至高主宰", private=True)
+    @world_serialized
     async def challenge_supreme_ruler(self, event: AstrMessageEvent):
         user_id = event.get_sender_id()
 
@@ -4573,6 +7987,7 @@ class DouPoCangQiongFinal(Star):
         self._save_world(group_id)
 
     @filter.command("挑战副本")
+    @world_serialized
     async def create_dungeon(self, event: AstrMessageEvent):
         """创建副本队伍"""
         world = self._get_world(event.get_group_id())
@@ -4603,134 +8018,427 @@ class DouPoCangQiongFinal(Star):
                 deduped.append(pid)
         all_player_ids = deduped
 
-        result = self.dungeon_manager.create_dungeon(world, level, all_player_ids)
+        count = len(world.dungeons)
+        result = world.dungeons.create_dungeon(world, level, all_player_ids)
+        if len(world.dungeons) > count:
+            self._save_world(event.get_group_id())
         yield event.plain_result(result)
 
+    def _resolve_dungeon_id(self, world: GameWorld, user_id: str, args: List[str]) -> Optional[str]:
+        """命令中给出的副本ID；未给出时使用玩家当前所在的队伍"""
+        if len(args) >= 2:
+            return args[1]
+        lobby = world.dungeons.lobby_of(user_id)
+        return lobby["dungeon_id"] if lobby else None
+
     @filter.command("接受副本")
+    @world_serialized
     async def confirm_dungeon(self, event: AstrMessageEvent):
         """确认准备就绪"""
-        args = event.message_str.strip().split()
-        if len(args) < 2:
-            yield event.plain_result("请指定要接受的副本ID！")
+        world = self._get_world(event.get_group_id())
+        user_id = event.get_sender_id()
+        dungeon_id = self._resolve_dungeon_id(world, user_id, event.message_str.strip().split())
+        if dungeon_id is None:
+            yield event.plain_result("你当前不在任何副本队伍中，请指定要接受的副本ID！")
             return
 
-        dungeon_id = args[1]
-        user_id = event.get_sender_id()
-        result = self.dungeon_manager.confirm_dungeon(dungeon_id, user_id)
+        result = world.dungeons.confirm_dungeon(dungeon_id, user_id)
+        self._save_world(event.get_group_id())
         yield event.plain_result(result)
 
     @filter.command("开始副本")
+    @world_serialized
     async def start_dungeon(self, event: AstrMessageEvent):
         """开始副本挑战"""
+        world = self._get_world(event.get_group_id())
+        user_id = event.get_sender_id()
+        dungeon_id = self._resolve_dungeon_id(world, user_id, event.message_str.strip().split())
+        if dungeon_id is None:
+            yield event.plain_result("你当前不在任何副本队伍中，请指定要开始的副本ID！")
+            return
+
+        success, result = world.dungeons.start_dungeon(world, dungeon_id, user_id)
+        # 队伍已解散（胜负结果已结算到所有队员身上），保存世界状态
+        self._save_world(event.get_group_id())
+        yield event.plain_result(result)
+
+    @filter.command("副本匹配")
+    @world_serialized
+    async def match_dungeon(self, event: AstrMessageEvent):
+        """加入副本匹配队列，凑够战力的队伍直接开战"""
+        world = self._get_world(event.get_group_id())
+        user_id = event.get_sender_id()
         args = event.message_str.strip().split()
+
         if len(args) < 2:
-            yield event.plain_result("请指定要开始的副本ID！")
+            queued = world.dungeons.queue_of(user_id)
+            status = f"你正在【{queued}】队列中排队\n" if queued else ""
+            yield event.plain_result(
+                f"{status}请指定副本等级！\n"
+                f"可用副本等级: {'、'.join(DUNGEON_LEVELS)}\n"
+                f"示例: /副本匹配 高级"
+            )
+            return
+
+        _, result = world.dungeons.enqueue(world, args[1], user_id)
+        self._save_world(event.get_group_id())
+        yield event.plain_result(result)
+
+    @filter.command("取消匹配")
+    @world_serialized
+    async def cancel_match(self, event: AstrMessageEvent):
+        """退出副本匹配队列"""
+        world = self._get_world(event.get_group_id())
+        level = world.dungeons.cancel_queue(event.get_sender_id())
+        if level is None:
+            yield event.plain_result("你当前不在任何匹配队列中")
             return
+        self._save_world(event.get_group_id())
+        yield event.plain_result(f"已退出【{level}】匹配队列")
 
-        dungeon_id = args[1]
+    @filter.command("副本预测")
+    @world_serialized
+    async def preview_dungeon(self, event: AstrMessageEvent):
+        """预测当前队伍（未组队时为自己）挑战各等级副本的胜率与期望收益"""
+        world = self._get_world(event.get_group_id())
         user_id = event.get_sender_id()
-        success, result = self.dungeon_manager.start_dungeon(dungeon_id, user_id)
+        args = event.message_str.strip().split()
 
-        if success:
-            # 保存世界状态
-            self._save_world(event.get_group_id())
-        yield event.plain_result(result)
+        if user_id not in world.players:
+            yield event.plain_result("你还没有加入游戏，请输入 /dp_join 加入游戏！")
+            return
 
+        level = args[1] if len(args) > 1 else None
+        if level is not None and level not in DUNGEON_LEVELS:
+            yield event.plain_result(f"无效的副本等级: {level}\n可用副本等级: {'、'.join(DUNGEON_LEVELS)}")
+            return
 
+        lobby = world.dungeons.lobby_of(user_id)
+        member_ids = lobby["player_ids"] if lobby else [user_id]
+        members = [world.players[pid] for pid in member_ids if pid in world.players]
+        total_power = sum(p.battle_power() for p in members)
+        header = (
+            f"=== 副本预测 ===\n"
+            f"队伍: {', '.join(p.user_name for p in members)}"
+            f"{'（' + lobby['dungeon_id'] + '）' if lobby else '（单人）'}\n"
+            f"队伍总战力: {int(total_power):,}\n"
+        )
 
+        if level is None:
+            lines = []
+            for name, info in DUNGEON_LEVELS.items():
+                result = forecast_dungeon(name, dungeon_forecast_bucket(total_power, info["boss_power"]), len(members))
+                lines.append(
+                    f"{name}: 胜率 {result['win_rate']:.1%}，期望金币 {int(result['expected_gold']):,}"
+                )
+            yield event.plain_result(
+                header + "\n" + "\n".join(lines) + "\n\n使用 /副本预测 等级 查看期望掉落"
+            )
+            return
 
-    async def _send_auction_end_message(self,event: AstrMessageEvent, group_id: str, end_time: float):
-        try:
-            # 计算需要等待的时间
-            wait_time = end_time - time.time()
-            if wait_time > 0:
-                await asyncio.sleep(wait_time)
-            # 获取当前世界状态
-            world = self._get_world(group_id)
-            # 检查拍卖是否真的结束了（防止提前刷新）
-            if time.time() < world.auction_end_time:
+        info = DUNGEON_LEVELS[level]
+        result = forecast_dungeon(level, dungeon_forecast_bucket(total_power, info["boss_power"]), len(members))
+        drops = sorted(result["expected_drops"].items(), key=lambda kv: -kv[1])
+        drop_lines = [f"- {name} ×{quantity:.2f}" for name, quantity in drops if quantity > 0]
+        yield event.plain_result(
+            header +
+            f"BOSS战力: {info['boss_power']:,}\n\n"
+            f"【{level}】胜率: {result['win_rate']:.1%}\n"
+            f"人均期望金币: {int(result['expected_gold']):,}\n"
+            f"人均期望掉落:\n" + ("\n".join(drop_lines) or "(无)") +
+            f"\n\n（基于 {result['samples']} 次模拟，失败时无奖励，胜利时按伤害贡献分配）"
+        )
+
+    @filter.command("dp_lobbies", admin=True)
+    @world_serialized
+    async def list_lobbies(self, event: AstrMessageEvent):
+        """管理员命令：查看当前群聊所有未开始的副本队伍"""
+        world = self._get_world(event.get_group_id())
+        world.dungeons.sweep()
+        world.dungeons.sweep_queues()
+        queue_line = "匹配排队: " + ("、".join(
+            f"{level} {len(queue)}人" for level, queue in world.dungeons.queues.items() if queue
+        ) or "无")
+        if not world.dungeons.lobbies:
+            yield event.plain_result("当前没有未开始的副本队伍\n" + queue_line)
+            return
+
+        now = time.time()
+        lines = [f"=== 副本队伍（{len(world.dungeons)}支）===", queue_line]
+        for lobby in sorted(world.dungeons.lobbies.values(), key=lambda lobby: lobby["expire_at"]):
+            names = ", ".join(
+                world.players[pid].user_name if pid in world.players else pid for pid in lobby["player_ids"]
+            )
+            status = f"待确认 {len(lobby['pending'])} 人" if lobby["pending"] else "已就绪"
+            remaining = max(0, int(lobby["expire_at"] - now))
+            lines.append(
+                f"{lobby['dungeon_id']} [{lobby['level']}] {names}\n"
+                f"   {status}，{remaining // 60}分{remaining % 60}秒后解散"
+            )
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("dp_locks", admin=True)
+    async def show_world_locks(self, event: AstrMessageEvent):
+        """管理员命令：查看各世界的锁等待与排队情况（本命令不加锁，卡住时也能查看）"""
+        if self.shards is not None:
+            # 分片模式下查看负责本群的工作进程
+            async for result in self.shards.dispatch(event, "show_world_locks", (), {}):
+                yield result
+            return
+        locks = self.world_locks.locks
+        if not locks:
+            yield event.plain_result("还没有世界执行过命令")
+            return
+
+        rows = sorted(locks.items(), key=lambda item: item[1].total_wait, reverse=True)
+        lines = [f"=== 世界锁（{len(locks)}个世界）==="]
+        for group_id, lock in rows[:20]:
+            stats = lock.stats()
+            lines.append(
+                f"{ {'*': '全局任务', '': '未绑定'}.get(group_id, group_id)}: 执行 {stats['acquired']} 次，等待 {stats['contended']} 次"
+                f"（平均 {stats['avg_wait'] * 1000:.1f}ms，最长 {stats['max_wait'] * 1000:.1f}ms）\n"
+                f"   当前排队 {stats['waiting']}，最多排队 {stats['max_waiting']}"
+                + ("，执行中" if lock.owner is not None else "")
+            )
+        if len(rows) > 20:
+            lines.append(f"…… 另有 {len(rows) - 20} 个世界")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("dp_stats", admin=True)
+    async def show_stats(self, event: AstrMessageEvent):
+        """管理员命令：查看命令与存档耗时统计；可调整采样比例或清零（本命令不加锁）"""
+        if self.shards is not None:
+            # 分片模式下查看负责本群的工作进程
+            async for result in self.shards.dispatch(event, "show_stats", (), {}):
+                yield result
+            return
+
+        args = event.message_str.strip().split()
+        metrics = self.metrics
+        if len(args) >= 2 and args[1] == "重置":
+            metrics.reset()
+            yield event.plain_result("运行统计已清零")
+            return
+        if len(args) >= 2 and args[1] == "采样":
+            try:
+                rate = float(args[2])
+                if not 0 <= rate <= 1:
+                    raise ValueError
+            except (IndexError, ValueError):
+                yield event.plain_result("用法：/dp_stats 采样 比例（0~1，0 为关闭）")
                 return
+            metrics.sample_rate = rate
+            yield event.plain_result(f"采样比例已设为 {rate:g}" + ("（统计已关闭）" if rate == 0 else ""))
+            return
 
-            # At the end of the auction, cancel all pending quick-win tasks.
-            for task in world.auction_quick_win_tasks.values():
-                task.cancel()
-            world.auction_quick_win_tasks.clear()
+        def row(name: str, stats: LatencyStats) -> str:
+            return (f"{name}: {stats.count}次" + (f" 失败{stats.errors}" if stats.errors else "") +
+                    f" | P50 {stats.quantile(0.5) * 1000:.2f}ms P99 {stats.quantile(0.99) * 1000:.2f}ms"
+                    f" 最长 {stats.max * 1000:.2f}ms")
+
+        def by_total(table: Dict[str, LatencyStats], limit: int):
+            return sorted(table.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+
+        minutes = int(time.time() - metrics.since) // 60
+        lines = [f"=== 运行统计（近 {minutes} 分钟，采样比例 {metrics.sample_rate:g}）==="]
+        lines.append("【命令】按累计耗时")
+        lines.extend(row(name, stats) for name, stats in by_total(metrics.commands, 15))
+        lines.append("【世界】按累计耗时")
+        lines.extend(row({'': '未绑定'}.get(group_id, group_id), stats)
+                     for group_id, stats in by_total(metrics.worlds, 5))
+        group_id = event.get_group_id()
+        if group_id in metrics.worlds and group_id not in dict(by_total(metrics.worlds, 5)):
+            lines.append(row(f"本群 {group_id}", metrics.worlds[group_id]))
+        lines.append("【存档】")
+        lines.extend(row(op, stats) for op, stats in by_total(metrics.persistence, 10))
+        if len(lines) == 4:
+            lines.append("暂无数据")
+        yield event.plain_result("\n".join(lines))
+
+    @filter.command("dp_profile", admin=True)
+    async def profile(self, event: AstrMessageEvent):
+        """管理员命令：采集 N 秒 cProfile（可选 tracemalloc），结束后自动关闭并发回热点函数"""
+        if self.shards is not None:
+            # 分片模式下采集负责本群的工作进程
+            async for result in self.shards.dispatch(event, "profile", (), {}):
+                yield result
+            return
 
-            # 处理拍卖结果
-            result_message = "🎉 拍卖会已结束！以下是竞拍结果：\n"
-            any_success = False
-            for index, item in enumerate(world.auction_items):
-                if item is None:  # Item might have been sold via quick-win
-                    continue
-                bid_info = world.auction_bids.get(str(index))
-                if bid_info:
-                    bidder_id = bid_info['bidder']
-                    bid_amount = bid_info['bid']
-
-                    # 检查玩家是否还在游戏中
-                    if bidder_id in world.players:
-                        player = world.players[bidder_id]
-                        if player.gold >= bid_amount:
-                            # 扣除金币并给予物品
-                            player.gold -= bid_amount
-                            player.add_item(item['name'])
-                            result_message += (
-                                f"【{item['name']}】由 {bid_info['bidder_name']} "
-                                f"以 {bid_amount}金币 成功拍得！\n"
-                            )
-                            any_success = True
-                            continue
+        args = event.message_str.strip().split()[1:]
+        memory = "内存" in args
+        args = [arg for arg in args if arg != "内存"]
+        try:
+            seconds = int(args[0]) if args else PROFILE_DEFAULT_SECONDS
+            if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+                raise ValueError
+        except ValueError:
+            yield event.plain_result(f"用法：/dp_profile [秒数 1~{PROFILE_MAX_SECONDS}] [内存]")
+            return
+        if self._profile_task is not None and not self._profile_task.done():
+            yield event.plain_result("已有性能采集在进行中，请等待其结束后再试")
+            return
 
-                # 如果没有人成功竞拍
-                result_message += f"【{item['name']}】流拍，无人获得。\n"
+        self._profile_task = self._start_background_task(
+            self._run_profile(seconds, memory, event.unified_msg_origin))
+        yield event.plain_result(
+            f"开始采集 {seconds} 秒性能数据" + ("（含内存分配，期间会明显变慢）" if memory else "") +
+            "，结束后自动关闭并发送结果"
+        )
 
-            if not any_success:
-               logger.info("本轮没有玩家成功竞拍")
-            else:
-                # 发送结果消息
-                message_chain = MessageChain().message(result_message)
-                await self.context.send_message(event.unified_msg_origin, message_chain)
-            # 立即刷新拍卖会
-            world.generate_auction_items()
-            world.last_auction_refresh = time.time()
-            world.auction_bids = {}
-            world.auction_end_time = world.last_auction_refresh + 3600
-            # 设置新的定时任务
-            world.auction_task = asyncio.create_task(
-                self._send_auction_end_message(event, group_id, world.auction_end_time)
-            )
-        except Exception as e:
-            logger.error(f"拍卖会结束消息发送失败: {e}")
+    @filter.command("dp_mem", admin=True)
+    async def memory_report(self, event: AstrMessageEvent):
+        """管理员命令：估算各世界的内存占用；可指定群号查看明细（本命令不加锁，分批让出事件循环）"""
+        if self.shards is not None:
+            # 分片模式下查看负责本群的工作进程
+            async for result in self.shards.dispatch(event, "memory_report", (), {}):
+                yield result
+            return
+        if self._memory_scan_running:
+            yield event.plain_result("内存统计正在进行中，请稍后再试")
+            return
 
-    async def _send_lottery_end_message(self, event: AstrMessageEvent, group_id: str, end_time: float):
+        args = event.message_str.strip().split()
+        target = args[1] if len(args) > 1 else event.get_group_id()
+        jobs_by_group: Dict[str, List[Dict[str, Any]]] = {}
+        for job in self.jobs.to_list():
+            jobs_by_group.setdefault(job["group_id"], []).append(job)
+
+        self._memory_scan_running = True
+        started = time.perf_counter()
+        reports = []
         try:
-            # 计算需要等待的时间
-            wait_time = end_time - time.time()
-            if wait_time > 0:
-                await asyncio.sleep(wait_time)
-            # 获取当前世界状态
-            world = self._get_world(group_id)
-            # 检查彩票是否真的该开奖了（防止提前刷新）
-            if time.time() < world.lottery_end_time:
-                return
-            # 执行开奖逻辑
-            if world.lottery_tickets:
-                result = world.draw_lottery()
-                message = world._send_lottery_result(event, result)
-                # 发送开奖结果
-                message_chain = MessageChain().message(message)
-                await self.context.send_message(event.unified_msg_origin, message_chain)
-            # 重置开奖时间
-            world.last_lottery_draw = time.time()
-            world.lottery_end_time = world.last_lottery_draw + 7200
-            # 设置新的定时任务
-            world.lottery_task = asyncio.create_task(
-                self._send_lottery_end_message(event, group_id, world.lottery_end_time)
+            for group_id, world in list(self.worlds.items()):
+                reports.append(await measure_world_memory(world, jobs_by_group.get(group_id, [])))
+        finally:
+            self._memory_scan_running = False
+        if not reports:
+            yield event.plain_result("当前没有已加载的世界")
+            return
+
+        reports.sort(key=lambda report: report["total"], reverse=True)
+        lines = [f"=== 世界内存占用估算（{len(reports)} 个世界，合计 "
+                 f"{format_bytes(sum(r['total'] for r in reports))}，耗时 {time.perf_counter() - started:.2f}秒）==="]
+        for report in reports[:10]:
+            sample = f"，抽样 {report['sampled']}" if report["sampled"] < report["players"] else ""
+            lines.append(f"{report['group_id']}: {format_bytes(report['total'])}（{report['players']} 名玩家{sample}）")
+        if len(reports) > 10:
+            lines.append(f"…… 另有 {len(reports) - 10} 个世界")
+
+        detail = next((r for r in reports if r["group_id"] == target), reports[0])
+        lock = self.world_locks.locks.get(detail["group_id"])
+        lines.append(f"【{detail['group_id']} 明细】")
+        lines.append(" | ".join(f"{name} {format_bytes(size)}" for name, size in detail["categories"].most_common()))
+        lines.append(f"定时任务 {detail['jobs']} 个，命令排队 {lock.waiting if lock else 0} 个")
+        if detail["largest"]:
+            lines.append("占用最大的玩家：")
+            lines.extend(
+                f"  {player.user_name}({player.user_id}) {format_bytes(size)}"
+                f"（背包 {len(player.inventory)} 件，加成 {len(player.temp_boosts)} 项）"
+                for size, player in detail["largest"]
             )
+        yield event.plain_result("\n".join(lines))
+
+    async def _run_profile(self, seconds: int, memory: bool, origin: str) -> None:
+        session = ProfileSession(memory)
+        try:
+            session.start()
+        except Exception as e:
+            await self._notify(origin, f"无法开始性能采集: {e}")
+            return
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            session.stop()
+        shard = self.persistence.shard
+        tag = time.strftime("profile-%Y%m%d-%H%M%S") + (f"-shard{shard[0]}" if shard is not None else "")
+        try:
+            summary = session.report(self.persistence.storage_dir / "profiles", tag)
         except Exception as e:
-            logger.error(f"彩票开奖消息发送失败: {e}")
+            logger.error(f"生成性能报告失败: {e}")
+            summary = f"性能采集已结束，但生成报告失败: {e}"
+        await self._notify(origin, summary)
+
+
+
+
+    def _clear_quick_wins(self, group_id: str) -> None:
+        """取消某个世界所有拍卖物品的快速成交倒计时"""
+        for job in [j for j in self.jobs.to_list() if j["kind"] == "quick_win" and j["group_id"] == group_id]:
+            self.jobs.cancel("quick_win", group_id, job["key"])
+        self._jobs_changed()
+
+    async def _job_auction_end(self, job: Dict[str, Any]):
+        """拍卖会结束：结算竞拍结果并立即开启下一轮"""
+        group_id = job["group_id"]
+        if group_id not in self.worlds:
+            return
+        world = self.worlds[group_id]
+        # 检查拍卖是否真的结束了（拍卖会可能已被刷新并改期）
+        if time.time() < world.auction_end_time:
+            self.jobs.schedule("auction_end", group_id, world.auction_end_time)
+            return
+
+        # At the end of the auction, drop all pending quick-win countdowns.
+        self._clear_quick_wins(group_id)
+
+        # 处理拍卖结果
+        result_message = "🎉 拍卖会已结束！以下是竞拍结果：\n"
+        any_success = False
+        for index, item in enumerate(world.auction_items):
+            if item is None:  # Item might have been sold via quick-win
+                continue
+            # 从托管金币中付款并给予物品
+            bid_info, sold = world.settle_auction_item(index)
+            if sold:
+                result_message += (
+                    f"【{item['name']}】由 {bid_info['bidder_name']} "
+                    f"以 {bid_info['bid']}金币 成功拍得！\n"
+                )
+                any_success = True
+                continue
+
+            # 如果没有人成功竞拍
+            result_message += f"【{item['name']}】流拍，无人获得。\n"
+
+        if not any_success:
+            logger.info("本轮没有玩家成功竞拍")
+        else:
+            # 发送结果消息
+            await self._notify(job["origin"] or world.notify_origin, result_message)
+        # 立即刷新拍卖会
+        world.generate_auction_items()
+        world.last_auction_refresh = time.time()
+        world.refund_auction_bids()
+        world.auction_end_time = world.last_auction_refresh + 3600
+        self._save_world(group_id)
+        # 设置新的定时任务
+        self.jobs.schedule("auction_end", group_id, world.auction_end_time)
+
+    async def _job_lottery_draw(self, job: Dict[str, Any]):
+        """斗破彩定时开奖"""
+        group_id = job["group_id"]
+        if group_id not in self.worlds:
+            return
+        world = self.worlds[group_id]
+        # 检查彩票是否真的该开奖了（防止提前开奖）
+        if time.time() < world.lottery_end_time:
+            self.jobs.schedule("lottery_draw", group_id, world.lottery_end_time)
+            return
+        # 执行开奖逻辑
+        if world.lottery_tickets:
+            result = world.draw_lottery()
+            message = world._send_lottery_result(None, result)
+            # 发送开奖结果
+            await self._notify(job["origin"] or world.notify_origin, message)
+        # 重置开奖时间
+        world.last_lottery_draw = time.time()
+        world.lottery_end_time = world.last_lottery_draw + LOTTERY_DRAW_INTERVAL
+        self._save_world(group_id)
+        # 设置新的定时任务
+        self.jobs.schedule("lottery_draw", group_id, world.lottery_end_time)
 
     @filter.command("交易")
+    @world_serialized
     async def trade_item(self, event: AstrMessageEvent):
         """发起交易请求"""
         world = self._get_world(event.get_group_id())
@@ -4799,7 +8507,7 @@ class DouPoCangQiongFinal(Star):
             "create_time": time.time(),
             "status": "pending"
         }
-        world.trade_requests[trade_id] = trade_data
+        world.trade_requests.add(trade_id, trade_data)
 
         yield event.plain_result(
             f"✅ 交易请求已发送！\n"
@@ -4807,12 +8515,14 @@ class DouPoCangQiongFinal(Star):
             f"💰 金额：{amount}金币\n"
             f"👤 对方：{target.user_name}\n"
             f"🔢 交易号：{trade_id}\n"
+            f"⏰ 有效期：{TRADE_REQUEST_TTL // 60}分钟\n"
             f"请让对方使用以下命令处理：\n"
             f"• /接受交易 {trade_id} - 接受交易\n"
             f"• /拒绝交易 {trade_id} - 拒绝交易"
         )
 
     @filter.command("接受交易")
+    @world_serialized
     async def accept_trade(self, event: AstrMessageEvent):
         """接受交易请求"""
         world = self._get_world(event.get_group_id())
@@ -4883,6 +8593,7 @@ class DouPoCangQiongFinal(Star):
             yield event.plain_result("交易执行失败，请稍后重试！")
 
     @filter.command("拒绝交易")
+    @world_serialized
     async def reject_trade(self, event: AstrMessageEvent):
         """拒绝交易请求"""
         world = self._get_world(event.get_group_id())
@@ -4928,35 +8639,147 @@ class DouPoCangQiongFinal(Star):
             f"交易已取消"
         )
 
-    async def _auto_train_loop(self, event: AstrMessageEvent, group_id: str, user_id: str):
-        """后台自动修炼循环"""
-        world = self._get_world(group_id)
-        player = world.players.get(user_id)
+    def _handle_place_order(self, event: AstrMessageEvent, side: str) -> str:
+        """解析 /挂单 与 /求购 的参数并下单"""
+        world = self._get_world(event.get_group_id())
+        user_id = event.get_sender_id()
+        command = "挂单" if side == "sell" else "求购"
+        if user_id not in world.players:
+            return "你还没有加入游戏，请输入 /dp_join 加入游戏！"
 
-        try:
-            while True:
-                player = self._get_world(group_id).players.get(user_id)
-                if not player or not player.is_auto_training:
-                    break
+        args = event.message_str.strip().split()
+        usage = (
+            f"格式：/{command} 物品名称 单价 [数量]\n"
+            f"示例：/{command} 1品聚气丹 120 5"
+        )
+        if len(args) < 3 or not args[-1].isdigit():
+            return usage
+        if len(args) >= 4 and args[-2].isdigit():
+            price, quantity = int(args[-2]), int(args[-1])
+            item_name = " ".join(args[1:-2])
+        else:
+            price, quantity = int(args[-1]), 1
+            item_name = " ".join(args[1:-1])
+        if not item_name:
+            return usage
+        if price <= 0 or quantity <= 0:
+            return "单价和数量必须大于0！"
+        if quantity > 200:
+            return "单笔订单数量不能超过200！"
 
-                success, msg = player.train(continuous=True)
+        success, msg = world.place_order(world.players[user_id], side, item_name, price, quantity)
+        if not success:
+            return msg
+        self._save_world(event.get_group_id())
+        action = "出售" if side == "sell" else "求购"
+        return f"📑 {action}【{item_name}】×{quantity} 单价{price}金币\n{msg}"
+
+    @filter.command("挂单")
+    @world_serialized
+    async def place_sell_order(self, event: AstrMessageEvent):
+        """挂出卖单（物品立即托管）"""
+        yield event.plain_result(self._handle_place_order(event, "sell"))
+
+    @filter.command("求购")
+    @world_serialized
+    async def place_buy_order(self, event: AstrMessageEvent):
+        """挂出买单（金币立即冻结）"""
+        yield event.plain_result(self._handle_place_order(event, "buy"))
+
+    @filter.command("撤单")
+    @world_serialized
+    async def cancel_order(self, event: AstrMessageEvent):
+        """撤销挂单；不带参数时列出自己的挂单"""
+        world = self._get_world(event.get_group_id())
+        user_id = event.get_sender_id()
+        args = event.message_str.strip().split()
 
-                if not success:
-                    await self.context.send_private_message(user_id, f"自动修炼已停止：{msg}")
-                    break
+        if user_id not in world.players:
+            yield event.plain_result("你还没有加入游戏，请输入 /dp_join 加入游戏！")
+            return
+
+        if len(args) < 2:
+            orders = world.get_player_orders(user_id)
+            if not orders:
+                yield event.plain_result("你当前没有挂单！")
+                return
+            yield event.plain_result(
+                "=== 我的挂单 ===\n" +
+                "\n".join([
+                    f"{o['order_id']} {'卖' if o['side'] == 'sell' else '买'} 【{o['item_name']}】"
+                    f"×{o['quantity']} @ {o['price']}金币"
+                    for o in orders
+                ]) +
+                "\n\n使用 /撤单 订单号 撤销挂单"
+            )
+            return
 
-                if "突破" in msg or "晋升" in msg:
-                    await self.context.send_private_message(user_id, f"自动修炼通知：{msg}")
+        success, msg = world.cancel_order(user_id, args[1])
+        if success:
+            self._save_world(event.get_group_id())
+        yield event.plain_result(msg)
 
-                await asyncio.sleep(player.cooldowns["train"])
-        finally:
-            if player:
-                player.is_auto_training = False
-            if user_id in self.auto_train_tasks:
-                del self.auto_train_tasks[user_id]
+    @filter.command("盘口")
+    @world_serialized
+    async def order_book(self, event: AstrMessageEvent):
+        """查看挂单簿"""
+        world = self._get_world(event.get_group_id())
+        args = event.message_str.strip().split()
+
+        if len(args) < 2:
+            if not world.order_books:
+                yield event.plain_result("当前没有任何挂单！使用 /挂单 或 /求购 发布订单")
+                return
+            lines = []
+            for item_name, book in world.order_books.items():
+                best_bid = book.best("buy")
+                best_ask = book.best("sell")
+                lines.append(
+                    f"【{item_name}】买一：{best_bid['price'] if best_bid else '-'} | "
+                    f"卖一：{best_ask['price'] if best_ask else '-'}"
+                )
+            yield event.plain_result(
+                "=== 玩家盘口 ===\n" + "\n".join(lines) + "\n\n使用 /盘口 物品名称 查看深度"
+            )
+            return
+
+        item_name = " ".join(args[1:])
+        book = world.order_books.get(item_name)
+        if not book:
+            yield event.plain_result(f"【{item_name}】当前没有挂单！")
+            return
+
+        asks = book.depth("sell")
+        bids = book.depth("buy")
+        lines = [f"=== 【{item_name}】盘口 ==="]
+        lines.extend(f"卖{i + 1}  {price}金币 ×{qty}" for i, (price, qty) in reversed(list(enumerate(asks))))
+        lines.append("──────────")
+        lines.extend(f"买{i + 1}  {price}金币 ×{qty}" for i, (price, qty) in enumerate(bids))
+        yield event.plain_result("\n".join(lines))
+
+    async def _job_auto_train(self, job: Dict[str, Any]):
+        """自动修炼：每次执行一轮修炼，然后按修炼冷却改期下一轮"""
+        group_id, user_id = job["group_id"], job["key"]
+        world = self.worlds.get(group_id)
+        player = world.players.get(user_id) if world else None
+        if not player or not player.is_auto_training:
+            return
+
+        success, msg = player.train(continuous=True)
+
+        if not success:
+            player.is_auto_training = False
             self._save_world(group_id)
+            await self.context.send_private_message(user_id, f"自动修炼已停止：{msg}")
+            return
+
+        if "突破" in msg or "晋升" in msg:
+            await self.context.send_private_message(user_id, f"自动修炼通知：{msg}")
+
+        self.jobs.schedule("auto_train", group_id, time.time() + player.cooldowns["train"], key=user_id)
 
     @filter.command("自动修炼")
+    @world_serialized
     async def auto_train(self, event: AstrMessageEvent):
         """开启或关闭自动修炼"""
         group_id = event.get_group_id()
@@ -4969,11 +8792,10 @@ class DouPoCangQiongFinal(Star):
 
         player = world.players[user_id]
 
-        if user_id in self.auto_train_tasks:
+        if player.is_auto_training:
             # 停止自动修炼
-            self.auto_train_tasks[user_id].cancel()
+            self._cancel_job("auto_train", group_id, user_id)
             player.is_auto_training = False
-            del self.auto_train_tasks[user_id]
             self._save_world(group_id)
             yield event.plain_result("自动修炼已停止。")
         else:
@@ -4984,18 +8806,6 @@ class DouPoCangQiongFinal(Star):
                 return
 
             player.is_auto_training = True
-            task = asyncio.create_task(self._auto_train_loop(event, group_id, user_id))
-            self.auto_train_tasks[user_id] = task
+            self._schedule_job("auto_train", group_id, time.time(), key=user_id)
             self._save_world(group_id)
             yield event.plain_result("自动修炼已开启！系统将在后台为您持续修炼。当遇到濒死、需要突破等情况时将自动停止。")
-
-
-
-
-
-
-
-
-
-
-